@@ -1,21 +1,78 @@
 import numpy as np
-import pandas as pd
 import datetime
-from event import SignalEvent, MarketEvent
+from event import BasketSignalEvent, SignalEvent, MarketEvent
 from strategy import Strategy
 
 
+def select_layer(values, cur_layer, n):
+    """
+    按因子值从大到小排序（NaN排在最后，相同的值按股票顺序）后，返回第cur_layer层n支股票的下标。
+    用partition找出这一层的边界值，只对边界值之间的股票做稳定排序，各层互不重叠，合起来覆盖所有股票。
+    """
+
+    key = np.where(np.isnan(values), np.inf, -values)
+    lo = min(cur_layer * n, len(key))
+    hi = min((cur_layer + 1) * n, len(key))
+    if hi <= lo:
+        return np.empty(0, dtype=int)
+    bound = np.partition(key, [lo, hi - 1])
+    candidates = np.flatnonzero((key >= bound[lo]) & (key <= bound[hi - 1]))
+    ordered = candidates[np.argsort(key[candidates], kind='stable')]
+    skipped = np.count_nonzero(key < bound[lo])
+    return np.sort(ordered[lo - skipped:hi - skipped])
+
+
+class FactorRanker(object):
+    """
+    取出当前数据条目上所有股票的因子截面。同一个数据条目只取一次，
+    分层测试时各层的策略共用一个FactorRanker，各自选出属于自己的一层。
+    factor可以是因子名，也可以是{因子: 权重}，此时按z-score加权合成后排序（见PanelDataHandler.combine_factors）。
+    """
+
+    def __init__(self, bars, factor):
+        self.bars = bars
+        self.symbol_list = self.bars.symbol_list
+        if isinstance(factor, dict):
+            factor = self.bars.combine_factors(factor)
+        self.factor = factor
+        self.ranked_datetime = None
+        self.values = None
+
+    def cross_section(self):
+        # 因子截面向量，按数据条目的日期缓存
+        bar_date = self.bars.get_latest_bar_datetime(self.symbol_list[0])
+        if self.values is None or bar_date != self.ranked_datetime:
+            self.values = np.asarray(self.bars.get_latest_cross_section(self.factor), dtype=float)
+            self.ranked_datetime = bar_date
+        return self.values
+
+    def layer_mask(self, cur_layer, n):
+        # 第cur_layer层n支股票的布尔掩码，顺序与symbol_list一致
+        mask = np.zeros(len(self.symbol_list), dtype=bool)
+        mask[select_layer(self.cross_section(), cur_layer, n)] = True
+        return mask
+
+
 class TestStrategy(Strategy):
+    """
+    月底按因子选股的策略。默认按原来的方式逐支股票发出SignalEvent，由Portfolio.generate_naive_order生成订单；
+    basket为True时每次清仓和买入各发出一个BasketSignalEvent（目标权重向量），组合和执行对象按向量一次处理，
+    例如strategy_cls=functools.partial(TestStrategy, basket=True)
+    """
 
-    def __init__(self, bars, events, stock_num, factor='close', layer=1):
+    def __init__(self, bars, events, stock_num, factor='close', layer=1, ranker=None, basket=False):
         self.bars = bars
         self.symbol_list = self.bars.symbol_list
         self.events = events
         self.stock_num = stock_num
         self.factor = factor
         self.layer = layer
-        self.stock_list = pd.DataFrame()
+        self.ranker = ranker if ranker is not None else FactorRanker(bars, factor)
+        self.stock_list = set()
+        self.selected = np.zeros(len(self.symbol_list), dtype=bool)
         self.transferring = False  # 调仓中
+        self.basket = basket
+        self.holding = np.zeros(len(self.symbol_list), dtype=bool)  # 按symbol_list排列的持有情况
 
         self.bought = self._calculate_initial_bought()
 
@@ -28,42 +85,65 @@ class TestStrategy(Strategy):
 
     def calculate_stock_selection(self, cur_layer):
         # 计算月底要买入哪些股票
-        n = int(self.stock_num / self.layer)  # 买入股票数量        ！！na值待处理！！
-        bars = []
-        for s in self.symbol_list:
-            bars.append(self.bars.get_latest_bar_value(
-                s, self.factor))  # 将每支股票的因子放入列表中
-        self.stock_list = pd.DataFrame(bars, self.symbol_list, columns=[self.factor])
-        self.stock_list = self.stock_list.sort_values(self.factor, ascending=False)  # 按因子值排序
-        self.stock_list = self.stock_list[cur_layer * n: (cur_layer + 1) * n].reset_index()['index']  # 把前n支股票放入dataframe中，股票代码作为index
+        n = int(self.stock_num / self.layer)  # 买入股票数量，na值排在最后，处理方式见FactorPreprocessor
+        self.selected = self.ranker.layer_mask(cur_layer, n)  # 第cur_layer层股票的布尔掩码
+        self.stock_list = set(self.symbol_list[j] for j in np.flatnonzero(self.selected))
 
     def calculate_signals(self, event, cur_layer=0):
 
         if event.type == 'MARKET':
-            self.calculate_stock_selection(cur_layer) # 调用计算函数
 
-            if not self.transferring:
+            if self.basket:
+                self.calculate_basket_signals(cur_layer)
+
+            elif not self.transferring:
                 for s in self.symbol_list:  # 遍历所有股票
                     if self.bought[s] == 'LONG':  # 如果持有
                         bar_date = self.bars.get_latest_bar_datetime(s)  # 获取目前日期
                         symbol = s
                         dt = datetime.datetime.utcnow()  # 获取当前现实时间（目前框架里还没用到）
                         sig_dir = 'EXIT'  # 指令为清仓
-                        order_price = self.bars.get_latest_bars_values(s, 'close')  # 交易价格，用收盘价表示
+                        order_price = self.bars.get_latest_bar_value(s, 'close')  # 交易价格，用收盘价表示
                         signal = SignalEvent(1, bar_date, symbol, dt, sig_dir, order_price, 1.0)  # 抛出清仓信号事件
                         self.events.put(signal)  # 将事件放入队列中 （循环后队列中应该多出n个清仓信号）
                         self.bought[s] = 'OUT'  # 买入情况变为'OUT'
                 self.transferring = True  # 调仓中，transferring为True时不会进行下一天的循环
 
             else:
-                for s in self.symbol_list:
-                    if s in self.stock_list.values and self.bought[s] == "OUT":  # 股票在待买入列表中
+                self.calculate_stock_selection(cur_layer)  # 调用计算函数，只在买入时需要
+                for j in np.flatnonzero(self.selected):  # 只遍历待买入的股票
+                    s = self.symbol_list[j]
+                    if self.bought[s] == "OUT":
                         bar_date = self.bars.get_latest_bar_datetime(s)
                         symbol = s
                         dt = datetime.datetime.utcnow()
                         sig_dir = 'LONG'  # 指令为买入
-                        order_price = self.bars.get_latest_bars_values(s, 'close')
+                        order_price = self.bars.get_latest_bar_value(s, 'close')
                         signal = SignalEvent(1, bar_date, symbol, dt, sig_dir, order_price, 1.0)  # 抛出买入信号事件
                         self.events.put(signal)  # 将事件放入队列中（循环后队列中应该多出n个买入信号）
                         self.bought[s] = "LONG"  # 买入情况变为'LONG'
                 self.transferring = False  # 调仓结束，transferring为False，信号处理结束后正常进行下一天的循环
+
+    def calculate_basket_signals(self, cur_layer):
+        # 清仓和买入各用一个目标权重信号完成，每支入选股票的权重为1/stock_num
+        bar_date = self.bars.get_latest_bar_datetime(self.symbol_list[0])
+        dt = datetime.datetime.utcnow()
+        order_price = self.bars.get_latest_cross_section('close')
+
+        if not self.transferring:
+            if self.holding.any():
+                weights = np.zeros(len(self.symbol_list))  # 目标权重全为0，即清仓
+                self.events.put(BasketSignalEvent(1, bar_date, self.symbol_list, dt, weights, order_price))
+                self.bought.update((self.symbol_list[j], 'OUT') for j in np.flatnonzero(self.holding))
+                self.holding[:] = False
+            self.transferring = True
+
+        else:
+            self.calculate_stock_selection(cur_layer)
+            buy = self.selected & ~self.holding
+            if buy.any():
+                weights = buy / self.stock_num
+                self.events.put(BasketSignalEvent(1, bar_date, self.symbol_list, dt, weights, order_price))
+                self.bought.update((self.symbol_list[j], 'LONG') for j in np.flatnonzero(buy))
+                self.holding |= buy
+            self.transferring = False
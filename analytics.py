@@ -0,0 +1,207 @@
+# analytics.py
+
+import numpy as np
+import pandas as pd
+
+'''
+因子分析：直接在对齐后的(日期 × 股票)矩阵上批量计算IC、Rank IC、IC衰减、因子自相关和分位数组合收益，
+不需要逐层回放FactorTest。所有按日期的统计都是对矩阵逐行（同一天的所有股票）计算，
+NaN不参与计算；第t天的因子与t日收盘到t+h日收盘的远期收益对应，与回测在收盘价调仓一致。
+'''
+
+
+def forward_returns(close, horizon=1):
+    """
+    (日期 × 股票)的h期远期收益：close[t + h] / close[t] - 1。价格为0（未上市）或者超出数据范围时为NaN
+    """
+
+    close = np.where(close > 0, close, np.nan)
+    result = np.full(close.shape, np.nan)
+    if horizon < len(close):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result[:len(close) - horizon] = close[horizon:] / close[:-horizon] - 1.0
+    return result
+
+
+def rank_rows(values):
+    """
+    沿最后一维（股票）计算排名，相同的值取平均排名，NaN保持为NaN
+    """
+
+    flat = values.reshape(-1, values.shape[-1])
+    return pd.DataFrame(flat).rank(axis=1).to_numpy().reshape(values.shape)
+
+
+def row_corr(a, b):
+    """
+    沿最后一维逐行计算Pearson相关系数，只使用两者都不是NaN的股票，有效股票少于3支时为NaN
+    """
+
+    valid = ~np.isnan(a) & ~np.isnan(b)
+    n = valid.sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_a = np.where(valid, a, 0.0).sum(axis=-1) / n
+        mean_b = np.where(valid, b, 0.0).sum(axis=-1) / n
+        da = np.where(valid, a - mean_a[..., None], 0.0)
+        db = np.where(valid, b - mean_b[..., None], 0.0)
+        corr = (da * db).sum(axis=-1) / np.sqrt((da * da).sum(axis=-1) * (db * db).sum(axis=-1))
+    return np.where(n >= 3, corr, np.nan)
+
+
+def information_coefficient(factor, returns, rank=False):
+    """
+    每天因子与远期收益的截面相关系数；rank为True时是Rank IC（Spearman）
+    """
+
+    if rank:
+        valid = ~np.isnan(factor) & ~np.isnan(returns)
+        factor = rank_rows(np.where(valid, factor, np.nan))
+        returns = rank_rows(np.where(valid, returns, np.nan))
+    return row_corr(factor, returns)
+
+
+def quantile_labels(factor, quantiles=5):
+    """
+    每天按因子值从小到大把股票分成quantiles组，返回0 ~ quantiles-1的组号，NaN为-1
+    """
+
+    ranks = rank_rows(factor)
+    n = (~np.isnan(factor)).sum(axis=-1, keepdims=True)
+    with np.errstate(invalid='ignore'):
+        labels = np.floor((ranks - 1) * quantiles / n)
+    return np.where(np.isnan(labels), -1, labels).astype(int)
+
+
+def quantile_mean_returns(factor, returns, quantiles=5):
+    """
+    每天每组股票远期收益的平均值，返回(日期 × 组)矩阵，第0组因子值最小
+    """
+
+    labels = np.where(np.isnan(returns), -1, quantile_labels(factor, quantiles))
+    result = np.full(factor.shape[:-1] + (quantiles,), np.nan)
+    for q in range(quantiles):
+        mask = labels == q
+        count = mask.sum(axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result[..., q] = np.where(mask, returns, 0.0).sum(axis=-1) / count
+    return result
+
+
+def _nanmean(values):
+
+    values = values[~np.isnan(values)]
+    return values.mean() if len(values) else np.nan
+
+
+def ic_summary(ic, periods=252):
+    """
+    IC序列的汇总：均值、标准差、IR（均值 / 标准差）、t统计量、IC大于0的比例，以及年化IR
+    """
+
+    ic = np.asarray(ic, dtype=float)
+    ic = ic[~np.isnan(ic)]
+    n = len(ic)
+    mean = ic.mean() if n else np.nan
+    std = ic.std(ddof=1) if n > 1 else np.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ir = mean / std
+    return {'ic_mean': mean, 'ic_std': std, 'ir': ir, 't_stat': ir * np.sqrt(n),
+            'hit_rate': (ic > 0).mean() if n else np.nan, 'annualized_ir': ir * np.sqrt(periods)}
+
+
+class FactorAnalysis(object):
+    """
+    FactorAnalysis对一个已经读入数据的数据对象（PanelDataHandler、HistoricCSVDataHandler等）或者MarketPanel
+    做因子分析。数据对象中通过add_field/preprocess_factor加入的字段也可以直接分析。
+    远期收益按horizon缓存，分析多个因子时只计算一次
+    """
+
+    def __init__(self, bars, price='close', periods=252):
+
+        self.bars = bars
+        self.panel = getattr(bars, 'panel', bars)
+        self.price = price
+        self.periods = periods
+        self.index = pd.Index(self.panel.dates, name='datetime')
+        self._returns = {}
+
+    def factors(self):
+        """
+        面板中的所有因子字段
+        """
+
+        return self.panel.factor_fields()
+
+    def _values(self, factor):
+
+        return np.asarray(self.bars.field(factor), dtype=float)
+
+    def forward_returns(self, horizon=1):
+
+        if horizon not in self._returns:
+            self._returns[horizon] = forward_returns(np.asarray(self.bars.field(self.price), dtype=float), horizon)
+        return self._returns[horizon]
+
+    def ic(self, factor, horizon=1, rank=False):
+        """
+        每天的IC（rank为True时是Rank IC），以日期为索引的Series
+        """
+
+        return pd.Series(information_coefficient(self._values(factor), self.forward_returns(horizon), rank),
+                         index=self.index, name=factor)
+
+    def ic_decay(self, factor, horizons=(1, 5, 10, 20, 60)):
+        """
+        不同远期收益期数下IC和Rank IC的均值与IR，每个期数一行
+        """
+
+        values = self._values(factor)
+        rows = []
+        for h in horizons:
+            returns = self.forward_returns(h)
+            ic = ic_summary(information_coefficient(values, returns), self.periods)
+            rank_ic = ic_summary(information_coefficient(values, returns, rank=True), self.periods)
+            rows.append({'ic_mean': ic['ic_mean'], 'ic_ir': ic['ir'],
+                         'rank_ic_mean': rank_ic['ic_mean'], 'rank_ic_ir': rank_ic['ir']})
+        return pd.DataFrame(rows, index=pd.Index(list(horizons), name='horizon'))
+
+    def autocorrelation(self, factor, lag=1):
+        """
+        因子的截面秩自相关：每天的因子排名与lag天前排名的相关系数，反映因子的稳定性和换手
+        """
+
+        values = self._values(factor)
+        result = np.full(len(values), np.nan)
+        if lag < len(values):
+            ranks = rank_rows(values)
+            result[lag:] = row_corr(ranks[lag:], ranks[:-lag])
+        return pd.Series(result, index=self.index, name=factor)
+
+    def quantile_returns(self, factor, horizon=1, quantiles=5):
+        """
+        每天按因子值分成quantiles组，各组远期收益的平均值，(日期 × 组)的DataFrame，第0组因子值最小
+        """
+
+        result = quantile_mean_returns(self._values(factor), self.forward_returns(horizon), quantiles)
+        return pd.DataFrame(result, index=self.index, columns=pd.Index(range(quantiles), name='quantile'))
+
+    def summary(self, factors=None, horizon=1, quantiles=5):
+        """
+        对多个因子（默认为面板中的所有因子）批量计算IC、Rank IC、自相关和多空组合收益，每个因子一行，
+        用来在回测之前快速筛选因子
+        """
+
+        factors = self.factors() if factors is None else list(factors)
+        returns = self.forward_returns(horizon)
+        rows = []
+        for factor in factors:
+            values = self._values(factor)
+            ic = ic_summary(information_coefficient(values, returns), self.periods)
+            rank_ic = ic_summary(information_coefficient(values, returns, rank=True), self.periods)
+            spread = quantile_mean_returns(values, returns, quantiles)
+            rows.append({'ic_mean': ic['ic_mean'], 'ic_ir': ic['ir'], 'ic_t_stat': ic['t_stat'],
+                         'rank_ic_mean': rank_ic['ic_mean'], 'rank_ic_ir': rank_ic['ir'],
+                         'rank_ic_hit_rate': rank_ic['hit_rate'],
+                         'autocorrelation': _nanmean(self.autocorrelation(factor).to_numpy()),
+                         'long_short_return': _nanmean(spread[:, -1] - spread[:, 0])})
+        return pd.DataFrame(rows, index=pd.Index(factors, name='factor'))
@@ -1,13 +1,37 @@
 # backtest.py
 
 import datetime
+import logging
 import pprint
-import queue
 import time
 
 from Test_strategy import TestStrategy
 from equity_plot import plot_performance
-from event import MarketEvent
+from event import EventBus, MarketEvent, ThreadedEventBus
+
+# 回测引擎各模块的logger都在'backtest'下，设置它的级别即可控制所有输出
+logger = logging.getLogger('backtest')
+
+
+class BacktestResult(object):
+    """
+    一次回测（分层测试时为其中一层）的结果：equity_curve、汇总统计、成交记录，以及信号、订单和成交的数量。
+    导出CSV是单独的可选步骤
+    """
+
+    def __init__(self, equity_curve, stats, execution_records, signals=None, orders=None, fills=None):
+
+        self.equity_curve = equity_curve
+        self.stats = stats
+        self.execution_records = execution_records
+        self.signals = signals
+        self.orders = orders
+        self.fills = fills
+
+    def to_csv(self, equity_path='equity.csv', execution_path='Execution_summary.csv'):
+
+        self.equity_curve.to_csv(equity_path)
+        self.execution_records.to_csv(execution_path)
 
 
 class Backtest(object):
@@ -15,7 +39,8 @@ class Backtest(object):
     def __init__(
             self, stock_csv_dir, factor_csv_dir, symbol_list, initial_capital, stock_num,
             heartbeat, start_date, data_handler_cls,
-            execution_handler_cls, portfolio_cls, strategy_cls
+            execution_handler_cls, portfolio_cls, strategy_cls, cache_dir=None, workers=1, threaded=False,
+            instrumentation=None, log_level=None, rebalance='M', skip_ahead=True, factor=None
     ):
 
         self.stock_csv_dir = stock_csv_dir
@@ -25,13 +50,22 @@ class Backtest(object):
         self.heartbeat = heartbeat
         self.stock_num = stock_num
         self.start_date = start_date
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.threaded = threaded
+        self.instrumentation = instrumentation  # Instrumentation对象，None表示不计时
+        self.rebalance = rebalance  # 调仓日历，见TradingCalendar.rebalance_offsets
+        self.skip_ahead = skip_ahead  # 两个控制点之间是否跳过逐日推进，见_skip_ahead
+        self.factor = factor  # 数据对象统计缺失值时使用的因子，None表示不统计
+        if log_level is not None:
+            logger.setLevel(log_level)
 
         self.data_handler_cls = data_handler_cls
         self.execution_handler_cls = execution_handler_cls
         self.portfolio_cls = portfolio_cls
         self.strategy_cls = strategy_cls
 
-        self.events = queue.Queue()
+        self.events = self._new_event_bus()
 
         self.signals = 0
         self.orders = 0
@@ -44,78 +78,176 @@ class Backtest(object):
 
     def _generate_trading_instances(self):
 
-        print(
-            "Creating DataHandler, Strategy, Portfolio and ExecutionHandler/n"
-        )
+        logger.info("Creating DataHandler, Strategy, Portfolio and ExecutionHandler")
 
-        self.data_handler = self.data_handler_cls(self.events, self.stock_csv_dir, self.factor_csv_dir,
-                                                  self.start_date, self.symbol_list)
+        self.data_handler = self.data_handler_cls(self.events, self.stock_csv_dir, self.factor_csv_dir, self.factor,
+                                                  self.start_date, self.symbol_list, cache_dir=self.cache_dir,
+                                                  workers=self.workers)
+        self.data_handler.set_rebalance(self.rebalance)
         self.strategy = self.strategy_cls(self.data_handler, self.events)
+        self.data_handler.declare_lookback(self.strategy.lookback)
         self.portfolio = self.portfolio_cls(self.data_handler, self.events, self.start_date,
                                             self.initial_capital, self.stock_num)
         self.execution_handler = self.execution_handler_cls(self.events)
+        self._subscribe_handlers(self.events)
+
+    def _new_event_bus(self):
+        """
+        回测默认使用单线程的EventBus；threaded=True时使用基于queue.Queue的ThreadedEventBus，
+        用于行情从其他线程推送进来的实盘场景
+        """
+
+        return ThreadedEventBus() if self.threaded else EventBus()
+
+    def _subscribe_handlers(self, events):
+
+        events.subscribe('MARKET', self._on_market)
+        for event_type in ('SIGNAL', 'BASKET_SIGNAL'):
+            events.subscribe(event_type, self._on_signal)
+        for event_type in ('ORDER', 'BASKET_ORDER'):
+            events.subscribe(event_type, self._on_order)
+        for event_type in ('FILL', 'BASKET_FILL'):
+            events.subscribe(event_type, self._on_fill)
+
+    def _on_market(self, event):
+
+        self.strategy.calculate_signals(event)
+        self.portfolio.update_timeindex()
+
+    def _on_signal(self, event):
+
+        self.signals += 1
+        self.portfolio.update_signal(event)
+
+    def _on_order(self, event):
+
+        self.orders += 1
+        self.execution_handler.execute_order(event)
+
+    def _on_fill(self, event):
+
+        self.fills += 1
+        self.portfolio.update_fill(event)
+
+    def _continue_transfer(self):
+        """
+        队列清空后，如果策略仍在调仓中（已发出清仓信号，还没有买入），再放入一个MarketEvent
+        """
+
+        if self.strategy.transferring:
+            self.strategy.events.put(MarketEvent())
+            return True
+        return False
+
+    def _skip_ahead(self, strategies, portfolios):
+        """
+        游标刚到达一个不是控制点的数据条目时，求出下一个控制点（各策略next_control的最小值）。
+        逐日推进时只记录这个控制点，由update_bars_monthly在控制点发出MarketEvent；
+        skip_ahead时控制点之前没有事件：直接把游标移到控制点的前一个数据条目，中间的数据条目由portfolios一次完成逐日市值结算。
+        两种方式的控制点完全相同，净值曲线也完全相同
+        """
+
+        data_handler = self.data_handler
+        t = data_handler.bar_index
+        if (not data_handler.continue_backtest or data_handler.next_month_bar
+                or t < 0 or data_handler.is_control(t)):
+            return
+        if data_handler.control_index is None or data_handler.control_index < t:
+            # 两个控制点之间没有事件，策略状态不变，控制点只需在上一个控制点之后求一次
+            data_handler.control_index = min(min(strategy.next_control(t) for strategy in strategies),
+                                             len(data_handler.panel) - 1)
+        control = data_handler.control_index
+        if not self.skip_ahead:
+            return
+        if control > t + 1:
+            for portfolio in portfolios:
+                portfolio.update_timeindex_range(t + 1, control)
+        data_handler.skip_to(max(control - 1, t), control)
+
+    def _start_instrumentation(self):
+
+        if self.instrumentation is not None:
+            self.instrumentation.attach(self)
+
+    def _end_iteration(self):
+
+        if self.instrumentation is not None:
+            self.instrumentation.end_iteration()
+
+    def _finish_instrumentation(self):
+
+        if self.instrumentation is not None:
+            self.instrumentation.finish()
 
     def _run_backtest(self):
 
+        self._start_instrumentation()
         i = 0
         while True:
             i += 1
-            print(i)
+            logger.debug("iteration %d", i)
 
             if self.data_handler.continue_backtest:
                 self.data_handler.update_bars_monthly()
             else:
                 break
 
-            while True:
-                try:
-                    event = self.events.get(False)
-                except queue.Empty:
-                    break
-                else:
-                    if event is not None:
-                        if event.type == 'MARKET':
-                            self.strategy.calculate_signals(event)
-                            self.portfolio.update_timeindex()
-                        elif event.type == 'SIGNAL':
-                            self.signals += 1
-                            self.portfolio.update_signal(event)
-                        elif event.type == 'ORDER':
-                            self.orders += 1
-                            self.execution_handler.execute_order(event)
-                        elif event.type == 'FILL':
-                            self.fills += 1
-                            self.portfolio.update_fill(event)
-
-                if self.events.empty() and self.strategy.transferring == True:
-                    self.events.put(MarketEvent())
-
-            time.sleep(self.heartbeat)
-
-    def _output_performance(self):
+            self.events.dispatch(self._continue_transfer)
+            # 净值只在MarketEvent中记录，跳过的数据条目不需要结算
+            self._skip_ahead([self.strategy], [])
+            self._end_iteration()
 
-        self.portfolio.create_equity_curve_dataframe()
+            if self.heartbeat:
+                time.sleep(self.heartbeat)
 
-        print("Creating summary stats...")
+        self.execution_handler.close()
+        self.data_handler.close()
+        self._finish_instrumentation()
+
+    def _result(self):
+        """
+        生成当前portfolio和execution_handler的回测结果对象
+        """
+
+        self.portfolio.create_equity_curve_dataframe()
         stats = self.portfolio.output_summary_stats()
+        return BacktestResult(self.portfolio.equity_curve, stats, self.execution_handler.execution_records,
+                              self.signals, self.orders, self.fills)
 
-        print("Creating equity curve...")
-        print(self.portfolio.equity_curve.tail(10))
-        pprint.pprint(stats)
+    def _output_performance(self, result=None):
 
-        print("Signals: %s" % self.signals)
-        print("Orders: %s" % self.orders)
-        print("Fills: %s" % self.fills)
-        self.portfolio.equity_curve.to_csv('equity.csv')
-        self.execution_handler.execution_records.to_csv('Execution_summary.csv')
+        if result is None:
+            result = self._result()
+        logger.info("Summary stats:\n%s", pprint.pformat(result.stats))
+        logger.info("Equity curve:\n%s", result.equity_curve.tail(10))
+        logger.info("Signals: %s, Orders: %s, Fills: %s", self.signals, self.orders, self.fills)
+        return result
 
-    def run_trading(self):
+    def run(self):
+        """
+        只运行回测并返回BacktestResult，不画图，也不写文件
+        """
 
         self._run_backtest()
-        self._output_performance()
-        my_plot = plot_performance(self.portfolio.equity_curve,
+        return self._result()
+
+    def plot(self, result):
+        """
+        画出result的净值曲线
+        """
+
+        my_plot = plot_performance(result.equity_curve,
                                    self.data_handler.symbol_data[self.symbol_list[0]],
-                                   self.execution_handler.execution_records)
+                                   result.execution_records)
         my_plot.plot_equity_curve()
         # my_plot.plot_stock_curve()
         # my_plot.show_all_plot()
+        return my_plot
+
+    def run_trading(self):
+
+        result = self.run()
+        self._output_performance(result)
+        result.to_csv()
+        self.plot(result)
+        return result
@@ -0,0 +1,203 @@
+# benchmark.py
+
+import argparse
+import datetime
+import json
+import os
+import os.path
+import platform
+import sys
+import time
+
+os.environ.setdefault('MPLBACKEND', 'Agg')  # 性能测试不弹出图形窗口
+
+import numpy as np
+import pandas as pd
+
+from data import HistoricCSVDataHandler, PanelDataHandler
+from execution import SimulatedExecutionHandler
+from factor_test import FactorTest
+from instrument import Instrumentation
+from performance import equity_by_date
+from test import MyPortfolio
+from Test_strategy import TestStrategy
+import matplotlib.pyplot as plt
+
+'''
+可复现的性能测试：先用generate_market生成指定股票数和天数的模拟行情CSV与因子XLSX
+（格式与HistoricCSVDataHandler读取的真实数据一致），再运行一次FactorTest，
+分别记录 读取数据、数据更新、信号、组合、执行、统计、画图 各阶段的耗时，结果输出为JSON，
+用来比较不同版本的速度。同时运行VectorizedFactorTest，检查与事件驱动引擎的结果是否一致。
+
+    python benchmark.py --symbols 800 --days 500 --stock-num 80 --output bench.json
+'''
+
+HANDLERS = {'panel': PanelDataHandler, 'csv': HistoricCSVDataHandler}
+
+# 阶段名 -> Instrumentation记录的处理函数名
+EVENT_PHASES = {
+    'bar_update': ['update_bars_monthly'],
+    'signal': ['calculate_signals'],
+    'portfolio': ['update_timeindex', 'update_timeindex_range', 'update_signal', 'update_fill'],
+    'execution': ['execute_order'],
+}
+
+
+def generate_market(data_dir, n_symbols, n_days, factors=('PE', 'PB'), start='2018-01-01', seed=0):
+    """
+    在data_dir下生成stock_price/<symbol>.csv（datetime, high, low, open, close）和
+    factors/<symbol>.xlsx（第一列为日期，其余为因子列），返回股票代码列表。
+    收盘价是几何随机游走；每20支股票中有一支晚上市（用来测试向前填充），因子有少量NaN。
+    参数与data_dir/market.json中记录的相同时直接使用已有数据。
+    """
+
+    params = {'n_symbols': n_symbols, 'n_days': n_days, 'factors': list(factors), 'start': start, 'seed': seed}
+    symbol_list = ['S%05d' % i for i in range(n_symbols)]
+    meta_path = os.path.join(data_dir, 'market.json')
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            if json.load(f) == params:
+                return symbol_list
+    except (OSError, ValueError):
+        pass
+
+    stock_dir = os.path.join(data_dir, 'stock_price')
+    factor_dir = os.path.join(data_dir, 'factors')
+    os.makedirs(stock_dir, exist_ok=True)
+    os.makedirs(factor_dir, exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range(start, periods=n_days)
+    close = 10.0 * np.exp(np.cumsum(rng.normal(0.0003, 0.02, (n_days, n_symbols)), axis=0))
+    spread = np.abs(rng.normal(0.0, 0.01, (n_days, n_symbols)))
+    opens = close * (1.0 + rng.normal(0.0, 0.005, (n_days, n_symbols)))
+    factor_values = rng.normal(size=(len(factors), n_days, n_symbols))
+    factor_values[rng.random(factor_values.shape) < 0.01] = np.nan
+
+    for j, s in enumerate(symbol_list):
+        first = int(rng.integers(1, n_days // 4 + 2)) if j % 20 == 19 else 0
+        df = pd.DataFrame({'datetime': dates.strftime('%Y-%m-%d'),
+                           'high': np.maximum(opens[:, j], close[:, j]) * (1.0 + spread[:, j]),
+                           'low': np.minimum(opens[:, j], close[:, j]) * (1.0 - spread[:, j]),
+                           'open': opens[:, j], 'close': close[:, j]}).iloc[first:]
+        df.to_csv(os.path.join(stock_dir, '%s.csv' % s), index=False, float_format='%.4f')
+
+        fdf = pd.DataFrame(dict((name, factor_values[k, :, j]) for k, name in enumerate(factors)),
+                           index=pd.Index(dates, name='date'))
+        fdf.to_excel(os.path.join(factor_dir, '%s.xlsx' % s))
+
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump(params, f)
+    return symbol_list
+
+
+def run_benchmark(data_dir, n_symbols=100, n_days=250, stock_num=10, layer=1, factor='PE',
+                  initial_capital=8000000.0, handler='panel', cache_dir=None, workers=1, plot=True,
+                  check_vectorized=True):
+    """
+    生成（或复用）模拟数据，运行一次FactorTest并返回各阶段耗时的字典
+    """
+
+    timer = Instrumentation()
+    with timer.phase('generate'):
+        symbol_list = generate_market(data_dir, n_symbols, n_days)
+    dates = pd.bdate_range('2018-01-01', periods=n_days)
+    start_date = dates[min(21, n_days - 1)].to_pydatetime()
+
+    with timer.phase('load'):
+        factortest = FactorTest(os.path.join(data_dir, 'stock_price'), os.path.join(data_dir, 'factors'),
+                                symbol_list, initial_capital, stock_num / layer, 0.0, start_date,
+                                factor, layer, data_handler_cls=HANDLERS[handler],
+                                execution_handler_cls=SimulatedExecutionHandler, portfolio_cls=MyPortfolio,
+                                strategy_cls=TestStrategy, cache_dir=cache_dir, workers=workers,
+                                instrumentation=timer)
+
+    with timer.phase('run'):
+        factortest._run_factortest()
+
+    with timer.phase('stats'):
+        results = []
+        for cur_layer in range(layer):
+            factortest._select_layer(cur_layer)
+            results.append(factortest._result())
+        factortest.layer_summary()
+
+    if plot:
+        with timer.phase('plotting'):
+            for result in results:
+                factortest.plot(result)
+            plt.close('all')
+
+    summary = timer.summary()
+    handler_names = [name for names in EVENT_PHASES.values() for name in names]
+    phases = dict((name, {'wall': row['wall'], 'cpu': row['cpu'], 'calls': int(row['calls'])})
+                  for name, row in summary.iterrows())
+    handlers = dict((name, phases.pop(name)) for name in handler_names if name in phases)
+    for phase, names in EVENT_PHASES.items():
+        rows = [handlers[name] for name in names if name in handlers]
+        phases[phase] = {'wall': sum(r['wall'] for r in rows), 'cpu': sum(r['cpu'] for r in rows),
+                         'calls': sum(r['calls'] for r in rows)}
+    # 事件分发等没有计入各处理函数的时间
+    phases['dispatch'] = {'wall': phases['run']['wall'] - sum(phases[p]['wall'] for p in EVENT_PHASES),
+                          'cpu': phases['run']['cpu'] - sum(phases[p]['cpu'] for p in EVENT_PHASES), 'calls': 1}
+    iterations = timer.iterations()
+
+    vectorized = None
+    if check_vectorized:
+        equivalent = True
+        start = time.perf_counter()
+        for cur_layer in range(layer):
+            curve = factortest.run_vectorized(cur_layer).equity_curve
+            event_curve = factortest.portfolios[cur_layer].equity_curve
+            equivalent &= bool(np.allclose(equity_by_date(curve), equity_by_date(event_curve),
+                                           rtol=1e-9, equal_nan=True))
+        vectorized = {'wall': time.perf_counter() - start, 'equivalent': equivalent}
+
+    return {
+        'config': {'symbols': n_symbols, 'days': n_days, 'stock_num': stock_num, 'layer': layer,
+                   'factor': factor, 'handler': handler, 'workers': workers, 'cache': cache_dir is not None,
+                   'plot': plot},
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                        'platform': platform.platform(), 'time': datetime.datetime.now().isoformat()},
+        'phases': phases,
+        'handlers': handlers,
+        'iterations': {'count': len(iterations), 'max_queue_depth': int(iterations['queue_depth'].max())},
+        'counts': {'signals': factortest.signals, 'orders': factortest.orders, 'fills': factortest.fills},
+        'vectorized': vectorized,
+    }
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='FactorTest性能测试')
+    parser.add_argument('--symbols', type=int, default=100, help='股票数量')
+    parser.add_argument('--days', type=int, default=250, help='交易日数量')
+    parser.add_argument('--stock-num', type=int, default=10, help='每次调仓买入的股票数量')
+    parser.add_argument('--layer', type=int, default=1, help='分层数')
+    parser.add_argument('--handler', choices=sorted(HANDLERS), default='panel', help='DataHandler类型')
+    parser.add_argument('--data-dir', default=None, help='模拟数据目录，默认为bench_data/<股票数>x<天数>')
+    parser.add_argument('--cache', action='store_true', help='使用.npy缓存读取数据')
+    parser.add_argument('--workers', type=int, default=1, help='读取数据的进程数')
+    parser.add_argument('--no-plot', action='store_true', help='不计时画图阶段')
+    parser.add_argument('--no-check', action='store_true', help='不运行向量化引擎的一致性检查')
+    parser.add_argument('--output', default=None, help='JSON结果文件，默认输出到标准输出')
+    args = parser.parse_args(argv)
+
+    data_dir = args.data_dir or os.path.join('bench_data', '%dx%d' % (args.symbols, args.days))
+    result = run_benchmark(data_dir, args.symbols, args.days, args.stock_num, args.layer,
+                           handler=args.handler,
+                           cache_dir=os.path.join(data_dir, 'cache') if args.cache else None,
+                           workers=args.workers, plot=not args.no_plot, check_vectorized=not args.no_check)
+
+    text = json.dumps(result, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    if result['vectorized'] is not None and not result['vectorized']['equivalent']:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
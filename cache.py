@@ -0,0 +1,92 @@
+# cache.py
+
+import hashlib
+import json
+import os
+import os.path
+
+import numpy as np
+
+
+class SourceCache(object):
+    """
+    SourceCache把解析后的行情CSV和因子XLSX保存成.npy二进制文件，下次直接内存映射读取。
+    每个源文件对应cache_dir下的一个目录，用源文件的mtime和size作为键，
+    源文件被修改后缓存自动失效并重新解析。
+    """
+
+    def __init__(self, cache_dir):
+
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _entry_dir(self, path):
+        """
+        缓存目录名由文件名和绝对路径的哈希组成，避免不同目录下的同名文件冲突
+        """
+
+        path = os.path.abspath(path)
+        digest = hashlib.md5(path.encode('utf-8')).hexdigest()[:12]
+        return os.path.join(self.cache_dir, '%s.%s' % (os.path.basename(path), digest))
+
+    @staticmethod
+    def _source_key(path):
+
+        st = os.stat(path)
+        return {'mtime_ns': st.st_mtime_ns, 'size': st.st_size}
+
+    def _read_entry(self, entry, key):
+
+        try:
+            with open(os.path.join(entry, 'meta.json'), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get('source') != key:
+            return None
+
+        items = []
+        for item in meta['items']:
+            if 'npy' in item:
+                items.append(np.load(os.path.join(entry, item['npy']), mmap_mode='r'))
+            else:
+                items.append(item['json'])
+        return tuple(items)
+
+    def _write_entry(self, entry, key, items):
+        """
+        每个文件都先写入同一目录下的临时文件，再用os.replace替换，其他进程已经打开或内存映射的旧文件不受影响；
+        meta.json最后写入，保证读到的meta总是对应完整的数组
+        """
+
+        os.makedirs(entry, exist_ok=True)
+        meta_items = []
+        for i, item in enumerate(items):
+            if isinstance(item, np.ndarray):
+                name = '%d.npy' % i
+                tmp = os.path.join(entry, '%s.%d.tmp' % (name, os.getpid()))
+                with open(tmp, 'wb') as f:
+                    np.save(f, item)
+                os.replace(tmp, os.path.join(entry, name))
+                meta_items.append({'npy': name})
+            else:
+                meta_items.append({'json': item})
+
+        tmp = os.path.join(entry, 'meta.json.%d.tmp' % os.getpid())
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'source': key, 'items': meta_items}, f)
+        os.replace(tmp, os.path.join(entry, 'meta.json'))
+
+    def load(self, path, reader):
+        """
+        返回reader(path)的结果。缓存有效时直接读取.npy，否则调用reader解析并写入缓存。
+        reader需要返回由ndarray和可JSON序列化的对象组成的元组。
+        """
+
+        key = self._source_key(path)
+        entry = self._entry_dir(path)
+        items = self._read_entry(entry, key)
+        if items is None:
+            items = tuple(reader(path))
+            self._write_entry(entry, key, items)
+        return items
@@ -1,15 +1,20 @@
 # data.py
 
-import datetime
-import os
-import os.path
-import math
+import logging
+import threading
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
 
 from event import MarketEvent
+from panel import PRICE_FIELDS, MarketPanel, load_panel, load_universe
+from preprocess import zscore
+from store import PanelStore
+from trading_calendar import TradingCalendar
+
+logger = logging.getLogger('backtest.data')
 
 
 class DataHandler(object):
@@ -57,6 +62,28 @@ class DataHandler(object):
 
         raise NotImplementedError("Should implement get_latest_bars_values()")
 
+    def get_latest_cross_section(self, val_type):
+        """
+        返回所有股票最近数据条目中某个字段的数组，顺序与symbol_list一致
+        """
+
+        return np.array([self.get_latest_bar_value(s, val_type) for s in self.symbol_list])
+
+    def declare_lookback(self, lookback):
+        """
+        策略在回测开始前声明需要的最近数据条目数（含当前条目）。
+        保留全部历史的数据对象不需要处理，流式读取的数据对象据此决定保留多少历史
+        """
+
+        pass
+
+    def close(self):
+        """
+        回测结束时调用，释放打开的文件、后台线程等资源
+        """
+
+        pass
+
     @abstractmethod
     def update_bars(self):
         """
@@ -67,13 +94,58 @@ class DataHandler(object):
         raise NotImplementedError("Should implement update_bars()")
 
 
-class HistoricCSVDataHandler(DataHandler):
+class RingBuffer(object):
     """
-    HistoricCSVDataHandler类用来读取请求的代码的CSV文件，这些CSV文件
-    存储在磁盘上，提供了一种类似于实际交易的场景的”最近数据“一种概念。
+    固定长度的环形缓冲区，按(股票 × 2size)保存每支股票某个字段最近size个值。
+    每个值同时写在pos和pos+size两个位置，所以任意一支股票最近n个值总是缓冲区中连续的一段，
+    latest返回的是缓冲区的视图，不复制数据，内存占用与回测长度无关
     """
 
-    def __init__(self, events, stock_csv_dir, factor_csv_dir, factor, start_date, symbol_list):
+    def __init__(self, n_symbols, size):
+
+        self.size = size
+        self.buffer = np.full((n_symbols, 2 * size), np.nan)
+        self.pos = 0  # 下一个值写入的位置
+        self.count = 0
+
+    def clear(self):
+
+        self.buffer[:] = np.nan
+        self.pos = 0
+        self.count = 0
+
+    def extend(self, rows):
+        """
+        依次写入rows中的每一行（所有股票同一天的值），只保留最后size行
+        """
+
+        rows = rows[-self.size:]
+        m = len(rows)
+        cols = (self.pos + np.arange(m)) % self.size
+        self.buffer[:, cols] = rows.T
+        self.buffer[:, cols + self.size] = rows.T
+        self.pos = (self.pos + m) % self.size
+        self.count = min(self.count + m, self.size)
+
+    def latest(self, j, N):
+        """
+        第j支股票最近N个值（不足N个时返回全部），时间从早到晚，是C连续的视图
+        """
+
+        n = min(N, self.count)
+        end = self.pos + self.size
+        return self.buffer[j, end - n:end]
+
+
+class PanelDataHandler(DataHandler):
+    """
+    PanelDataHandler把所有股票的数据读入一个对齐的(日期 × 股票 × 字段)面板中，
+    用一个游标bar_index表示当前最新的数据条目，get_latest_bar*系列函数直接返回
+    面板在游标处的数组切片，不再为每支股票维护DataFrame和数据列表。
+    """
+
+    def __init__(self, events, stock_csv_dir, factor_csv_dir, factor, start_date, symbol_list,
+                 cache_dir=None, workers=1):
 
         self.events = events
         self.stock_csv_dir = stock_csv_dir
@@ -82,221 +154,625 @@ class HistoricCSVDataHandler(DataHandler):
         self.start_month = start_date.month
         self.start_date = start_date.strftime("%Y-%m-%d")
         self.symbol_list = symbol_list
+        self.cache_dir = cache_dir
+        self.workers = workers
 
-        self.symbol_data = {}
-        self.symbol_factor = {}
         self.factor_na = 0
-        self.latest_symbol_data = {}
+        self.factor_na_counted = False  # 缺失值只在第一个控制点统计一次
         self.continue_backtest = True
-        self.bar_index = 0
-        self.data_generator = {}
-        self.next_month_bar = {}
-        self.latest_data_month = start_date.month
+        self.bar_index = -1
+        self.next_month_bar = False
+        self.control_index = None  # 策略声明的下一个控制点（调仓点以外）
+
+        self.lookback = {}  # 字段 -> 策略声明的回看长度，None表示整个数据条目
+        self.rings = {}  # 字段 -> RingBuffer
+        self.ring_index = -1  # 环形缓冲区已经写入到的bar_index
+        self.derived_fields = {}  # 字段名 -> 与面板日期、股票对齐的(日期 × 股票)矩阵，例如预处理后的因子
+        self.store = None  # 面板来自cache_dir下的PanelStore时为打开面板的PanelStore
 
         self._open_convert_csv_files()
+        self.calendar = TradingCalendar(self.panel.dates)
+        self.set_rebalance('M')
 
-    def _open_convert_csv_files(self, symbol_list=None):  # 多进程实验
+    def _open_convert_csv_files(self):
         """
-        从数据路径中打开CSV文件，将它们转化为pandas的DataFrame。
+        读取所有股票的数据并构建面板
         """
 
-        if symbol_list is None:
-            symbol_list = self.symbol_list
+        if self.cache_dir is None:
+            self.panel = load_panel(self.stock_csv_dir, self.factor_csv_dir, self.symbol_list, self.start_date,
+                                    workers=self.workers)
+        else:
+            self.panel = self._open_store(mmap=False).since(self.start_date)
+        self.symbol_data = self.panel.symbol_frames()
 
-        comb_index = None
-        for s in symbol_list:
-            self.symbol_data[s] = pd.read_csv(
-                os.path.join(self.stock_csv_dir, '%s.csv' % s),
-                header=0, index_col=0,
-                names=['datetime', 'high', 'low', 'open', 'close']
-                # names = ['datetime', 'high', 'low', 'open', 'close', 'volume', 'adj_close']
-            ).sort_index()
-
-            self.symbol_factor[s] = pd.read_excel(
-                os.path.join(self.factor_csv_dir, '%s.xlsx' % s),
-                header=0, index_col=0,
-            ).sort_index()
-            self.symbol_factor[s].index.name = 'datetime'
-            self.symbol_factor[s].index = self.symbol_factor[s].index.to_series().apply(lambda x: x.strftime('%Y-%m-%d'))
+    def _open_store(self, mmap):
+        """
+        更新并打开cache_dir下的PanelStore，返回完整的面板。打开面板的PanelStore保存在self.store中，
+        它记录了本次回测使用的数据文件，预处理结果等派生数组与这一代面板对应
+        """
 
-            if comb_index is None:
-                comb_index = self.symbol_data[s].index
-            else:
-                comb_index.union(self.symbol_data[s].index)
+        self.store = PanelStore.for_universe(self.cache_dir, self.stock_csv_dir, self.factor_csv_dir,
+                                             self.symbol_list)
+        return self.store.update(self.stock_csv_dir, self.factor_csv_dir, self.symbol_list, self.cache_dir,
+                                 self.workers, mmap=mmap)
 
-            self.latest_symbol_data[s] = []
-            self.next_month_bar[s] = []
+    def reset_latest_data(self):
 
-        for s in symbol_list:
-            self.symbol_data[s] = self.symbol_data[s].reindex(
-                index=comb_index, method='pad')
-            self.symbol_data[s] = self.symbol_data[s].fillna(0)
-            self.symbol_data[s] = pd.merge(self.symbol_data[s], self.symbol_factor[s], how='left', on='datetime')
-            self.symbol_data[s]["Pct_change"] = self.symbol_data[s]["close"].pct_change()
-            self.symbol_data[s] = self.symbol_data[s].loc[self.start_date:]
-            self.data_generator[s] = self.symbol_data[s].iterrows()
+        self.bar_index = -1
+        self.next_month_bar = False
+        self.control_index = None
+        self.factor_na = 0
+        self.factor_na_counted = False
+        self.ring_index = -1
+        for ring in self.rings.values():
+            ring.clear()
 
-    def reset_latest_data(self, symbol_list=None):
+    def declare_lookback(self, lookback):
+        """
+        lookback为整数时表示需要最近lookback个完整的数据条目；为字典{字段: 长度}时，
+        每个声明的字段（长度大于1）用一个RingBuffer保存最近的值，get_latest_bars_values直接返回缓冲区的视图
+        """
 
-        if symbol_list is None:
-            symbol_list = self.symbol_list
-        for s in symbol_list:
-            self.data_generator[s] = self.symbol_data[s].iterrows()
-            self.latest_symbol_data[s] = []
-            self.next_month_bar[s] = []
-        self.factor_na = 0
+        items = lookback.items() if isinstance(lookback, dict) else [(None, lookback)]
+        for field, n in items:
+            n = max(self.lookback.get(field, 1), int(n))
+            self.lookback[field] = n
+            if field is not None and n > 1:
+                if field not in self.rings or self.rings[field].size < n:
+                    self.rings[field] = RingBuffer(len(self.symbol_list), n)
+                    self.ring_index = -1
 
-    def _get_new_bar(self, symbol):
+    def max_lookback(self):
+
+        return max(self.lookback.values(), default=1)
+
+    def _field_rows(self, start, stop, field):
         """
-        从数据集返回最新的数据条目
+        返回第start到stop-1个数据条目中某个字段的(日期 × 股票)数组，用来写入环形缓冲区
         """
 
-        for b in self.data_generator[symbol]:
-            yield b
+        if field in self.derived_fields:
+            return self.derived_fields[field][start:stop]
+        return self.panel.values[start:stop, :, self.panel.field_index[field]]
 
-    def get_latest_bar(self, symbol):
+    def field_rows(self, name, start, stop):
         """
-        从最新的symbol_list中返回最新数据条目
+        第start到stop-1个数据条目中某个字段的(日期 × 股票)矩阵。回测循环中只需要一段数据时使用，
+        StreamingDataHandler不经过完整历史的内存映射，内存占用与这一段的长度有关
         """
 
-        try:
-            bars_list = self.latest_symbol_data[symbol]
-        except KeyError:
-            print("That symbol is not available in the historical data set.")
-            raise
-        else:
-            return bars_list[-1]
+        return self._field_rows(start, stop, name)
 
-    def get_latest_bars(self, symbol, N=1):
+    def row_blocks(self, start, stop):
         """
-        从最近的数据列表中获取N条数据，如果没有那么多，则返回N-k条数据
+        把第start到stop-1个数据条目切成若干段依次处理，配合field_rows使每次读取的数据量有上限。
+        面板已经在内存中，不需要切分
         """
 
-        try:
-            bars_list = self.latest_symbol_data[symbol]
-        except KeyError:
-            print("That symbol is not available in the historical data")
-            raise
-        else:
-            return bars_list[-N:]
+        return [(start, stop)] if stop > start else []
 
-    def get_latest_bar_datetime(self, symbol):
+    def _fill_rings(self):
         """
-        返回最近的数据条目对应的Python datetime
+        把上次写入之后的数据条目写入各个环形缓冲区。游标跳过的条目多于缓冲区长度时只写入最后size条
         """
 
-        try:
-            bars_list = self.latest_symbol_data[symbol]
-        except KeyError:
-            print("That symbol is not available in the historical data")
-            raise
+        if self.ring_index == self.bar_index:
+            return
+        if self.bar_index < self.ring_index:
+            for ring in self.rings.values():
+                ring.clear()
+            self.ring_index = -1
+        for field, ring in self.rings.items():
+            start = max(self.ring_index + 1, self.bar_index - ring.size + 1, 0)
+            ring.extend(self._field_rows(start, self.bar_index + 1, field))
+        self.ring_index = self.bar_index
+
+    def field(self, name):
+        """
+        返回某个字段的(日期 × 股票)矩阵，包括通过add_field加入的字段
+        """
+
+        if name in self.derived_fields:
+            return self.derived_fields[name]
+        return self.panel.field(name)
+
+    def add_field(self, name, values):
+        """
+        加入一个与面板日期、股票对齐的(日期 × 股票)矩阵，之后可以像面板中的字段一样通过get_latest_*读取
+        """
+
+        values = np.asarray(values)
+        if values.shape != (len(self.panel), len(self.panel.symbols)):
+            raise ValueError("Field %s has shape %s, expected %s" % (
+                name, values.shape, (len(self.panel), len(self.panel.symbols))))
+        self.derived_fields[name] = values
+
+    def _panel_store(self):
+        """
+        面板来自cache_dir下的PanelStore时返回打开面板的PanelStore，否则返回None
+        """
+
+        return self.store
+
+    def preprocess_factor(self, preprocessor, factor=None):
+        """
+        用FactorPreprocessor对因子（默认为self.factor）做截面预处理，结果作为新字段加入，返回字段名。
+        面板来自PanelStore时结果缓存在面板目录中，面板没有变化时直接读取
+        """
+
+        factor = factor if factor is not None else self.factor
+        name = preprocessor.field_name(factor)
+
+        def compute():
+            size = self.field(preprocessor.size) if preprocessor.size is not None else None
+            return preprocessor.transform(self.field(factor), self.panel.symbols, size)
+
+        store = self._panel_store()
+        if store is None:
+            values = compute()
         else:
-            return bars_list[-1][0]
+            key = {'factor': factor, 'start_date': self.start_date, 'preprocessor': preprocessor.config()}
+            values = store.derived(key, compute, mmap=True, shape=(len(self.panel), len(self.panel.symbols)))
+        self.add_field(name, values)
+        return name
 
-    def get_latest_bar_value(self, symbol, val_type):
+    def factor_block(self, factors=None):
+        """
+        返回(日期 × 股票 × 因子)的因子数组，factors默认为面板中的所有因子字段（顺序与panel.factor_fields()一致）。
+        因子在面板中是相邻的字段时返回面板的视图，不复制数据
         """
-        返回最近的数据pandas Series对象中的Open,High,Low,Close,Volume或OI的值
+
+        factors = self.panel.factor_fields() if factors is None else list(factors)
+        ks = [self.panel.field_index[f] for f in factors]
+        if ks and ks == list(range(ks[0], ks[0] + len(ks))):
+            return self.panel.values[:, :, ks[0]:ks[0] + len(ks)]
+        return self.panel.values[:, :, ks]
+
+    def combine_factors(self, weights, standardize=True):
         """
+        把多个因子按权重{因子: 权重}合成一个因子，作为新字段加入并返回字段名。
+        standardize为True时先对每个因子逐日做z-score，使量纲不同的因子可以相加；
+        任何一个因子缺失的股票合成值为NaN。字段名中的权重用repr保留全部精度，权重不同的合成因子不会共用一个字段
+        """
+
+        name = '+'.join('%s*%s' % (repr(float(w)), f) for f, w in weights.items()).replace('+-', '-')
+        if standardize:
+            name = 'z:' + name
+        if name not in self.derived_fields:
+            combined = np.zeros((len(self.panel), len(self.panel.symbols)))
+            for factor, weight in weights.items():
+                values = np.asarray(self.field(factor), dtype=float)
+                combined += weight * (zscore(values) if standardize else values)
+            self.add_field(name, combined)
+        return name
+
+    def _symbol_index(self, symbol):
 
         try:
-            bars_list = self.latest_symbol_data[symbol]
+            return self.panel.symbol_index[symbol]
         except KeyError:
-            print("That Symbol is not available in the historical data")
+            logger.error("Symbol %s is not available in the historical data set.", symbol)
             raise
-        else:
-            return getattr(bars_list[-1][1], val_type)
+
+    def get_latest_bar(self, symbol):
+        """
+        返回最新数据条目(datetime, 字段数组)，字段顺序见panel.fields
+        """
+
+        j = self._symbol_index(symbol)
+        return self.panel.dates[self.bar_index], self.panel.values[self.bar_index, j]
+
+    def get_latest_bars(self, symbol, N=1):
+        """
+        获取最近的N条数据，如果没有那么多，则返回N-k条数据
+        """
+
+        j = self._symbol_index(symbol)
+        start = max(self.bar_index - N + 1, 0)
+        return [(self.panel.dates[t], self.panel.values[t, j]) for t in range(start, self.bar_index + 1)]
+
+    def get_latest_bar_datetime(self, symbol):
+
+        self._symbol_index(symbol)
+        return self.panel.dates[self.bar_index]
+
+    def get_latest_bar_value(self, symbol, val_type):
+
+        j = self._symbol_index(symbol)
+        if val_type in self.derived_fields:
+            return self.derived_fields[val_type][self.bar_index, j]
+        return self.panel.values[self.bar_index, j, self.panel.field_index[val_type]]
 
     def get_latest_bars_values(self, symbol, val_type, N=1):
         """
-        返回latest_symbol_list中的最近N条数据，如果没有那么多，返回N-k条
+        返回最近N条数据中某个字段的数组（面板的视图），如果没有那么多，返回N-k条。
+        策略声明过该字段的回看长度且N不超过声明的长度时，返回环形缓冲区中连续的视图，
+        缓冲区在下一个数据条目写入后会被覆盖，需要保留时请复制
         """
 
-        try:
-            bars_list = self.get_latest_bars(symbol, N)
-        except KeyError:
-            print("That Symbol is not available in the historical data")
-            raise
-        else:
-            return np.array([getattr(b[1], val_type) for b in bars_list])
+        j = self._symbol_index(symbol)
+        ring = self.rings.get(val_type)
+        if ring is not None and N <= ring.size:
+            self._fill_rings()
+            return ring.latest(j, N)
+        start = max(self.bar_index - N + 1, 0)
+        if val_type in self.derived_fields:
+            return self.derived_fields[val_type][start:self.bar_index + 1, j]
+        return self.panel.values[start:self.bar_index + 1, j, self.panel.field_index[val_type]]
+
+    def get_latest_cross_section(self, val_type):
+        """
+        返回面板在游标处某个字段的截面（视图），顺序与symbol_list一致
+        """
+
+        if val_type in self.derived_fields:
+            return self.derived_fields[val_type][self.bar_index]
+        return self.panel.values[self.bar_index, :, self.panel.field_index[val_type]]
 
     def update_bars(self):
         """
-        将最近的数据条目放入到latest_symbol_data结构中。
+        游标前进一天
         """
 
-        for s in self.symbol_list:
-            try:
-                bar = next(self._get_new_bar(s))
-            except StopIteration:
-                self.continue_backtest = False
-            else:
-                if bar is not None:
-                    self.latest_symbol_data[s].append(bar)
+        if self.bar_index + 1 < len(self.panel):
+            self.bar_index += 1
+        else:
+            self.continue_backtest = False
         self.events.put(MarketEvent())
 
+    def set_rebalance(self, freq='M'):
+        """
+        设置调仓日历：'W'/'M'/'Q'/'Y'、每N个交易日或者日期列表，见TradingCalendar.rebalance_offsets
+        """
+
+        self.rebalance = freq
+        self.rebalance_offsets = self.calendar.rebalance_offsets(freq)
+        self.rebalance_mask = self.calendar.rebalance_mask(freq)
+
+    def next_rebalance(self, start=None):
+        """
+        第start个数据条目（默认为游标处）或之后的下一个调仓点的下标，没有时返回最后一个数据条目的下标
+        """
+
+        start = max(self.bar_index, 0) if start is None else start
+        k = np.searchsorted(self.rebalance_offsets, start)
+        return int(self.rebalance_offsets[k]) if k < len(self.rebalance_offsets) else len(self.panel) - 1
+
+    def first_crossing(self, field, start, stop, lower=None, upper=None, mask=None):
+        """
+        返回[start, stop)中第一个某字段小于等于lower或者大于等于upper的数据条目下标，没有时返回stop。
+        lower、upper可以是标量或者每支股票一个值的数组（例如止损价、止盈价），mask是需要检查的股票的布尔掩码
+        """
+
+        for lo, hi in self.row_blocks(start, stop):
+            block = np.asarray(self.field_rows(field, lo, hi))
+            hit = np.zeros(block.shape, dtype=bool)
+            if lower is not None:
+                hit |= block <= lower
+            if upper is not None:
+                hit |= block >= upper
+            if mask is not None:
+                hit &= mask
+            rows = np.flatnonzero(hit.any(axis=1))
+            if len(rows):
+                return lo + int(rows[0])
+        return stop
+
+    def is_control(self, t):
+        """
+        第t个数据条目是否需要发出MarketEvent：调仓点，或者策略通过next_control声明的控制点
+        """
+
+        return bool(self.rebalance_mask[t]) or t == self.control_index
+
+    def skip_to(self, t, control):
+        """
+        把游标直接移到第t个数据条目，并记录下一个控制点control，由调度器在两个控制点之间跳过逐日推进时调用
+        """
+
+        self.bar_index = t
+        self.control_index = control
+
     def update_bars_monthly(self):
+        """
+        游标前进一天。游标在调仓点（默认为每月最后一个数据条目，见set_rebalance）或者策略声明的控制点时先不前进，
+        而是发出MarketEvent，让策略在这个数据条目上调仓，下一次调用时再进入新的周期。
+        调仓点由交易日历预先算出，这里只查布尔数组。
+        """
+
+        if self.next_month_bar:
+            self.bar_index += 1
+            self.next_month_bar = False
+            return
+
+        if self.bar_index + 1 >= len(self.panel):
+            self.continue_backtest = False
+            return
+
+        if self.bar_index >= 0 and self.is_control(self.bar_index):
+            self.next_month_bar = True
+            if self.factor is not None and not self.factor_na_counted:
+                # 在第一个控制点统计回测第一天因子缺失的股票数（按月调仓时即开始月份的月底），之后的控制点不再重复统计
+                self.factor_na_counted = True
+                self.factor_na += int(np.isnan(self.field_rows(self.factor, 0, 1)[0]).sum())
+            self.events.put(MarketEvent())
+        else:
+            self.bar_index += 1
+
+
+class MemmapDataHandler(PanelDataHandler):
+    """
+    MemmapDataHandler以只读内存映射的方式打开cache_dir下的面板文件（PanelStore的values.bin），
+    数据不读入进程内存。面板只在第一次使用或者源文件追加新行后更新，同一台机器上同时运行的多个回测
+    通过操作系统的页缓存共享同一份物理内存，每个进程的行情数据常驻内存接近于0。
+    必须指定cache_dir。
+    """
+
+    def _open_convert_csv_files(self):
+
+        if self.cache_dir is None:
+            raise ValueError("MemmapDataHandler requires cache_dir")
+        self.panel = self._open_store(mmap=True).since(self.start_date)
+        self.symbol_data = self.panel.symbol_frames()
+
+
+class StreamingDataHandler(PanelDataHandler):
+    """
+    StreamingDataHandler用于股票池和回测区间大到内存放不下整个面板的情况。面板保存在cache_dir下的
+    PanelStore中，回测时按日期分块从面板的数据文件中按偏移量读取（默认每块一个月，与update_bars_monthly一致；
+    chunk为整数时每块chunk个数据条目），进程内只保留当前块和策略声明的回看窗口（Strategy.lookback），
+    下一块由后台线程预先读取。内存占用只与股票数、每块的长度和回看窗口有关，与回测长度无关。
+    self.panel（以及field()返回的矩阵）是面板文件的只读内存映射，只用于预处理、画图、导出等需要完整历史的场合，
+    回测循环中跳过的数据条目通过field_rows按块读取。必须指定cache_dir。
+    """
+
+    def __init__(self, events, stock_csv_dir, factor_csv_dir, factor, start_date, symbol_list,
+                 cache_dir=None, workers=1, chunk=None, prefetch=True):
+
+        self.chunk = chunk
+        self.prefetch = prefetch
+        self._executor = None
+        self._pending = None
+        self.values_file = None
+        super().__init__(events, stock_csv_dir, factor_csv_dir, factor, start_date, symbol_list,
+                         cache_dir, workers)
+
+    def _open_convert_csv_files(self):
+
+        if self.cache_dir is None:
+            raise ValueError("StreamingDataHandler requires cache_dir")
+        # 一直读取打开时的数据文件，回测过程中其他进程更新面板不影响本次回测。
+        # PanelStore更新之后、打开数据文件之前，其他进程发布了新的一代并删除了这个文件时重新更新
+        while self.values_file is None:
+            full = self._open_store(mmap=True)
+            try:
+                self.values_file = open(self.store.values_path, 'rb')
+            except FileNotFoundError:
+                pass
+        self.panel = full.since(self.start_date)
+        self.symbol_data = self.panel.symbol_frames()
+        self._read_lock = threading.Lock()
+        self.offset = len(full) - len(self.panel)  # 回测第一天在数据文件中的行号
+        self.row_shape = full.values.shape[1:]
+
+        if self.chunk is None:
+            months = self.panel.dates.astype('U7')
+            starts = np.r_[0, np.flatnonzero(months[1:] != months[:-1]) + 1]
+        else:
+            starts = np.arange(0, len(self.panel), self.chunk)
+        self.bounds = np.r_[starts, len(self.panel)] if len(self.panel) else np.zeros(1, dtype=int)
+        self._reset_window()
+
+    def _reset_window(self):
+
+        if self._pending is not None:
+            self._pending.result()
+            self._pending = None
+        self.window = np.empty((0,) + self.row_shape)
+        self.window_start = 0  # window第一行对应的bar_index
+        self.next_chunk = 0
+        self._scan = None  # 最近一次在回看窗口以外读取的一段数据：(start, stop, values)
+
+    def reset_latest_data(self):
+
+        super().reset_latest_data()
+        self._reset_window()
+        if self.values_file is None:
+            # close之后再次回测，重新打开同一个数据文件
+            self.values_file = open(self.store.values_path, 'rb')
+
+    def close(self):
+        """
+        等待后台线程中的读取完成，关闭读取线程和数据文件。之后再次回测时由reset_latest_data重新打开数据文件
+        """
+
+        if self._pending is not None:
+            self._pending.result()
+            self._pending = None
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self.values_file is not None:
+            self.values_file.close()
+            self.values_file = None
+
+    def _read_chunk(self, k):
+        """
+        从数据文件中读取第k块
+        """
+
+        return self._read_range(int(self.bounds[k]), int(self.bounds[k + 1]))
+
+    def _read_range(self, start, stop):
+        """
+        从数据文件中读取第start到stop-1个数据条目。日期是第一维，这一段在文件中是连续的字节
+        """
+
+        row = int(np.prod(self.row_shape))
+        with self._read_lock:
+            self.values_file.seek((self.offset + start) * row * 8)
+            values = np.fromfile(self.values_file, dtype=np.float64, count=(stop - start) * row)
+        return values.reshape((stop - start,) + self.row_shape)
 
-        prev_month = self.latest_data_month
-        flag = 0
-        for s in self.symbol_list:
+    def _load_next_chunk(self):
+        """
+        把下一块接到回看窗口后面，并在后台线程中开始读取再下一块
+        """
+
+        k = self.next_chunk
+        if self._pending is not None:
+            block = self._pending.result()
+            self._pending = None
+        else:
+            block = self._read_chunk(k)
+        self.next_chunk += 1
+        if self.prefetch and self.next_chunk < len(self.bounds) - 1:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+            self._pending = self._executor.submit(self._read_chunk, self.next_chunk)
+        elif self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+        keep = min(self.max_lookback() - 1, len(self.window))
+        self.window = np.concatenate([self.window[len(self.window) - keep:], block])
+        self.window_start = int(self.bounds[k]) - keep
+
+    def _row(self):
+        """
+        游标在window中的行号，游标进入下一块时读入下一块
+        """
+
+        while self.bar_index - self.window_start >= len(self.window) and self.next_chunk < len(self.bounds) - 1:
+            self._load_next_chunk()
+        return self.bar_index - self.window_start
+
+    def _field_rows(self, start, stop, field):
+        """
+        在回看窗口中的数据条目直接取窗口的视图，否则（例如跳过的数据条目）从数据文件中读取这一段
+        """
+
+        if field in self.derived_fields:
+            return self.derived_fields[field][start:stop]
+        self._row()
+        k = self.panel.field_index[field]
+        if start >= self.window_start and stop - self.window_start <= len(self.window):
+            return self.window[start - self.window_start:stop - self.window_start, :, k]
+        return self._read_rows(start, stop)[:, :, k]
+
+    def _read_rows(self, start, stop):
+        """
+        读取回看窗口以外的一段数据，只缓存最近读取的一段，多层组合结算同一段时只读一次
+        """
+
+        if self._scan is None or not self._scan[0] <= start <= stop <= self._scan[1]:
+            self._scan = (start, stop, self._read_range(start, stop))
+        lo = self._scan[0]
+        return self._scan[2][start - lo:stop - lo]
+
+    def row_blocks(self, start, stop):
+        """
+        按数据块的边界切分，每段不超过一块
+        """
+
+        edges = np.r_[start, self.bounds[(self.bounds > start) & (self.bounds < stop)], stop]
+        return [(int(lo), int(hi)) for lo, hi in zip(edges[:-1], edges[1:]) if hi > lo]
+
+    def get_latest_bar(self, symbol):
+
+        j = self._symbol_index(symbol)
+        i = self._row()
+        return self.panel.dates[self.bar_index], self.window[i, j]
+
+    def get_latest_bars(self, symbol, N=1):
+        """
+        获取最近的N条数据，最多返回回看窗口中保留的数据条目
+        """
+
+        j = self._symbol_index(symbol)
+        i = self._row()
+        start = max(i - N + 1, 0)
+        return [(self.panel.dates[self.window_start + t], self.window[t, j]) for t in range(start, i + 1)]
+
+    def get_latest_bar_value(self, symbol, val_type):
+
+        j = self._symbol_index(symbol)
+        if val_type in self.derived_fields:
+            return self.derived_fields[val_type][self.bar_index, j]
+        i = self._row()
+        return self.window[i, j, self.panel.field_index[val_type]]
+
+    def get_latest_bars_values(self, symbol, val_type, N=1):
+        """
+        返回最近N条数据中某个字段的数组（回看窗口或者环形缓冲区的视图），最多返回回看窗口中保留的数据条目
+        """
+
+        j = self._symbol_index(symbol)
+        ring = self.rings.get(val_type)
+        if ring is not None and N <= ring.size:
+            self._fill_rings()
+            return ring.latest(j, N)
+        if val_type in self.derived_fields:
+            return self.derived_fields[val_type][max(self.bar_index - N + 1, 0):self.bar_index + 1, j]
+        i = self._row()
+        return self.window[max(i - N + 1, 0):i + 1, j, self.panel.field_index[val_type]]
+
+    def get_latest_cross_section(self, val_type):
+
+        if val_type in self.derived_fields:
+            return self.derived_fields[val_type][self.bar_index]
+        i = self._row()
+        return self.window[i, :, self.panel.field_index[val_type]]
+
+
+class HistoricCSVDataHandler(PanelDataHandler):
+    """
+    HistoricCSVDataHandler类用来读取请求的代码的CSV文件，这些CSV文件
+    存储在磁盘上，提供了一种类似于实际交易的场景的”最近数据“一种概念。
+    数据按原来的方式逐个股票用pandas对齐，然后转成数组，用游标按天推进，
+    不再为每个数据条目生成pandas Series。
+    """
+
+    def _open_convert_csv_files(self, symbol_list=None):
+        """
+        从数据路径中打开CSV文件，将它们转化为pandas的DataFrame，对齐后合并成数据面板。
+        文件解析由load_universe完成，workers大于1时多进程并行。
+        """
+
+        if symbol_list is None:
+            symbol_list = self.symbol_list
 
-            if self.next_month_bar[s]:
-                self.latest_symbol_data[s].append(self.next_month_bar[s])
-                self.next_month_bar[s] = []
+        price_data, factor_data = load_universe(self.stock_csv_dir, self.factor_csv_dir, symbol_list,
+                                                self.cache_dir, self.workers)
+        symbol_data = {}
+        symbol_factor = {}
+        comb_index = None
+        for s in symbol_list:
+            (p_dates, p_values), (f_dates, f_columns, f_values) = price_data[s], factor_data[s]
+            symbol_data[s] = pd.DataFrame(
+                p_values, index=pd.Index(p_dates, name='datetime'), columns=PRICE_FIELDS)
+            symbol_factor[s] = pd.DataFrame(
+                f_values, index=pd.Index(f_dates, name='datetime'), columns=f_columns)
+
+            if comb_index is None:
+                comb_index = symbol_data[s].index
             else:
-                try:
-                    bar = next(self._get_new_bar(s))
-                except StopIteration:
-                    self.continue_backtest = False
-                else:
-                    if bar is not None:
-                        cur_month = datetime.datetime.strptime(bar[0], "%Y-%m-%d").month
-                        if cur_month != self.latest_data_month:
-                            self.next_month_bar[s] = bar
-                            flag = 1
-                            if math.isnan(self.latest_symbol_data[s][0][1].loc[self.factor]) \
-                                    and self.latest_data_month == self.start_month:
-                                self.factor_na += 1
-
-                        elif cur_month == self.latest_data_month:
-                            self.latest_symbol_data[s].append(bar)
-                        prev_month = cur_month
-
-        self.latest_data_month = prev_month
-        if flag == 1:
-            self.events.put(MarketEvent())
+                comb_index.union(symbol_data[s].index)
 
-    '''def update_bars_monthly(self):
-
-        prev_month = self.latest_data_month
-        while True:
-            flag = 0
-            for s in self.symbol_list:
-
-                if self.next_month_bar[s]:
-                    self.latest_symbol_data[s].append(self.next_month_bar[s])
-                    self.next_month_bar[s] = []
-                else:
-                    try:
-                        bar = next(self._get_new_bar(s))
-                    except StopIteration:
-                        self.continue_backtest = False
-                        flag = 1
-                    else:
-                        if bar is not None:
-                            cur_month = datetime.datetime.strptime(bar[0], "%Y-%m-%d").month
-                            if cur_month != self.latest_data_month:
-                                self.next_month_bar[s] = bar
-                                flag = 1
-                                if math.isnan(self.latest_symbol_data[s][0][1].loc[self.factor]) \
-                                        and self.latest_data_month == self.start_month:
-                                    self.factor_na += 1
-
-                            elif cur_month == self.latest_data_month:
-                                self.latest_symbol_data[s].append(bar)
-                            prev_month = cur_month
-
-            self.latest_data_month = prev_month
-            if flag == 1:
-                break
-        self.events.put(MarketEvent())'''
+        fields = []
+        for s in symbol_list:
+            symbol_data[s] = symbol_data[s].reindex(
+                index=comb_index, method='pad')
+            symbol_data[s] = symbol_data[s].fillna(0)
+            symbol_data[s] = pd.merge(symbol_data[s], symbol_factor[s], how='left', on='datetime')
+            symbol_data[s]["Pct_change"] = symbol_data[s]["close"].pct_change()
+            symbol_data[s] = symbol_data[s].loc[self.start_date:]
+            for c in symbol_data[s].columns:
+                if c not in fields:
+                    fields.append(c)
+
+        values = np.stack([symbol_data[s].reindex(columns=fields).to_numpy(dtype=float) for s in symbol_list], axis=1)
+        dates = symbol_data[symbol_list[0]].index.to_numpy()
+        self.panel = MarketPanel(dates, symbol_list, fields, values)
+        self.symbol_data = self.panel.symbol_frames()
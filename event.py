@@ -1,25 +1,36 @@
 # event.py
 
+import queue
+from collections import deque
+
+import numpy as np
+
 
 class Event(object):
+    """
+    事件基类。事件类都用__slots__定义属性，不创建__dict__，type是类属性，
+    回测中每次调仓产生的大量信号、订单和成交事件创建得更快、占用内存更少
+    """
 
-    pass
+    __slots__ = ()
+    type = None
 
 
 class MarketEvent(Event):
 
-    def __init__(self):
-
-        self.type = "MARKET"
+    __slots__ = ()
+    type = "MARKET"
 
 
 class SignalEvent(Event):
 
+    __slots__ = ('strategy_id', 'date_time', 'symbol', 'datetime', 'signal_type', 'strength', 'order_price')
+    type = "SIGNAL"
+
     def __init__(self, strategy_id, date_time, symbol, datetime, signal_type, order_price, strength):
 
         self.strategy_id = strategy_id
         self.date_time = date_time
-        self.type = "SIGNAL"
         self.symbol = symbol
         self.datetime = datetime
         self.signal_type = signal_type
@@ -29,10 +40,12 @@ class SignalEvent(Event):
 
 class OrderEvent(Event):
 
+    __slots__ = ('date_time', 'symbol', 'order_type', 'quantity', 'buy_or_sell', 'direction', 'order_price')
+    type = "ORDER"
+
     def __init__(self, date_time, symbol, order_type, quantity, buy_or_sell, order_price, direction):
 
         self.date_time = date_time
-        self.type = "ORDER"
         self.symbol = symbol
         self.order_type = order_type
         self.quantity = quantity
@@ -48,10 +61,12 @@ class OrderEvent(Event):
 
 class FillEvent(Event):
 
+    __slots__ = ('date_time', 'symbol', 'quantity', 'buy_or_sell', 'fill_cost', 'commission')
+    type = "FILL"
+
     def __init__(self, date_time, symbol, quantity, buy_or_sell,
                  fill_cost, commission=None):
 
-        self.type = "FILL"
         self.date_time = date_time
         self.symbol = symbol
         # self.exchange = exchange
@@ -75,3 +90,151 @@ class FillEvent(Event):
         return full_cost
 
 
+class BasketSignalEvent(Event):
+    """
+    整个组合的目标权重信号。weights、order_price是按symbols顺序排列的向量，
+    权重为0表示清仓，一次调仓只需要一个事件
+    """
+
+    __slots__ = ('strategy_id', 'date_time', 'symbols', 'datetime', 'weights', 'order_price')
+    type = "BASKET_SIGNAL"
+
+    def __init__(self, strategy_id, date_time, symbols, datetime, weights, order_price):
+
+        self.strategy_id = strategy_id
+        self.date_time = date_time
+        self.symbols = symbols
+        self.datetime = datetime
+        self.weights = weights
+        self.order_price = order_price
+
+
+class BasketOrderEvent(Event):
+    """
+    一篮子订单。quantity是带方向的数量向量（正数买入，负数卖出），direction由目标持仓与当前持仓之差决定：
+    开仓或加仓为'LONG'/'SHORT'，减仓为'SELL'（多头）/'BUY'（空头），清仓为'EXIT'
+    """
+
+    __slots__ = ('date_time', 'symbols', 'order_type', 'quantity', 'order_price', 'direction')
+    type = "BASKET_ORDER"
+
+    def __init__(self, date_time, symbols, order_type, quantity, order_price, direction):
+
+        self.date_time = date_time
+        self.symbols = symbols
+        self.order_type = order_type
+        self.quantity = quantity
+        self.order_price = order_price
+        self.direction = direction
+
+    def print_order(self):
+
+        for j in np.flatnonzero(self.quantity):
+            print("Order: Symbol:%s, Type=%s, Quantity=%s, Direction=%s, Order_price=%s" %
+                  (self.symbols[j], self.order_type, self.quantity[j], self.direction[j], self.order_price[j]))
+
+
+class BasketFillEvent(Event):
+    """
+    一篮子成交。quantity是带方向的成交数量向量，fill_cost是成交价格向量，commission是手续费率
+    """
+
+    __slots__ = ('date_time', 'symbols', 'quantity', 'fill_cost', 'commission')
+    type = "BASKET_FILL"
+
+    def __init__(self, date_time, symbols, quantity, fill_cost, commission):
+
+        self.date_time = date_time
+        self.symbols = symbols
+        self.quantity = quantity
+        self.fill_cost = fill_cost
+        self.commission = commission
+
+
+class EventBus(object):
+    """
+    单线程回测用的事件总线：事件存放在deque中，不加锁，也不用queue.Empty异常控制流程。
+    按事件的type分发给subscribe注册的处理函数，代替 if event.type == ... 的判断链。
+    保留put和empty接口，数据、策略、组合和执行对象仍然调用events.put(...)放入事件，
+    放入None（例如没有生成订单）会被忽略。
+    """
+
+    def __init__(self):
+
+        self._events = deque()
+        self._handlers = {}
+
+    def subscribe(self, event_type, handler):
+        """
+        注册event_type类型事件的处理函数，同一类型可以注册多个，按注册顺序调用
+        """
+
+        self._handlers.setdefault(event_type, []).append(handler)
+
+    def put(self, event):
+
+        if event is not None:
+            self._events.append(event)
+
+    def empty(self):
+
+        return not self._events
+
+    def __len__(self):
+
+        return len(self._events)
+
+    def _pop(self):
+        """
+        取出下一个事件，队列为空时返回None
+        """
+
+        return self._events.popleft() if self._events else None
+
+    def dispatch(self, idle=None):
+        """
+        依次处理队列中的所有事件（处理过程中新放入的事件也会被处理）。
+        队列清空后调用idle()，返回True表示放入了新事件，需要继续处理
+        """
+
+        handlers = self._handlers
+        while True:
+            event = self._pop()
+            while event is not None:
+                for handler in handlers.get(event.type, ()):
+                    handler(event)
+                event = self._pop()
+            if idle is None or not idle():
+                break
+
+
+class ThreadedEventBus(EventBus):
+    """
+    基于线程安全queue.Queue的事件总线，供实盘行情等需要从其他线程放入事件的场景使用。
+    单线程回测请使用EventBus
+    """
+
+    def __init__(self):
+
+        super().__init__()
+        self._events = queue.Queue()
+
+    def put(self, event):
+
+        if event is not None:
+            self._events.put(event)
+
+    def empty(self):
+
+        return self._events.empty()
+
+    def __len__(self):
+
+        return self._events.qsize()
+
+    def _pop(self):
+
+        try:
+            return self._events.get(False)
+        except queue.Empty:
+            return None
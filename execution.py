@@ -1,12 +1,14 @@
 # execution.py
 
 import datetime
+import itertools
+import numpy as np
 import pandas as pd
 import queue
 
 from abc import ABCMeta, abstractmethod
 
-from event import FillEvent
+from event import BasketFillEvent, FillEvent
 
 
 class ExecutionHandler(object, metaclass=ABCMeta):
@@ -24,24 +26,154 @@ class ExecutionHandler(object, metaclass=ABCMeta):
 
         raise NotImplementedError("Should implement execute_order()")
 
+    def close(self):
+        """
+        回测结束时调用，用于写出缓存的成交记录等收尾工作
+        """
+
+        pass
+
+
+class TradeLog(object):
+    """
+    只追加的成交记录日志。每条记录以元组的形式保存在列表中，需要时才生成DataFrame。
+    指定path时，每累计flush_size条新记录就增量写入文件，
+    path以.parquet结尾时写Parquet（需要pyarrow），否则写CSV。
+    """
+
+    def __init__(self, columns, path=None, flush_size=10000):
+
+        self.columns = columns
+        self.path = path
+        self.flush_size = flush_size
+        self.records = []
+        self._flushed = 0
+        self._frame = None
+        self._parquet_writer = None
+
+    def __len__(self):
+
+        return len(self.records)
+
+    def append(self, record):
+
+        self.records.append(record)
+        if self.path is not None and len(self.records) - self._flushed >= self.flush_size:
+            self.flush()
+
+    def extend(self, records):
+
+        self.records.extend(records)
+        if self.path is not None and len(self.records) - self._flushed >= self.flush_size:
+            self.flush()
+
+    def to_frame(self):
+        """
+        返回所有记录的DataFrame，记录没有增加时直接使用上一次生成的结果
+        """
+
+        if self._frame is None or len(self._frame) != len(self.records):
+            self._frame = pd.DataFrame(self.records, columns=self.columns)
+        return self._frame
+
+    def flush(self):
+        """
+        把上次写入之后的新记录追加到文件中
+        """
+
+        if self.path is None or self._flushed == len(self.records):
+            return
+        chunk = pd.DataFrame(self.records[self._flushed:], columns=self.columns)
+        if self.path.endswith('.parquet'):
+            self._write_parquet(chunk)
+        else:
+            chunk.to_csv(self.path, mode='w' if self._flushed == 0 else 'a',
+                         header=self._flushed == 0, index=False)
+        self._flushed = len(self.records)
+
+    def _write_parquet(self, chunk):
+
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Writing the trade log to Parquet requires pyarrow")
+
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        if self._parquet_writer is None:
+            self._parquet_writer = pq.ParquetWriter(self.path, table.schema)
+        self._parquet_writer.write_table(table)
+
+    def close(self):
+
+        self.flush()
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+
 
 class SimulatedExecutionHandler(ExecutionHandler):
     """
     这是一个模拟的执行处理，简单的将所有的订单对象转化为等价的成交对象，不考虑
     时延，滑价以及成交比率的影响。
+    成交记录保存在TradeLog中，指定trade_log_path时会在回测过程中增量写入文件。
     """
 
-    def __init__(self, events):
+    def __init__(self, events, trade_log_path=None):
 
         self.events = events
-        self.execution_records = pd.DataFrame(columns=['date_time', 'symbol', 'direction', 'quantity', 'order_price',
-                                                       'return_profit', 'return_profit_pct'])
+        self.trade_log = TradeLog(['date_time', 'symbol', 'direction', 'quantity', 'order_price',
+                                   'return_profit', 'return_profit_pct'], trade_log_path)
         self.recent_deal_average_cost = {}
         self.entry_time = {}
 
+    @property
+    def execution_records(self):
+
+        return self.trade_log.to_frame()
+
+    def close(self):
+
+        self.trade_log.close()
+
+    def execute_basket_order(self, event):
+        """
+        把一篮子订单整体转化为一个BasketFillEvent，成交记录和平均成本按向量计算。
+        开仓或加仓更新平均成本；减仓和清仓按平均成本记录盈亏，减仓后平均成本不变，清仓后清零
+        """
+
+        self.events.put(BasketFillEvent(event.date_time, event.symbols, event.quantity,
+                                        event.order_price, commission=0.00025))
+
+        traded = np.flatnonzero(event.quantity)
+        symbols = [event.symbols[j] for j in traded]
+        quantity = np.abs(event.quantity[traded])
+        price = event.order_price[traded]
+        direction = event.direction[traded]
+        exit_ = direction == 'EXIT'
+        close = exit_ | (direction == 'SELL') | (direction == 'BUY')
+
+        average_cost = np.array([self.recent_deal_average_cost.get(s, 0.0) for s in symbols], dtype=float)
+        entry_time = np.array([self.entry_time.get(s, 0) for s in symbols], dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return_profit = np.where(close, (price - average_cost) * quantity, np.nan)
+            return_profit_pct = np.where(close, (price - average_cost) / average_cost, np.nan)
+            entered = entry_time + 1
+            average_cost = np.where(exit_, 0.0, np.where(close, average_cost,
+                                                         average_cost * entry_time / entered + price / entered))
+            entry_time = np.where(exit_, 0, np.where(close, entry_time, entered))
+
+        self.trade_log.extend(zip(itertools.repeat(event.date_time), symbols, direction.tolist(), quantity.tolist(),
+                                  price.tolist(), np.where(close, return_profit, None).tolist(),
+                                  np.where(close, return_profit_pct, None).tolist()))
+        self.recent_deal_average_cost.update(zip(symbols, average_cost))
+        self.entry_time.update(zip(symbols, entry_time.astype(int)))
+
     def execute_order(self, event):
 
-        if event.type == 'ORDER':
+        if event.type == 'BASKET_ORDER':
+            self.execute_basket_order(event)
+        elif event.type == 'ORDER':
             fill_event = FillEvent(event.date_time,
                                    event.symbol,
                                    event.quantity, event.buy_or_sell, fill_cost=None, commission=0.00025)
@@ -51,13 +183,8 @@ class SimulatedExecutionHandler(ExecutionHandler):
                     self.recent_deal_average_cost[event.symbol] = 0
                     self.entry_time[event.symbol] = 0
                 self.entry_time[event.symbol] += 1
-                self.execution_records = self.execution_records.append(
-                    pd.DataFrame(
-                        {'date_time': [event.date_time], 'symbol': [event.symbol], 'direction': [event.direction],
-                         'quantity': [event.quantity], 'order_price': [event.order_price],
-                         'return_profit': None, 'return_profit_pct': [None]}
-                    )
-                )
+                self.trade_log.append((event.date_time, event.symbol, event.direction, event.quantity,
+                                       event.order_price, None, None))
                 self.recent_deal_average_cost[event.symbol] = \
                     self.recent_deal_average_cost[event.symbol] * (self.entry_time[event.symbol] - 1) / \
                     self.entry_time[event.symbol] + event.order_price / self.entry_time[event.symbol]
@@ -66,13 +193,7 @@ class SimulatedExecutionHandler(ExecutionHandler):
                 return_profit = (event.order_price - self.recent_deal_average_cost[event.symbol]) * event.quantity
                 return_profit_pct = (event.order_price - self.recent_deal_average_cost[event.symbol]) / \
                                     self.recent_deal_average_cost[event.symbol]
-                self.execution_records = self.execution_records.append(
-                    pd.DataFrame(
-                        {'date_time': [event.date_time], 'symbol': [event.symbol], 'direction': [event.direction],
-                         'quantity': [event.quantity], 'order_price': [event.order_price],
-                         'return_profit': return_profit,
-                         'return_profit_pct': return_profit_pct}
-                    )
-                )
+                self.trade_log.append((event.date_time, event.symbol, event.direction, event.quantity,
+                                       event.order_price, return_profit, return_profit_pct))
                 self.recent_deal_average_cost[event.symbol] = 0
                 self.entry_time[event.symbol] = 0
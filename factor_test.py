@@ -1,98 +1,255 @@
-import queue
+import logging
+import os.path
 import time
 
+import pandas as pd
+
 from backtest import Backtest
 from equity_plot import plot_performance
-from event import MarketEvent
+from performance import equity_by_date, summary_table
+from Test_strategy import FactorRanker
+from vectorized import VectorizedFactorTest
 import matplotlib.pyplot as plt
 
+logger = logging.getLogger('backtest.factor_test')
+
 '''如果拆成 backtest 和 factortest 两套，需要加入判断功能的参数'''
 
 
+class FactorTestResult(object):
+    """
+    分层测试的结果：layers是每一层的BacktestResult，equity_curves是 层 × 日期 的净值矩阵，
+    summary是每层一行的汇总统计
+    """
+
+    def __init__(self, layers, equity_curves, summary, signals, orders, fills):
+
+        self.layers = layers
+        self.equity_curves = equity_curves
+        self.summary = summary
+        self.signals = signals
+        self.orders = orders
+        self.fills = fills
+
+    def to_csv(self, equity_path='equity.csv', execution_path='Execution_summary.csv'):
+        """
+        只有一层时文件名与Backtest相同；多层时在文件名后加上_layer<层号>，避免互相覆盖
+        """
+
+        if len(self.layers) == 1:
+            self.layers[0].to_csv(equity_path, execution_path)
+            return
+        for cur_layer, result in enumerate(self.layers):
+            paths = ['%s_layer%d%s' % (os.path.splitext(path)[0], cur_layer, os.path.splitext(path)[1])
+                     for path in (equity_path, execution_path)]
+            result.to_csv(*paths)
+
+
 class FactorTest(Backtest):
 
     def __init__(
             self, stock_csv_dir, factor_csv_dir, symbol_list, initial_capital, stock_num,
             heartbeat, start_date, factor, layer,
-            data_handler_cls, execution_handler_cls, portfolio_cls, strategy_cls
+            data_handler_cls, execution_handler_cls, portfolio_cls, strategy_cls, cache_dir=None, workers=1,
+            threaded=False, instrumentation=None, log_level=None, preprocessor=None, rebalance='M',
+            skip_ahead=True
     ):
         super().__init__(stock_csv_dir, factor_csv_dir, symbol_list, initial_capital, stock_num,
                          heartbeat, start_date, data_handler_cls,
-                         execution_handler_cls, portfolio_cls, strategy_cls)
+                         execution_handler_cls, portfolio_cls, strategy_cls, cache_dir, workers, threaded,
+                         instrumentation, log_level, rebalance, skip_ahead)
         self.factor = factor
         self.layer = layer
+        self.preprocessor = preprocessor  # FactorPreprocessor，None表示直接按原始因子值排序
         # self.cur_layer = cur_layer
         self._generate_trading_instances()
 
     def _generate_trading_instances(self):
 
-        print(
-            "Creating DataHandler, Strategy, Portfolio and ExecutionHandler/n"
-        )
+        logger.info("Creating DataHandler, Strategy, Portfolio and ExecutionHandler")
 
         self.data_handler = self.data_handler_cls(self.events, self.stock_csv_dir, self.factor_csv_dir, self.factor,
-                                                  self.start_date, self.symbol_list)
-        self.strategy = self.strategy_cls(self.data_handler, self.events, self.stock_num, self.factor, self.layer)
-        self.portfolio = self.portfolio_cls(self.data_handler, self.events, self.start_date,
-                                            self.initial_capital, self.stock_num)
-        self.execution_handler = self.execution_handler_cls(self.events)
+                                                  self.start_date, self.symbol_list, cache_dir=self.cache_dir,
+                                                  workers=self.workers)
+        self.data_handler.set_rebalance(self.rebalance)
+        self._prepare_factor()
+        self._reset_class()
+
+    def _prepare_factor(self):
+        """
+        确定分层排序使用的字段：factor为{因子: 权重}时先合成，指定preprocessor时再做截面预处理。
+        factor_name是合成后、预处理前的字段名，用作结果的名称
+        """
+
+        self.factor_name = self.factor
+        if isinstance(self.factor, dict):
+            self.factor_name = self.data_handler.combine_factors(self.factor)
+        self.data_handler.factor = self.factor_name
+        self.rank_factor = self.factor_name
+        if self.preprocessor is not None:
+            self.rank_factor = self.data_handler.preprocess_factor(self.preprocessor, self.factor_name)
+
+    def set_factor(self, factor, preprocessor=None):
+        """
+        换一个因子（因子名或者{因子: 权重}）重新准备分层测试。共用已经读入的数据，
+        只重置数据游标，重新生成每一层的策略、组合和执行对象
+        """
+
+        self.factor = factor
+        self.preprocessor = preprocessor
+        self.data_handler.reset_latest_data()
+        self.data_handler.continue_backtest = True
+        self.events = self._new_event_bus()
+        self.data_handler.events = self.events
+        self.signals = 0
+        self.orders = 0
+        self.fills = 0
+        self._prepare_factor()
+        self._reset_class()
 
     def _reset_class(self):
+        """
+        每一层有自己的事件总线、策略、组合和执行对象，所有层共用一个FactorRanker，
+        每个调仓日只排序一次。数据更新产生的MarketEvent由主事件总线分发给每一层
+        """
+
+        self.ranker = FactorRanker(self.data_handler, self.rank_factor)
+        self.layer_events = []
+        self.strategies = []
+        self.portfolios = []
+        self.execution_handlers = []
+        for cur_layer in range(self.layer):
+            events = self._new_event_bus()
+            self._subscribe_handlers(events)
+            self.layer_events.append(events)
+            self.strategies.append(self.strategy_cls(self.data_handler, events, self.stock_num, self.rank_factor,
+                                                     self.layer, ranker=self.ranker))
+            self.portfolios.append(self.portfolio_cls(self.data_handler, events, self.start_date,
+                                                      self.initial_capital, self.stock_num))
+            self.execution_handlers.append(self.execution_handler_cls(events))
+        for strategy in self.strategies:
+            self.data_handler.declare_lookback(strategy.lookback)
+        self.events.subscribe('MARKET', self._on_layers_market)
+        self._select_layer(0)
+
+    def _select_layer(self, cur_layer):
+        """
+        把strategy、portfolio和execution_handler指向第cur_layer层，处理该层事件和输出结果时使用
+        """
+
+        self.cur_layer = cur_layer
+        self.strategy = self.strategies[cur_layer]
+        self.portfolio = self.portfolios[cur_layer]
+        self.execution_handler = self.execution_handlers[cur_layer]
+
+    def _on_market(self, event):
 
-        self.strategy = self.strategy_cls(self.data_handler, self.events, self.stock_num, self.factor, self.layer)
-        self.portfolio = self.portfolio_cls(self.data_handler, self.events, self.start_date,
-                                            self.initial_capital, self.stock_num)
-        self.execution_handler = self.execution_handler_cls(self.events)
+        self.strategy.calculate_signals(event, self.cur_layer)
 
-    def _run_factortest(self, cur_layer):
+    def _on_layers_market(self, event):
+        """
+        主事件总线上的MarketEvent转发给每一层，依次处理到该层调仓结束
+        """
 
+        for cur_layer in range(self.layer):
+            self._select_layer(cur_layer)
+            events = self.layer_events[cur_layer]
+            events.put(event)
+            events.dispatch(self._continue_transfer)
+
+    def _run_factortest(self):
+        """
+        所有层在同一个数据循环中推进：数据更新产生的MarketEvent分发给每一层
+        """
+
+        self._start_instrumentation()
         i = 0
         while True:
             i += 1
-            print(i)
+            logger.debug("iteration %d", i)
 
             if self.data_handler.continue_backtest:
                 self.data_handler.update_bars_monthly()
-                self.portfolio.update_timeindex()
+                for portfolio in self.portfolios:
+                    portfolio.update_timeindex()
             else:
                 break
 
-            while True:
-                try:
-                    event = self.events.get(False)
-                except queue.Empty:
-                    break
-                else:
-                    if event is not None:
-                        if event.type == 'MARKET':
-                            self.strategy.calculate_signals(event, cur_layer)
-                        elif event.type == 'SIGNAL':
-                            self.signals += 1
-                            self.portfolio.update_signal(event)
-                        elif event.type == 'ORDER':
-                            self.orders += 1
-                            self.execution_handler.execute_order(event)
-                        elif event.type == 'FILL':
-                            self.fills += 1
-                            self.portfolio.update_fill(event)
-
-                if self.events.empty() and self.strategy.transferring == True:
-                    self.events.put(MarketEvent())
-
-            time.sleep(self.heartbeat)
+            self.events.dispatch()
+            self._skip_ahead(self.strategies, self.portfolios)
+            self._end_iteration()
 
-    def run_trading(self):
+            if self.heartbeat:
+                time.sleep(self.heartbeat)
+
+        for execution_handler in self.execution_handlers:
+            execution_handler.close()
+        self.data_handler.close()
+        self._finish_instrumentation()
+
+    def layer_equity_curves(self):
+        """
+        返回 层 × 日期 的净值矩阵，每个日期取当天最后一条记录
+        """
+
+        curves = {}
+        for cur_layer, portfolio in enumerate(self.portfolios):
+            curves['layer %s' % cur_layer] = equity_by_date(portfolio.equity_curve)
+        return pd.DataFrame(curves).T
+
+    def layer_summary(self, periods=252):
+        """
+        一次计算所有层净值曲线的汇总统计
+        """
+
+        return summary_table(self.layer_equity_curves(), periods, axis=1)
 
+    def run(self):
+        """
+        只运行分层测试并返回FactorTestResult，不画图，也不写文件
+        """
+
+        self._run_factortest()
+        layers = []
         for cur_layer in range(self.layer):
-            self._run_factortest(cur_layer)
-            self._output_performance()
-            my_plot = plot_performance(self.portfolio.equity_curve,
-                                       self.data_handler.symbol_data[self.symbol_list[0]],
-                                       self.execution_handler.execution_records)
-            my_plot.plot_equity_curve()
-            self.data_handler.reset_latest_data()
-            self._reset_class()
-            self.data_handler.continue_backtest = True
+            self._select_layer(cur_layer)
+            layers.append(self._result())
+        return FactorTestResult(layers, self.layer_equity_curves(), self.layer_summary(),
+                                self.signals, self.orders, self.fills)
+
+    def run_factors(self, factors, preprocessor=None):
+        """
+        依次测试多个因子（或因子组合），数据只读一次。返回 因子名 -> FactorTestResult 的字典
+        """
+
+        results = {}
+        for factor in factors:
+            self.set_factor(factor, preprocessor)
+            results[self.factor_name] = self.run()
+        return results
+
+    def run_trading(self):
+
+        result = self.run()
+        for cur_layer, layer_result in enumerate(result.layers):
+            logger.info("Layer %d", cur_layer)
+            self._output_performance(layer_result)
+            self.plot(layer_result)
+        result.to_csv()
+        return result.equity_curves
+
+    def run_vectorized(self, cur_layer=0):
+        """
+        用VectorizedFactorTest直接在数据面板上计算第cur_layer层的结果，不经过事件队列。
+        需要使用PanelDataHandler
+        """
+
+        vectorized = VectorizedFactorTest(self.data_handler.panel, self.factor, self.stock_num, self.layer,
+                                          self.initial_capital,
+                                          factor_values=self.data_handler.field(self.rank_factor),
+                                          rebalance=self.rebalance)
+        vectorized.run(cur_layer)
+        return vectorized
 
     def factor_equity_curve(self):
 
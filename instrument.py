@@ -0,0 +1,203 @@
+# instrument.py
+
+import contextlib
+import cProfile
+import logging
+import time
+import tracemalloc
+
+import pandas as pd
+
+logger = logging.getLogger('backtest.instrument')
+
+# 回测引擎中需要计时的方法：对象类型 -> 方法名
+HANDLER_METHODS = [
+    ('data_handler', 'update_bars_monthly'),
+    ('strategy', 'calculate_signals'),
+    ('portfolio', 'update_timeindex'),
+    ('portfolio', 'update_timeindex_range'),
+    ('portfolio', 'update_signal'),
+    ('execution_handler', 'execute_order'),
+    ('portfolio', 'update_fill'),
+]
+
+_MISSING = object()
+
+
+class Instrumentation(object):
+    """
+    Instrumentation是可选的回测计时工具，通过Backtest(..., instrumentation=Instrumentation())启用。
+    它把数据、策略、组合和执行对象上的处理函数替换为计时版本，记录每个函数的调用次数、
+    墙钟时间和CPU时间；每次循环记录事件队列的最大深度，trace_memory为True时还记录
+    tracemalloc统计的已分配内存。回测结束后把汇总表写入日志，
+    指定summary_path时写出汇总CSV，指定profile_path时用cProfile记录整个回测并写出pstats文件。
+    """
+
+    def __init__(self, profile_path=None, summary_path=None, trace_memory=False):
+
+        self.profile_path = profile_path
+        self.summary_path = summary_path
+        self.trace_memory = trace_memory
+
+        self.calls = {}
+        self.wall = {}
+        self.cpu = {}
+        self.records = []
+        self._replaced = []  # (对象, 方法名, 替换前对象自身的属性)，finish时恢复
+        self._depth = 0
+        self._iteration_start = None
+        self._profiler = None
+        self._started_tracemalloc = False
+
+    def add(self, name, wall, cpu, calls=1):
+
+        self.calls[name] = self.calls.get(name, 0) + calls
+        self.wall[name] = self.wall.get(name, 0.0) + wall
+        self.cpu[name] = self.cpu.get(name, 0.0) + cpu
+
+    def _replace(self, obj, method, func):
+        """
+        把obj.method替换为func，并记录替换前的属性。已经被本对象替换过的方法不再替换
+        """
+
+        if getattr(getattr(obj, method), 'instrumentation', None) is self:
+            return False
+        self._replaced.append((obj, method, vars(obj).get(method, _MISSING)))
+        func.instrumentation = self
+        setattr(obj, method, func)
+        return True
+
+    def restore(self):
+        """
+        恢复所有被替换的方法，之后这些对象与没有计时时完全相同
+        """
+
+        for obj, method, original in reversed(self._replaced):
+            if original is _MISSING:
+                delattr(obj, method)
+            else:
+                setattr(obj, method, original)
+        self._replaced = []
+
+    def wrap(self, obj, method, name=None):
+        """
+        把obj.method替换为计时版本，同一个对象的同一个方法只替换一次
+        """
+
+        name = name or method
+        func = getattr(obj, method)
+
+        def timed(*args, **kwargs):
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+        self._replace(obj, method, timed)
+
+    def watch_events(self, events):
+        """
+        记录事件队列在本次循环中达到的最大深度
+        """
+
+        put = events.put
+
+        def watched_put(event):
+            put(event)
+            self._depth = max(self._depth, len(events))
+
+        self._replace(events, 'put', watched_put)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        记录一段代码的耗时，例如读取数据、统计和画图
+        """
+
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    def attach(self, backtest):
+        """
+        在回测开始前调用，替换backtest中各对象的处理函数，并开始cProfile和内存统计
+        """
+
+        # FactorTest每一层有一套策略、组合和执行对象，Backtest只有一套
+        targets = {
+            'data_handler': [backtest.data_handler],
+            'strategy': getattr(backtest, 'strategies', [backtest.strategy]),
+            'portfolio': getattr(backtest, 'portfolios', [backtest.portfolio]),
+            'execution_handler': getattr(backtest, 'execution_handlers', [backtest.execution_handler]),
+        }
+        for kind, method in HANDLER_METHODS:
+            for obj in targets[kind]:
+                self.wrap(obj, method)
+
+        for events in [backtest.events] + list(getattr(backtest, 'layer_events', [])):
+            self.watch_events(events)
+
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        if self.profile_path is not None:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        self._iteration_start = time.perf_counter()
+
+    def end_iteration(self):
+        """
+        每次循环结束时调用，记录本次循环的耗时、事件队列最大深度和已分配内存
+        """
+
+        now = time.perf_counter()
+        record = {'wall': now - self._iteration_start, 'queue_depth': self._depth}
+        if self.trace_memory:
+            record['memory'], record['memory_peak'] = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+        self.records.append(record)
+        self._depth = 0
+        self._iteration_start = now
+
+    def finish(self):
+        """
+        回测结束时调用：恢复被替换的方法，停止cProfile和内存统计，写出pstats文件和汇总表，并把汇总表写入日志。
+        同一个Instrumentation可以再用于下一次回测，计时累加
+        """
+
+        self.restore()
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.profile_path)
+            self._profiler = None
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+        summary = self.summary()
+        if self.summary_path is not None:
+            summary.to_csv(self.summary_path)
+        logger.info("Handler timings:\n%s", summary)
+
+    def summary(self):
+        """
+        每个处理函数一行：调用次数、墙钟时间、CPU时间、平均每次调用的时间和占总时间的比例
+        """
+
+        table = pd.DataFrame({'calls': pd.Series(self.calls), 'wall': pd.Series(self.wall),
+                              'cpu': pd.Series(self.cpu)})
+        table.index.name = 'handler'
+        table['wall_per_call'] = table['wall'] / table['calls']
+        total = table['wall'].sum()
+        table['wall_pct'] = table['wall'] / total * 100.0 if total > 0 else 0.0
+        return table
+
+    def iterations(self):
+        """
+        每次循环一行：耗时、事件队列最大深度，以及trace_memory为True时的已分配内存（字节）
+        """
+
+        return pd.DataFrame(self.records)
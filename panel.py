@@ -0,0 +1,247 @@
+# panel.py
+
+import os.path
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from cache import SourceCache
+
+PRICE_FIELDS = ['high', 'low', 'open', 'close']
+
+
+class MarketPanel(object):
+    """
+    MarketPanel把所有股票的行情和因子数据对齐成一个(日期 × 股票 × 字段)的NumPy数组，
+    代替原先每支股票一个DataFrame的存储方式。
+    dates是'%Y-%m-%d'格式的日期字符串数组，values[t, j, k]是第t天第j支股票的第k个字段。
+    """
+
+    def __init__(self, dates, symbols, fields, values):
+
+        self.dates = np.asarray(dates)
+        self.symbols = list(symbols)
+        self.fields = list(fields)
+        self.values = values
+
+        self.symbol_index = dict((s, j) for j, s in enumerate(self.symbols))
+        self.field_index = dict((f, k) for k, f in enumerate(self.fields))
+
+    def __len__(self):
+
+        return len(self.dates)
+
+    def field(self, name):
+        """
+        返回某个字段的(日期 × 股票)矩阵，是values的视图，不复制数据
+        """
+
+        return self.values[:, :, self.field_index[name]]
+
+    def factor_fields(self):
+        """
+        除行情字段和Pct_change以外的字段，即因子XLSX中的所有列
+        """
+
+        return [f for f in self.fields if f not in PRICE_FIELDS and f != 'Pct_change']
+
+    def since(self, start_date):
+        """
+        返回从start_date开始的子面板，values是原数组的视图
+        """
+
+        start = np.searchsorted(self.dates, start_date)
+        return MarketPanel(self.dates[start:], self.symbols, self.fields, self.values[start:])
+
+    def symbol_frame(self, symbol):
+        """
+        把某支股票的数据还原成以日期为索引的DataFrame，用于画图和导出
+        """
+
+        return pd.DataFrame(self.values[:, self.symbol_index[symbol], :],
+                            index=pd.Index(self.dates, name='datetime'),
+                            columns=self.fields)
+
+    def symbol_frames(self):
+        """
+        返回一个按需生成DataFrame的字典视图，兼容原先的symbol_data用法
+        """
+
+        return SymbolFrames(self)
+
+
+class SymbolFrames(Mapping):
+    """
+    symbol -> DataFrame的只读映射，只在访问时才从面板中切出对应股票的数据
+    """
+
+    def __init__(self, panel):
+
+        self.panel = panel
+
+    def __getitem__(self, symbol):
+
+        if symbol not in self.panel.symbol_index:
+            raise KeyError(symbol)
+        return self.panel.symbol_frame(symbol)
+
+    def __iter__(self):
+
+        return iter(self.panel.symbols)
+
+    def __len__(self):
+
+        return len(self.panel.symbols)
+
+
+def read_price_csv(path):
+    """
+    读取一支股票的行情CSV，返回(日期数组, 数值矩阵)，列顺序为PRICE_FIELDS
+    """
+
+    df = pd.read_csv(
+        path, header=0, index_col=0,
+        names=['datetime'] + PRICE_FIELDS
+    ).sort_index()
+    return np.asarray(df.index.astype(str), dtype=str), df.to_numpy(dtype=float)
+
+
+def read_factor_xlsx(path, sort=True):
+    """
+    读取一支股票的因子XLSX，返回(日期数组, 因子列名, 数值矩阵)。
+    日期统一转成'%Y-%m-%d'格式，非数值的单元格按NaN处理。sort为False时保持文件中的行顺序
+    """
+
+    df = pd.read_excel(path, header=0, index_col=0)
+    if sort:
+        df = df.sort_index()
+    dates = pd.to_datetime(df.index).strftime('%Y-%m-%d')
+    df = df.apply(pd.to_numeric, errors='coerce')
+    return np.asarray(dates, dtype=str), [str(c) for c in df.columns], df.to_numpy(dtype=float)
+
+
+def build_panel(symbol_list, price_data, factor_data, start_date, dates=None, factor_fields=None):
+    """
+    把每支股票的行情和因子数组对齐到同一个日期索引上：
+    行情按所有股票日期的并集向前填充，缺失值填0；因子按日期左连接；
+    再计算收盘价的Pct_change，最后截取start_date之后的数据（start_date为None时保留全部）。
+    price_data[s] = (dates, values)，factor_data[s] = (dates, columns, values)。
+    分批对齐一部分股票时，由dates和factor_fields传入整个股票池的日期并集和因子列
+    """
+
+    if dates is None:
+        dates = np.unique(np.concatenate([price_data[s][0] for s in symbol_list]))
+    n_dates, n_symbols = len(dates), len(symbol_list)
+
+    if factor_fields is None:
+        factor_fields = []
+        for s in symbol_list:
+            for c in factor_data[s][1]:
+                if c not in factor_fields:
+                    factor_fields.append(c)
+    fields = PRICE_FIELDS + factor_fields + ['Pct_change']
+    field_index = dict((f, k) for k, f in enumerate(fields))
+
+    values = np.full((n_dates, n_symbols, len(fields)), np.nan)
+    present = np.zeros((n_dates, n_symbols), dtype=bool)
+    n_price = len(PRICE_FIELDS)
+
+    for j, s in enumerate(symbol_list):
+        p_dates, p_values = price_data[s]
+        rows = np.searchsorted(dates, p_dates)
+        values[rows, j, :n_price] = p_values
+        present[rows, j] = True
+
+        f_dates, f_columns, f_values = factor_data[s]
+        pos = np.searchsorted(dates, f_dates)
+        hit = (pos < n_dates) & (dates[np.minimum(pos, n_dates - 1)] == f_dates)
+        cols = [field_index[c] for c in f_columns]
+        values[np.ix_(pos[hit], [j], cols)] = f_values[hit][:, None, :]
+
+    # 行情数据按每支股票自己最近一次出现的日期向前填充
+    last_seen = np.where(present, np.arange(n_dates)[:, None], -1)
+    np.maximum.accumulate(last_seen, axis=0, out=last_seen)
+    prices = values[np.maximum(last_seen, 0), np.arange(n_symbols)[None, :], :n_price]
+    prices[last_seen < 0] = np.nan
+    values[:, :, :n_price] = np.nan_to_num(prices, nan=0.0)
+
+    close = values[:, :, field_index['close']]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values[1:, :, field_index['Pct_change']] = close[1:] / close[:-1] - 1.0
+
+    start = 0 if start_date is None else np.searchsorted(dates, start_date)
+    return MarketPanel(dates[start:], symbol_list, fields, values[start:])
+
+
+def read_symbol_sources(stock_csv_dir, factor_csv_dir, symbol, cache=None):
+    """
+    读取一支股票的行情和因子数据，返回(行情元组, 因子元组)。
+    传入SourceCache时优先读取缓存
+    """
+
+    price_path = os.path.join(stock_csv_dir, '%s.csv' % symbol)
+    factor_path = os.path.join(factor_csv_dir, '%s.xlsx' % symbol)
+    if cache is None:
+        return read_price_csv(price_path), read_factor_xlsx(factor_path)
+    return cache.load(price_path, read_price_csv), cache.load(factor_path, read_factor_xlsx)
+
+
+def _load_symbol_chunk(stock_csv_dir, factor_csv_dir, symbols, cache_dir):
+    """
+    子进程中执行：解析一批股票的数据，返回紧凑的NumPy数组给主进程
+    """
+
+    cache = SourceCache(cache_dir) if cache_dir is not None else None
+    result = []
+    for s in symbols:
+        (p_dates, p_values), (f_dates, f_columns, f_values) = read_symbol_sources(
+            stock_csv_dir, factor_csv_dir, s, cache)
+        result.append(((np.asarray(p_dates), np.asarray(p_values)),
+                       (np.asarray(f_dates), f_columns, np.asarray(f_values))))
+    return result
+
+
+def load_universe(stock_csv_dir, factor_csv_dir, symbol_list, cache_dir=None, workers=1):
+    """
+    读取所有股票的行情和因子数据，返回(price_data, factor_data)两个字典。
+    workers大于1时把symbol_list切分给进程池并行解析
+    """
+
+    price_data = {}
+    factor_data = {}
+    if workers is None or workers <= 1:
+        chunks = [list(symbol_list)]
+        results = [_load_symbol_chunk(stock_csv_dir, factor_csv_dir, chunks[0], cache_dir)]
+    else:
+        # 切得比进程数更细一些，避免个别大文件拖慢整体
+        n_chunks = min(len(symbol_list), workers * 4)
+        chunks = [list(c) for c in np.array_split(np.asarray(symbol_list, dtype=object), n_chunks)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_load_symbol_chunk, [stock_csv_dir] * n_chunks, [factor_csv_dir] * n_chunks,
+                                    chunks, [cache_dir] * n_chunks))
+
+    for symbols, result in zip(chunks, results):
+        for s, (price, factor) in zip(symbols, result):
+            price_data[s] = price
+            factor_data[s] = factor
+    return price_data, factor_data
+
+
+def load_panel(stock_csv_dir, factor_csv_dir, symbol_list, start_date, cache_dir=None, workers=1, mmap=False):
+    """
+    从数据路径中读取所有股票的行情CSV和因子XLSX，构建MarketPanel。
+    指定cache_dir时，对齐后的完整面板保存在cache_dir下的PanelStore中，源文件末尾追加新行后只读取新增部分，
+    mmap为True时以只读内存映射的方式打开面板（需要cache_dir）；workers大于1时用多进程解析
+    """
+
+    if cache_dir is not None:
+        from store import PanelStore
+        store = PanelStore.for_universe(cache_dir, stock_csv_dir, factor_csv_dir, symbol_list)
+        return store.update(stock_csv_dir, factor_csv_dir, symbol_list, cache_dir, workers, mmap).since(start_date)
+    if mmap:
+        raise ValueError("Memory-mapping the panel requires a cache_dir for the panel store")
+
+    price_data, factor_data = load_universe(stock_csv_dir, factor_csv_dir, symbol_list, cache_dir, workers)
+    return build_panel(symbol_list, price_data, factor_data, start_date)
@@ -2,30 +2,318 @@
 
 import numpy as np
 import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
 
+'''
+所有统计函数既可以处理单条曲线，也可以一次处理多条曲线（分层、参数扫描）：
+时间沿axis方向（默认axis=0，即DataFrame的每一列是一条曲线），NaN会被忽略。
+输入是pandas对象时，按时间保留长度的结果返回同样索引的pandas对象，
+归约后的结果对Series返回标量，对DataFrame返回以曲线名为索引的Series。
+'''
 
-def create_sharpe_ratio(returns, periods=252):
+
+def _to_array(x, axis):
+
+    return np.moveaxis(np.asarray(x, dtype=float), axis, 0)
+
+
+def _wrap_reduced(result, x, axis):
+
+    if isinstance(x, pd.DataFrame):
+        return pd.Series(result, index=x.columns if axis == 0 else x.index)
+    if np.ndim(result) == 0:
+        return float(result)
+    return result
+
+
+def _wrap_series(result, x, axis):
+
+    result = np.moveaxis(result, 0, axis)
+    if isinstance(x, pd.DataFrame):
+        return pd.DataFrame(result, index=x.index, columns=x.columns)
+    if isinstance(x, pd.Series):
+        return pd.Series(result, index=x.index, name=x.name)
+    return result
+
+
+def _pad_front(result, n):
+    """
+    滚动窗口的结果前面补n个NaN，使长度与原序列一致
+    """
+
+    pad = np.full((n,) + result.shape[1:], np.nan)
+    return np.concatenate([pad, result], axis=0)
+
+
+def _nanmax(arr):
+    """
+    沿时间方向取最大值，忽略NaN，全部为NaN时返回NaN（不产生警告）
+    """
+
+    valid = ~np.isnan(arr)
+    return np.where(valid.any(axis=0), np.max(np.where(valid, arr, -np.inf), axis=0), np.nan)
+
+
+def _last_reset(flag):
+    """
+    沿时间方向返回每个位置之前（含）最近一次flag为True的下标，没有则为NaN
+    """
+
+    t = np.arange(len(flag), dtype=float).reshape((-1,) + (1,) * (flag.ndim - 1))
+    return np.fmax.accumulate(np.where(flag, t, np.nan), axis=0)
+
+
+def curve_returns(curve, axis=0):
+    """
+    由净值曲线计算每期收益率，第一期为NaN
+    """
+
+    arr = _to_array(curve, axis)
+    returns = np.full(arr.shape, np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns[1:] = arr[1:] / arr[:-1] - 1.0
+    return _wrap_series(returns, curve, axis)
+
+
+def equity_by_date(equity_curve):
+    """
+    从Portfolio的equity_curve中取出每个交易日的净值：去掉初始资金那一行，
+    同一天有多条记录（调仓日）时取最后一条
+    """
+
+    curve = equity_curve['equity_curve']
+    return curve[curve.index.notnull() & ~curve.index.duplicated(keep='last')]
+
+
+def create_sharpe_ratio(returns, periods=252, axis=0):
     """
     计算策略的Sharpe比率，基于基准为0，也就是假设无风险利率为0
     """
-    return np.sqrt(periods) * (np.mean(returns)) / np.std(returns)
+
+    arr = _to_array(returns, axis)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.sqrt(periods) * np.nanmean(arr, axis=0) / np.nanstd(arr, axis=0)
+    return _wrap_reduced(result, returns, axis)
+
+
+def create_drawdowns(pnl, axis=0):
+    """
+    计算PnL曲线的回撤序列（高水位减去当前值）、最大回撤，以及最长的回撤持续期数。
+    与原来的逐点循环一致：高水位从0开始，从第二个点起计算，第一个点的回撤为NaN。
+    """
+
+    arr = _to_array(pnl, axis)
+    drawdown = np.full(arr.shape, np.nan)
+    duration = np.full(arr.shape, np.nan)
+    if len(arr) > 1:
+        hwm = np.fmax(np.fmax.accumulate(arr[1:], axis=0), 0.0)
+        drawdown[1:] = hwm - arr[1:]
+        t = np.arange(len(arr), dtype=float).reshape((-1,) + (1,) * (arr.ndim - 1))
+        duration = t - _last_reset(drawdown == 0)
+
+    return _wrap_series(drawdown, pnl, axis), _wrap_reduced(_nanmax(drawdown), pnl, axis), \
+        _wrap_reduced(_nanmax(duration), pnl, axis)
+
+
+def drawdown_pct(curve, axis=0):
+    """
+    相对回撤序列：1 - 当前净值 / 历史最高净值
+    """
+
+    arr = _to_array(curve, axis)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = 1.0 - arr / np.fmax.accumulate(arr, axis=0)
+    return _wrap_series(result, curve, axis)
+
+
+def max_drawdown(curve, axis=0):
+    """
+    最大相对回撤
+    """
+
+    return _wrap_reduced(_nanmax(_to_array(drawdown_pct(curve, axis), axis)), curve, axis)
+
+
+def max_drawdown_duration(curve, axis=0):
+    """
+    净值低于历史最高点的最长连续期数
+    """
+
+    arr = _to_array(curve, axis)
+    underwater = arr < np.fmax.accumulate(arr, axis=0)
+    t = np.arange(len(arr), dtype=float).reshape((-1,) + (1,) * (arr.ndim - 1))
+    duration = t - np.nan_to_num(_last_reset(~underwater), nan=-1.0)
+    duration[~underwater] = 0.0
+    return _wrap_reduced(duration.max(axis=0), curve, axis)
+
+
+def total_return(returns, axis=0):
+    """
+    整个区间的累计收益率
+    """
+
+    arr = _to_array(returns, axis)
+    return _wrap_reduced(np.nanprod(1.0 + arr, axis=0) - 1.0, returns, axis)
+
+
+def annualized_return(returns, periods=252, axis=0):
+    """
+    年化收益率（几何平均）
+    """
+
+    arr = _to_array(returns, axis)
+    n = np.sum(~np.isnan(arr), axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.nanprod(1.0 + arr, axis=0) ** (periods / n) - 1.0
+    return _wrap_reduced(result, returns, axis)
+
+
+def annualized_volatility(returns, periods=252, axis=0):
+    """
+    年化波动率
+    """
+
+    arr = _to_array(returns, axis)
+    return _wrap_reduced(np.nanstd(arr, axis=0) * np.sqrt(periods), returns, axis)
+
+
+def sortino_ratio(returns, periods=252, axis=0):
+    """
+    Sortino比率，只用负收益计算下行波动，无风险利率为0
+    """
+
+    arr = _to_array(returns, axis)
+    downside = np.sqrt(np.nanmean(np.minimum(arr, 0.0) ** 2, axis=0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.sqrt(periods) * np.nanmean(arr, axis=0) / downside
+    return _wrap_reduced(result, returns, axis)
+
+
+def calmar_ratio(returns, periods=252, axis=0):
+    """
+    Calmar比率：年化收益率 / 最大相对回撤
+    """
+
+    arr = _to_array(returns, axis)
+    curve = np.cumprod(1.0 + np.nan_to_num(arr), axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.asarray(annualized_return(arr, periods)) / _nanmax(drawdown_pct(curve))
+    return _wrap_reduced(result, returns, axis)
+
+
+def hit_rate(returns, axis=0):
+    """
+    收益为正的期数占有效期数的比例
+    """
+
+    arr = _to_array(returns, axis)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.sum(arr > 0, axis=0) / np.sum(~np.isnan(arr), axis=0)
+    return _wrap_reduced(result, returns, axis)
+
+
+def turnover(weights, axis=0):
+    """
+    每期换手率：0.5 * sum(|w_t - w_{t-1}|)。weights的最后一维是股票，时间沿axis方向，
+    可以是(时间 × 股票)或者(时间 × 曲线 × 股票)，第一期为NaN
+    """
+
+    arr = _to_array(np.nan_to_num(np.asarray(weights, dtype=float)), axis)
+    result = np.full(arr.shape[:-1], np.nan)
+    result[1:] = 0.5 * np.abs(np.diff(arr, axis=0)).sum(axis=-1)
+    if isinstance(weights, pd.DataFrame):
+        return pd.Series(result, index=weights.index)
+    return np.moveaxis(result, 0, axis) if result.ndim > 1 else result
+
+
+def _rolling_windows(x, window, axis):
+
+    arr = _to_array(x, axis)
+    return sliding_window_view(arr, window, axis=0)
+
+
+def rolling_return(returns, window, axis=0):
+    """
+    滚动窗口内的累计收益率
+    """
+
+    windows = _rolling_windows(returns, window, axis)
+    result = np.prod(1.0 + windows, axis=-1) - 1.0
+    return _wrap_series(_pad_front(result, window - 1), returns, axis)
+
+
+def rolling_volatility(returns, window, periods=252, axis=0):
+    """
+    滚动窗口的年化波动率
+    """
+
+    windows = _rolling_windows(returns, window, axis)
+    result = np.std(windows, axis=-1) * np.sqrt(periods)
+    return _wrap_series(_pad_front(result, window - 1), returns, axis)
+
+
+def rolling_sharpe(returns, window, periods=252, axis=0):
+    """
+    滚动窗口的Sharpe比率
+    """
+
+    windows = _rolling_windows(returns, window, axis)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.sqrt(periods) * np.mean(windows, axis=-1) / np.std(windows, axis=-1)
+    return _wrap_series(_pad_front(result, window - 1), returns, axis)
+
+
+def rolling_max_drawdown(curve, window, axis=0):
+    """
+    滚动窗口内的最大相对回撤
+    """
+
+    windows = _rolling_windows(curve, window, axis)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.max(1.0 - windows / np.maximum.accumulate(windows, axis=-1), axis=-1)
+    return _wrap_series(_pad_front(result, window - 1), curve, axis)
+
+
+def summary_table(curves, periods=252, axis=0):
+    """
+    一次计算多条净值曲线的汇总统计，返回每条曲线一行的DataFrame
+    """
+
+    arr = _to_array(curves, axis)
+    returns = _to_array(curve_returns(arr), 0)
+    table = pd.DataFrame({
+        'total_return': np.ravel(total_return(returns)),
+        'annualized_return': np.ravel(annualized_return(returns, periods)),
+        'annualized_volatility': np.ravel(annualized_volatility(returns, periods)),
+        'sharpe_ratio': np.ravel(create_sharpe_ratio(returns, periods)),
+        'sortino_ratio': np.ravel(sortino_ratio(returns, periods)),
+        'calmar_ratio': np.ravel(calmar_ratio(returns, periods)),
+        'max_drawdown': np.ravel(max_drawdown(arr)),
+        'max_drawdown_duration': np.ravel(max_drawdown_duration(arr)),
+        'hit_rate': np.ravel(hit_rate(returns)),
+    })
+    if isinstance(curves, pd.DataFrame):
+        table.index = curves.columns if axis == 0 else curves.index
+    elif isinstance(curves, pd.Series):
+        table.index = [curves.name]
+    return table
 
 
-def create_drawdowns(pnl):
+def create_summary_stats(equity_curve):
     """
-    计算PnL曲线的最大回撤（从最大收益到最小收益之间的距离），以及回撤的时间
-    这里需要参数pnl_returns是一个pandas的Series
+    根据equity_curve计算汇总统计，同时把回撤序列写入equity_curve['drawdown']
     """
 
-    hwm = [0]
-    idx = pnl.index
-    drawdown = pd.Series(index=idx)
-    duration = pd.Series(index=idx)
+    final_equity = equity_curve['equity_curve'].iloc[-1]
+    returns = equity_curve['returns']
+    pnl = equity_curve['equity_curve']
 
-    for t in range(1, len(idx)):
-        cur_hwm = max(hwm[t - 1], pnl[t])
-        hwm.append(cur_hwm)
-        drawdown[t] = hwm[t] - pnl[t]
-        duration[t] = 0 if drawdown[t] == 0 else duration[t - 1] + 1
+    sharpe_ratio = create_sharpe_ratio(returns)
+    drawdown, max_dd, dd_duration = create_drawdowns(pnl)
+    equity_curve['drawdown'] = drawdown
 
-    return drawdown, drawdown.max(), duration.max()
\ No newline at end of file
+    stats = [("Total Return", "%0.2f%%" % ((final_equity - 1.0) * 100.0)),
+             ("Sharpe Ratio", "%0.2f" % sharpe_ratio),
+             ("Max Drawdown", "%0.2f%%" % (max_dd * 100)),
+             ("Drawdown Duration", "%d" % dd_duration)]
+    return stats
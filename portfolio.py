@@ -4,12 +4,155 @@ import datetime
 import numpy as np
 import pandas as pd
 import queue
-from performance import create_sharpe_ratio, create_drawdowns
+from collections.abc import Mapping
+from performance import create_sharpe_ratio, create_drawdowns, create_summary_stats
 
 from abc import ABCMeta, abstractmethod
 from math import floor
 
-from event import FillEvent, OrderEvent
+from event import BasketOrderEvent, FillEvent, OrderEvent
+
+
+class SymbolVector(Mapping):
+    """
+    以股票代码为下标读写的NumPy向量，values按symbol_list的顺序存放。
+    兼容原来current_positions字典的用法，同时可以直接参与向量运算。
+    """
+
+    def __init__(self, symbol_list):
+
+        self.symbol_list = symbol_list
+        self.symbol_index = dict((s, j) for j, s in enumerate(symbol_list))
+        self.values = np.zeros(len(symbol_list))
+
+    def __getitem__(self, symbol):
+
+        return self.values[self.symbol_index[symbol]]
+
+    def __setitem__(self, symbol, value):
+
+        self.values[self.symbol_index[symbol]] = value
+
+    def __iter__(self):
+
+        return iter(self.symbol_list)
+
+    def __len__(self):
+
+        return len(self.symbol_list)
+
+
+class HoldingsVector(SymbolVector):
+    """
+    current_holdings使用的映射：每支股票的持仓成本存放在values向量中，
+    cash、commission、total等其他键存放在字典里，读写方式与原来的字典相同
+    """
+
+    def __init__(self, symbol_list, **items):
+
+        super().__init__(symbol_list)
+        self.extra = dict(items)
+
+    def __getitem__(self, key):
+
+        j = self.symbol_index.get(key)
+        return self.extra[key] if j is None else self.values[j]
+
+    def __setitem__(self, key, value):
+
+        j = self.symbol_index.get(key)
+        if j is None:
+            self.extra[key] = value
+        else:
+            self.values[j] = value
+
+    def __iter__(self):
+
+        yield from self.symbol_list
+        yield from self.extra
+
+    def __len__(self):
+
+        return len(self.symbol_list) + len(self.extra)
+
+
+class HoldingsLedger(object):
+    """
+    用预先分配的数组记录每个时间点的持仓数量和市值（时间 × 股票），以及现金、手续费和总资产。
+    每次记录写入一行，容量不够时翻倍扩容。第0行是初始资金。
+    """
+
+    def __init__(self, symbol_list, initial_capital, capacity=512):
+
+        self.symbol_list = symbol_list
+        self.size = 0
+        self.datetime = np.empty(capacity, dtype=object)
+        self.positions = np.zeros((capacity, len(symbol_list)))
+        self.market_value = np.zeros((capacity, len(symbol_list)))
+        self.cash = np.zeros(capacity)
+        self.commission = np.zeros(capacity)
+        self.total = np.zeros(capacity)
+
+        self.datetime[0] = np.nan
+        self.cash[0] = initial_capital
+        self.total[0] = initial_capital
+        self.size = 1
+
+    def _grow(self):
+
+        capacity = 2 * len(self.cash)
+        for name in ['datetime', 'positions', 'market_value', 'cash', 'commission', 'total']:
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def append(self, date_time, positions, close, cash, commission):
+        """
+        按收盘价向量对持仓做逐个股票的市值结算，写入新的一行
+        """
+
+        if self.size == len(self.cash):
+            self._grow()
+        i = self.size
+        self.datetime[i] = date_time
+        self.positions[i] = positions
+        np.multiply(positions, close, out=self.market_value[i])
+        self.cash[i] = cash
+        self.commission[i] = commission
+        self.total[i] = cash + self.market_value[i].sum()
+        self.size += 1
+
+    def extend(self, dates, positions, close, cash, commission):
+        """
+        持仓、现金和手续费不变的一段时间：close是(日期 × 股票)的收盘价矩阵，一次写入len(dates)行
+        """
+
+        m = len(dates)
+        while self.size + m > len(self.cash):
+            self._grow()
+        i, j = self.size, self.size + m
+        self.datetime[i:j] = dates
+        self.positions[i:j] = positions
+        np.multiply(positions, close, out=self.market_value[i:j])
+        self.cash[i:j] = cash
+        self.commission[i:j] = commission
+        self.total[i:j] = cash + self.market_value[i:j].sum(axis=1)
+        self.size = j
+
+    def positions_frame(self):
+
+        return pd.DataFrame(self.positions[:self.size], columns=self.symbol_list,
+                            index=pd.Index(self.datetime[:self.size], name='datetime'))
+
+    def holdings_frame(self):
+
+        curve = pd.DataFrame(self.market_value[:self.size], columns=self.symbol_list,
+                             index=pd.Index(self.datetime[:self.size], name='datetime'))
+        curve['cash'] = self.cash[:self.size]
+        curve['commission'] = self.commission[:self.size]
+        curve['total'] = self.total[:self.size]
+        return curve
 
 
 class Portfolio(object):
@@ -18,8 +161,11 @@ class Portfolio(object):
     postion DataFrame存放一个用时间做索引的持仓数量
     holdings DataFrame存放特定时间索引对应的每个代码的现金和总的市场持仓价值，
     以及资产组合总量的百分比变化。
+    持仓和市值的历史记录保存在HoldingsLedger的数组中，只有用到时才生成DataFrame。
     """
 
+    commission_rate = 0.00025  # 生成一篮子订单时估算手续费的费率，与SimulatedExecutionHandler一致
+
     def __init__(self, bars, events, start_date, initial_capital=100000, N=1):
         self.bars = bars
         self.events = events
@@ -31,44 +177,35 @@ class Portfolio(object):
         self.initial_capital = initial_capital
         self.stock_num = N
 
-        self.all_positions = self.__construct_all_positions()
-
-        self.current_positions = dict((k, v) for k, v in
-                                     [(s, 0) for s in self.symbol_list])
-
-        self.all_holdings = self.__construct_all_holdings()
+        self.current_positions = SymbolVector(self.symbol_list)
         self.current_holdings = self.__construct_current_holdings()
 
-    def __construct_all_positions(self):
+        self.ledger = HoldingsLedger(self.symbol_list, self.initial_capital)
+        self._equity_curve = None
+
+    def __construct_current_holdings(self):
         """
-        使用start_date来确定时间索引开始的日期来构造所有的持仓列表
+        这个函数构造一个字典，保存所有代码的资产组合的当前价值
         """
 
-        d = dict((k, v) for k, v in [(s, 0.0) for s in self.symbol_list])
-        d['datetime'] = self.start_date
-        return [d]
+        return HoldingsVector(self.symbol_list, cash=self.initial_capital, commission=0.0,
+                              total=self.initial_capital)
 
-    def __construct_all_holdings(self):
+    @property
+    def all_positions(self):
         """
-        这个函数构造一个字典，保存所有的代码的资产组合的startdate的价值
+        所有时间点的持仓数量DataFrame
         """
 
-        d = dict((k, v) for k, v in [(s, 0.0) for s in self.symbol_list])
-        d['cash'] = self.initial_capital
-        d['commission'] = 0.0
-        d['total'] = self.initial_capital
-        return [d]
+        return self.ledger.positions_frame()
 
-    def __construct_current_holdings(self):
+    @property
+    def all_holdings(self):
         """
-        这个函数构造一个字典，保存所有代码的资产组合的当前价值
+        所有时间点的持仓市值、现金、手续费和总资产DataFrame
         """
 
-        d = dict((k, v) for k, v in [(s, 0.0) for s in self.symbol_list])
-        d['cash'] = self.initial_capital
-        d['commission'] = 0.0
-        d['total'] = self.initial_capital
-        return d
+        return self.ledger.holdings_frame()
 
     def update_timeindex(self):
         """
@@ -78,26 +215,21 @@ class Portfolio(object):
         self.latest_datetime = self.bars.get_latest_bar_datetime(
             self.symbol_list[0]
         )
-        dp = dict((k, v) for k, v in [(s, 0) for s in self.symbol_list])
-        dp['datetime'] = self.latest_datetime
-        for s in self.symbol_list:
-            dp[s] = self.current_positions[s]
-
-        self.all_positions.append(dp)
-
-        dh = dict((k, v) for k, v in [(s, 0) for s in self.symbol_list])
-        dh['datetime'] = self.latest_datetime
-        dh['cash'] = self.current_holdings['cash']
-        dh['commission'] = self.current_holdings['commission']
-        dh['total'] = self.current_holdings['cash']
+        self.ledger.append(self.latest_datetime, self.current_positions.values,
+                           self.bars.get_latest_cross_section("close"),
+                           self.current_holdings['cash'], self.current_holdings['commission'])
 
-        for s in self.symbol_list:
-            market_value = self.current_positions[s] * \
-                           self.bars.get_latest_bar_value(s, "close")
-            dh[s] = market_value
-            dh['total'] += market_value
+    def update_timeindex_range(self, start, stop):
+        """
+        两个控制点之间没有交易，持仓不变：第start到stop-1个数据条目的市值记录用
+        持仓向量 × 收盘价矩阵按段写入（见PanelDataHandler.row_blocks），结果与逐日调用update_timeindex相同
+        """
 
-        self.all_holdings.append(dh)
+        dates = self.bars.panel.dates
+        for lo, hi in self.bars.row_blocks(start, stop):
+            self.ledger.extend(dates[lo:hi], self.current_positions.values, self.bars.field_rows("close", lo, hi),
+                               self.current_holdings['cash'], self.current_holdings['commission'])
+        self.latest_datetime = dates[stop - 1]
 
     def update_positions_from_fill(self, fill_event):
         """
@@ -131,58 +263,108 @@ class Portfolio(object):
         self.current_holdings['cash'] -= (cost + fill.commission * fill_cost * fill.quantity)
         a = 1
 
+    def update_from_basket_fill(self, fill):
+        """
+        获取一个BasketFillEvent，用向量运算一次更新所有股票的持仓数量、持仓成本、现金和手续费
+        """
+
+        quantity = np.asarray(fill.quantity, dtype=float)
+        fill_cost = fill.fill_cost
+        if fill_cost is None:
+            fill_cost = self.bars.get_latest_cross_section("close")
+        cost = quantity * fill_cost
+        commission = fill.commission * np.abs(cost).sum()
+        self.current_positions.values += quantity
+        self.current_holdings.values += cost
+        self.current_holdings['commission'] += commission
+        self.current_holdings['cash'] -= (cost.sum() + commission)
+
     def update_fill(self, event):
         """
-        在接收到FillEvent之后更新当前持仓和市值
+        在接收到FillEvent或BasketFillEvent之后更新当前持仓和市值
         """
 
         if event.type == 'FILL':
             self.update_positions_from_fill(event)
             self.update_holdings_from_fill(event)
+        elif event.type == 'BASKET_FILL':
+            self.update_from_basket_fill(event)
 
     @abstractmethod
     def generate_naive_order(self, signal, N=1):
         raise NotImplementedError("Should implement generate_naive_order()")
 
+    def generate_basket_order(self, signal):
+        """
+        根据目标权重向量生成一篮子订单：目标股数 = floor(组合价值 × 权重 / (价格 × (1 + 手续费率)))，
+        订单数量和方向都由目标股数与当前持仓之差决定。价格为0或权重为NaN的股票目标股数为0。
+        买入金额加上手续费超过现金与卖出所得（扣除手续费）之和时，按比例缩减买单，现金不会变成负数
+        """
+
+        price = np.asarray(signal.order_price, dtype=float)
+        weights = np.nan_to_num(np.asarray(signal.weights, dtype=float))
+        positions = self.current_positions.values
+        cash = self.current_holdings['cash']
+        rate = self.commission_rate
+        capital = cash + (positions * price).sum()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            target = np.where(price != 0, np.floor(capital * weights / (price * (1.0 + rate))), 0.0)
+        quantity = target - positions
+        if not quantity.any():
+            return None
+
+        value = quantity * price
+        buy = quantity > 0
+        available = cash - value[~buy].sum() * (1.0 - rate)
+        need = value[buy].sum() * (1.0 + rate)
+        if need > available:
+            quantity[buy] = np.floor(quantity[buy] * max(available, 0.0) / need)
+            target = positions + quantity
+
+        # 持仓方向不变、数量减少的是减仓，其余的数量变化是开仓或加仓（方向为数量变化的方向）
+        reduce = (np.sign(target) == np.sign(positions)) & (np.abs(target) < np.abs(positions))
+        direction = np.where(target == 0, 'EXIT',
+                             np.where(reduce, np.where(quantity < 0, 'SELL', 'BUY'),
+                                      np.where(quantity > 0, 'LONG', 'SHORT')))
+        return BasketOrderEvent(signal.date_time, self.symbol_list, 'MKT', quantity, price, direction)
+
     def update_signal(self, event):
         """
-        基于SignalEvent来生成新的订单，完成Portfolio的逻辑
+        基于SignalEvent或BasketSignalEvent来生成新的订单，完成Portfolio的逻辑
         """
         if event.type == 'SIGNAL':
             order_event = self.generate_naive_order(event, self.stock_num)
             self.events.put(order_event)
+        elif event.type == 'BASKET_SIGNAL':
+            self.events.put(self.generate_basket_order(event))
 
     def create_equity_curve_dataframe(self):
         """
         基于all_holdings创建一个pandas的DataFrame。
         """
 
-        curve = pd.DataFrame(self.all_holdings)
-        curve.set_index('datetime', inplace=True)
+        curve = self.all_holdings
         curve['returns'] = curve['total'].pct_change()
         curve['equity_curve'] = (1.0 + curve['returns']).cumprod()
-        self.equity_curve = curve
+        self._equity_curve = curve
+        return curve
 
-    def output_summary_stats(self):
+    @property
+    def equity_curve(self):
         """
-        Equity_summary
+        第一次访问或者有新的记录之后才重新生成DataFrame
         """
 
-        total_return = self.equity_curve['equity_curve'][-1]
-        returns = self.equity_curve['returns']
-        pnl = self.equity_curve['equity_curve']
+        if self._equity_curve is None or len(self._equity_curve) != self.ledger.size:
+            self.create_equity_curve_dataframe()
+        return self._equity_curve
 
-        sharpe_ratio = create_sharpe_ratio(returns)
-        drawdown, max_dd, dd_duration = create_drawdowns(pnl)
-        self.equity_curve['drawdown'] = drawdown
-
-        stats = [("Total Return", "%0.2f%%" % ((total_return - 1.0) * 100.0)),
-                 ("Sharpe Ratio", "%0.2f" % sharpe_ratio),
-                 ("Max Drawdown", "%0.2f%%" % (max_dd * 100)),
-                 ("Drawdown Duration", "%d" % dd_duration)]
+    def output_summary_stats(self):
+        """
+        Equity_summary
+        """
 
-        self.equity_curve.to_csv('equity.csv')
-        return stats
+        return create_summary_stats(self.equity_curve)
 
 
 
@@ -0,0 +1,170 @@
+# preprocess.py
+
+import hashlib
+import json
+import warnings
+
+import numpy as np
+
+'''
+因子的截面预处理：所有函数都作用在(日期 × 股票)矩阵上，每一行（同一天的所有股票）独立处理，
+NaN不参与统计。FactorPreprocessor在回测开始前对整个因子矩阵按
+去极值 -> 中性化 -> 标准化 -> 缺失值处理 的顺序处理一次，事件循环中只读取处理后的结果。
+'''
+
+NA_POLICIES = ('keep', 'median', 'mean', 'zero')
+
+MAD_SCALE = 1.4826  # 正态分布下MAD与标准差的比例
+NEUTRALIZE_BLOCK = 64  # 中性化时每批回归的日期数，限制设计矩阵的内存占用
+
+
+def _row_stat(func, values):
+    """
+    逐行计算统计量，整行都是NaN时结果为NaN（不产生警告）
+    """
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return func(values, axis=1, keepdims=True)
+
+
+def fill_na(values, policy='keep'):
+    """
+    缺失值处理：keep保留NaN（排序时排在最后），median/mean用当天的截面中位数/均值填充，zero填0
+    """
+
+    if policy not in NA_POLICIES:
+        raise ValueError("Unknown NaN policy %r, expected one of %s" % (policy, NA_POLICIES))
+    if policy == 'keep':
+        return values
+    if policy == 'zero':
+        fill = np.zeros((len(values), 1))
+    else:
+        fill = _row_stat(np.nanmedian if policy == 'median' else np.nanmean, values)
+    return np.where(np.isnan(values), fill, values)
+
+
+def winsorize_mad(values, n=5.0):
+    """
+    MAD去极值：把每天的因子值限制在 中位数 ± n × 1.4826 × MAD 之内
+    """
+
+    median = _row_stat(np.nanmedian, values)
+    mad = _row_stat(np.nanmedian, np.abs(values - median))
+    bound = n * MAD_SCALE * mad
+    return np.clip(values, median - bound, median + bound)
+
+
+def zscore(values):
+    """
+    标准化：每天减去截面均值再除以截面标准差，标准差为0时结果为0
+    """
+
+    mean = _row_stat(np.nanmean, values)
+    std = _row_stat(np.nanstd, values)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(std > 0, (values - mean) / std, np.where(np.isnan(values), np.nan, 0.0))
+
+
+def industry_dummies(symbols, industry):
+    """
+    由 股票 -> 行业 的映射生成(股票 × 行业)的哑变量矩阵，没有行业的股票整行为0
+    """
+
+    names = sorted(set(industry[s] for s in symbols if s in industry))
+    column = dict((name, k) for k, name in enumerate(names))
+    dummies = np.zeros((len(symbols), len(names)))
+    for j, s in enumerate(symbols):
+        if s in industry:
+            dummies[j, column[industry[s]]] = 1.0
+    return dummies
+
+
+def neutralize(values, dummies=None, size=None):
+    """
+    行业、市值中性化：每天用 因子 = 常数项 + 行业哑变量(股票 × 行业) + log(市值)(日期 × 股票) 做横截面回归，
+    返回残差。因子或解释变量缺失的股票不参与回归，残差为NaN。
+    法方程按日期批量求解，用伪逆处理行业哑变量与常数项的共线性
+    """
+
+    n_dates, n_symbols = values.shape
+    columns = [np.ones((n_symbols, 1))]
+    if dummies is not None:
+        columns.append(dummies)
+    static = np.concatenate(columns, axis=1)
+    if size is not None:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_size = np.where(size > 0, np.log(size), np.nan)
+
+    residual = np.full(values.shape, np.nan)
+    for start in range(0, n_dates, NEUTRALIZE_BLOCK):
+        stop = min(start + NEUTRALIZE_BLOCK, n_dates)
+        y = values[start:stop]
+        x = np.broadcast_to(static, (stop - start,) + static.shape)
+        if size is not None:
+            x = np.concatenate([x, log_size[start:stop, :, None]], axis=2)
+        valid = ~np.isnan(y) & ~np.isnan(x).any(axis=2)
+        xm = np.where(valid[:, :, None], x, 0.0)
+        ym = np.where(valid, y, 0.0)
+        xtx = np.einsum('tsk,tsl->tkl', xm, xm)
+        xty = np.einsum('tsk,ts->tk', xm, ym)
+        beta = np.einsum('tkl,tl->tk', np.linalg.pinv(xtx), xty)
+        fitted = np.einsum('tsk,tk->ts', np.nan_to_num(x), beta)
+        residual[start:stop] = np.where(valid, y - fitted, np.nan)
+    return residual
+
+
+class FactorPreprocessor(object):
+    """
+    因子截面预处理的配置：
+    winsorize为MAD去极值的倍数（None表示不去极值）；industry是 股票 -> 行业 的映射，
+    size是面板中市值字段的名称，指定其中之一时做中性化回归；standardize为True时做z-score标准化；
+    na是缺失值处理方式（见NA_POLICIES）。
+    transform对整个(日期 × 股票)因子矩阵一次完成所有步骤，通常通过
+    PanelDataHandler.preprocess_factor调用，结果作为新字段加入数据对象，并缓存在面板目录中
+    """
+
+    def __init__(self, na='keep', winsorize=None, standardize=False, industry=None, size=None):
+
+        if na not in NA_POLICIES:
+            raise ValueError("Unknown NaN policy %r, expected one of %s" % (na, NA_POLICIES))
+        self.na = na
+        self.winsorize = winsorize
+        self.standardize = standardize
+        self.industry = dict(industry) if industry is not None else None
+        self.size = size
+
+    def config(self):
+        """
+        可以写入JSON的配置，用作缓存的键
+        """
+
+        return {'na': self.na, 'winsorize': self.winsorize, 'standardize': self.standardize,
+                'industry': sorted((str(s), str(i)) for s, i in self.industry.items())
+                if self.industry is not None else None,
+                'size': self.size}
+
+    def field_name(self, factor):
+        """
+        处理后的因子在数据对象中的字段名
+        """
+
+        digest = hashlib.md5(json.dumps(self.config()).encode('utf-8')).hexdigest()[:8]
+        return '%s.%s' % (factor, digest)
+
+    def transform(self, values, symbols, size=None):
+        """
+        values是(日期 × 股票)因子矩阵，symbols是列对应的股票代码，size是self.size字段的(日期 × 股票)矩阵。
+        返回处理后的因子矩阵，不修改values
+        """
+
+        values = np.array(values, dtype=float)
+        if self.winsorize is not None:
+            values = winsorize_mad(values, self.winsorize)
+        if self.industry is not None or self.size is not None:
+            dummies = industry_dummies(symbols, self.industry) if self.industry is not None else None
+            size = np.asarray(size, dtype=float) if self.size is not None else None
+            values = neutralize(values, dummies, size)
+        if self.standardize:
+            values = zscore(values)
+        return fill_na(values, self.na)
@@ -0,0 +1,598 @@
+# store.py
+
+import contextlib
+import hashlib
+import io
+import json
+import os
+import os.path
+import re
+import shutil
+import zipfile
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+import numpy as np
+import pandas as pd
+
+from panel import PRICE_FIELDS, MarketPanel, build_panel, load_universe, read_factor_xlsx
+
+_ROW = re.compile(rb'<row[ >/]')
+
+
+def _window(size, window):
+    """
+    已经读入的size字节中用来校验的末尾字节数，window为None时校验全部
+    """
+
+    return size if window is None else min(size, window)
+
+
+def _csv_state(path, window=None):
+    """
+    记录行情CSV当前的大小（已经读入到的位置）、修改时间，以及已经读入部分最后window字节的md5，
+    用来判断文件是否只在末尾追加了新行
+    """
+
+    st = os.stat(path)
+    tail = _window(st.st_size, window)
+    with open(path, 'rb') as f:
+        f.seek(st.st_size - tail)
+        data = f.read(tail)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'tail_size': len(data),
+            'md5': hashlib.md5(data).hexdigest()}
+
+
+def _rows_digest(dates, columns, values):
+    """
+    因子XLSX中已经读入面板的行（按日期排序后的前若干行）的md5，覆盖日期、列名和所有数值
+    """
+
+    digest = hashlib.md5(json.dumps(list(columns)).encode('utf-8'))
+    digest.update(np.asarray(dates, dtype='U10').tobytes())
+    digest.update(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def _read_sheet(path):
+    """
+    读取因子XLSX的所有部件（解压后的字节），返回(工作表部件名, {部件名: 字节})；不是只有一个工作表时返回None
+    """
+
+    with zipfile.ZipFile(path) as z:
+        names = z.namelist()
+        sheets = [n for n in names if n.startswith('xl/worksheets/') and n.endswith('.xml')]
+        if len(sheets) != 1:
+            return None
+        return sheets[0], dict((n, z.read(n)) for n in names)
+
+
+def _sheet_rows(xml, start=None):
+    """
+    工作表XML中表头行的字节、第一个数据行的位置、数据行的起始位置（从start开始，默认为表头之后）和</sheetData>的位置；
+    格式不符时返回None
+    """
+
+    end = xml.rfind(b'</sheetData>')
+    first = _ROW.search(xml, 0, max(end, 0))
+    if end < 0 or first is None:
+        return None
+    close = xml.find(b'</row>', first.start(), end)
+    if close < 0:
+        return None
+    header = xml[first.start():close + len(b'</row>')]
+    data = close + len(b'</row>')
+    return header, data, [m.start() for m in _ROW.finditer(xml, data if start is None else start, end)], end
+
+
+def _tail_workbook(sheet, parts, offset):
+    """
+    只包含表头和offset之后的数据行的XLSX（内存中），交给read_factor_xlsx解析，不再解析已经读入的行。
+    去掉行号和单元格引用，行按顺序排列；去掉记录原来范围的dimension
+    """
+
+    xml = parts[sheet]
+    header, _, _, end = _sheet_rows(xml)
+    head = xml[:xml.find(b'<sheetData>') + len(b'<sheetData>')]
+    head = re.sub(rb'<dimension[^>]*/>', b'', head)
+    rows = re.sub(rb' r="[A-Z]*\d+"', b'', header + xml[offset:end])
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as z:
+        for name, data in parts.items():
+            z.writestr(name, head + rows + xml[end:] if name == sheet else data)
+    buf.seek(0)
+    return buf
+
+
+def _offset_state(path, header, data, xml, rows, last, offset, complete, window):
+    """
+    因子XLSX按工作表XML中的位置记录已经读入的行：offset是第一个没有读入的行的起始位置，
+    md5覆盖表头和offset之前（数据行范围内）的window字节。表头之前的部分（例如记录表格范围的dimension）追加新行时会变化，不校验
+    """
+
+    st = os.stat(path)
+    tail = _window(offset - data, window)
+    return {'size': st.st_size if complete else -1, 'mtime_ns': st.st_mtime_ns, 'rows': rows, 'last': last,
+            'offset': offset, 'tail_size': tail, 'md5': hashlib.md5(header + xml[offset - tail:offset]).hexdigest()}
+
+
+def _xlsx_state(path, f_dates, f_columns, f_values, rows, window=None):
+    """
+    rows是已经读入面板的行数，f_*是完整读取的因子（按日期排序）。文件中还有日期晚于面板最后一天、
+    暂时没有对应行情的行时size记为-1，下次更新时会重新读取这些行。
+    工作表中的行按日期顺序排列时记录第一个没有读入的行在工作表XML中的位置，以后只解析这个位置之后的行；
+    否则记录已读入的行的md5，以后完整读取
+    """
+
+    st = os.stat(path)
+    sheet = _read_sheet(path)
+    parsed = _sheet_rows(sheet[1][sheet[0]]) if sheet is not None else None
+    if parsed is not None and len(parsed[2]) == len(f_dates):
+        header, data, starts, end = parsed
+        offset = starts[rows] if rows < len(starts) else end
+        tail = read_factor_xlsx(_tail_workbook(sheet[0], sheet[1], offset), sort=False) \
+            if rows < len(starts) else None
+        # 没有读入的行就是工作表中最后的若干行，并且按日期顺序排列
+        if tail is None or list(tail[0]) == list(f_dates[rows:]):
+            return _offset_state(path, header, data, sheet[1][sheet[0]], rows, str(f_dates[rows - 1]) if rows else None,
+                                 offset, rows == len(f_dates), window)
+    return {'size': st.st_size if rows == len(f_dates) else -1, 'mtime_ns': st.st_mtime_ns, 'rows': rows,
+            'md5': _rows_digest(f_dates[:rows], f_columns, f_values[:rows])}
+
+
+def _consumed_rows(f_dates, last_date):
+    """
+    因子按日期左连接到面板上，日期晚于面板最后一天的行留到以后再读。XLSX中的行按日期顺序追加
+    """
+
+    return int(np.searchsorted(f_dates, last_date, side='right'))
+
+
+def _unchanged(path, state):
+
+    st = os.stat(path)
+    return st.st_size == state['size'] and st.st_mtime_ns == state['mtime_ns']
+
+
+def read_price_delta(path, state, window=None):
+    """
+    只读取行情CSV在state记录的位置之后追加的字节，返回(新的state, 日期数组, 数值矩阵)。
+    已经读入的部分只校验最后window字节（state['tail_size']）的md5，不再读取整个文件；
+    校验不通过（原有内容被修改或者文件被截短），或者原来的最后一行没有换行符时返回None，需要重建
+    """
+
+    if 'tail_size' not in state:
+        return None
+    with open(path, 'rb') as f:
+        f.seek(state['size'] - state['tail_size'])
+        tail = f.read(state['tail_size'])
+        if len(tail) != state['tail_size'] or hashlib.md5(tail).hexdigest() != state['md5'] \
+                or not tail.endswith(b'\n'):
+            return None
+        data = f.read()
+    st = os.stat(path)
+    if not data:
+        return dict(state, mtime_ns=st.st_mtime_ns), np.empty(0, dtype=str), np.empty((0, len(PRICE_FIELDS)))
+
+    df = pd.read_csv(io.BytesIO(data), header=None, index_col=0,
+                     names=['datetime'] + PRICE_FIELDS).sort_index()
+    tail = tail + data
+    tail = tail[len(tail) - _window(len(tail), window):]
+    new_state = {'size': state['size'] + len(data), 'mtime_ns': st.st_mtime_ns, 'tail_size': len(tail),
+                 'md5': hashlib.md5(tail).hexdigest()}
+    return new_state, np.asarray(df.index.astype(str), dtype=str), df.to_numpy(dtype=float)
+
+
+def read_factor_delta(path, state, window=None):
+    """
+    读取因子XLSX中还没有读入面板的行，返回(日期数组, 因子列名, 数值矩阵, advance)，advance(n)返回读入其中前n行之后的state。
+    state记录了工作表XML中的位置时只解析这个位置之后的行（工作表仍需解压），并校验表头和这个位置之前window字节的md5；
+    否则完整读取，校验已经读入的行的md5。
+    已经读入面板的行被修改、删除，或者新行插入到原有日期之间时返回None，需要重建
+    """
+
+    rows = state['rows']
+    if state.get('offset') is None:
+        f_dates, f_columns, f_values = read_factor_xlsx(path)
+        if 'md5' not in state or rows > len(f_dates) \
+                or _rows_digest(f_dates[:rows], f_columns, f_values[:rows]) != state['md5']:
+            return None
+
+        def advance(n):
+            return _xlsx_state(path, f_dates, f_columns, f_values, rows + n, window)
+
+        return f_dates[rows:], f_columns, f_values[rows:], advance
+
+    sheet = _read_sheet(path)
+    parsed = _sheet_rows(sheet[1][sheet[0]], state['offset']) if sheet is not None else None
+    if parsed is None:
+        return None
+    xml = sheet[1][sheet[0]]
+    header, data, starts, end = parsed
+    offset, tail = state['offset'], state['tail_size']
+    if offset > end or offset - tail < data or (starts[:1] or [end])[0] != offset \
+            or hashlib.md5(header + xml[offset - tail:offset]).hexdigest() != state['md5']:
+        return None
+    f_dates, f_columns, f_values = read_factor_xlsx(_tail_workbook(sheet[0], sheet[1], offset), sort=False)
+    if len(f_dates) != len(starts) or (len(f_dates) and state['last'] is not None and f_dates[0] <= state['last']) \
+            or (f_dates[1:] < f_dates[:-1]).any():
+        # 新行的日期不在已经读入的行之后，或者没有按日期顺序追加
+        return None
+
+    def advance(n):
+        return _offset_state(path, header, data, xml, rows + n, str(f_dates[n - 1]) if n else state['last'],
+                             starts[n] if n < len(starts) else end, n == len(starts), window)
+
+    return f_dates, f_columns, f_values, advance
+
+
+class PanelStore(object):
+    """
+    PanelStore把对齐后的完整面板保存在磁盘上：values.<n>.bin是按C顺序存放的(日期 × 股票 × 字段)float64数组，
+    meta.json记录当前的数据文件、日期、股票、字段，以及每个源文件已经读取到的位置。
+    数据文件中已经写入meta.json的部分不再修改：新增的行追加到数据文件末尾，之后再用os.replace替换meta.json，
+    其他进程按原来的meta打开或内存映射的部分内容不变；新增的因子值落在原有的行上或者重建时写一个新的数据文件（第n+1代）。
+    update持有store_dir/lock的排他锁，多个进程依次更新。
+    每天行情CSV和因子XLSX末尾追加新行后，update只读取、对齐新增的部分并追加到面板中：行情CSV从上次读到的位置读取，
+    因子XLSX只解析上次读到的行之后的行，已经读入的部分用md5校验最后VERIFY_BYTES字节，更新的耗时与新增的数据量成正比。
+    源文件有其他修改、股票列表或字段变化时完整重建。
+    """
+
+    REBUILD_SYMBOLS = 256  # 重建时每批读取的股票数
+    VERIFY_BYTES = 1 << 16  # 校验每个源文件已经读入部分的最后多少字节，None表示校验全部（每次更新都要读取整个文件）
+
+    def __init__(self, store_dir):
+
+        self.store_dir = store_dir
+        self.meta_path = os.path.join(store_dir, 'meta.json')
+        self.lock_path = os.path.join(store_dir, 'lock')
+        self.values_path = None  # 最近一次打开的数据文件，见open
+        self.values_rows = None  # 最近一次打开的面板的行数，数据文件末尾可能还有之后追加的行
+
+    def _values_path(self, meta):
+
+        return os.path.join(self.store_dir, meta.get('values', 'values.bin'))
+
+    def _next_values(self, meta):
+        """
+        下一代数据文件的文件名和代数
+        """
+
+        generation = meta.get('generation', 0) + 1 if meta is not None else 0
+        return 'values.%d.bin' % generation, generation
+
+    def _remove_values(self, current):
+        """
+        新的meta写入后删除上一代数据文件。已经打开这个文件的进程仍然可以读取，直到关闭为止；
+        文件被占用不能删除时（Windows）保留，下次更新时再删除
+        """
+
+        for name in os.listdir(self.store_dir):
+            if name.startswith('values.') and name.endswith('.bin') and name != current:
+                try:
+                    os.remove(os.path.join(self.store_dir, name))
+                except OSError:
+                    pass
+
+    @contextlib.contextmanager
+    def _lock(self):
+        """
+        持有store_dir/lock的排他锁，同时更新同一个面板的多个进程依次进行
+        """
+
+        os.makedirs(self.store_dir, exist_ok=True)
+        with open(self.lock_path, 'a+b') as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+    @classmethod
+    def for_universe(cls, cache_dir, stock_csv_dir, factor_csv_dir, symbol_list):
+        """
+        cache_dir下每组 数据路径 + 股票列表 对应一个面板目录
+        """
+
+        key = json.dumps([os.path.abspath(stock_csv_dir), os.path.abspath(factor_csv_dir), list(symbol_list)])
+        digest = hashlib.md5(key.encode('utf-8')).hexdigest()[:12]
+        return cls(os.path.join(cache_dir, 'panel.%s' % digest))
+
+    def read_meta(self):
+
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, meta):
+        """
+        数据文件写完后再用os.replace写入meta.json，读到的meta总是对应完整的数据
+        """
+
+        tmp = '%s.%d.tmp' % (self.meta_path, os.getpid())
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(tmp, self.meta_path)
+
+    @staticmethod
+    def _shape(meta):
+
+        return len(meta['dates']), len(meta['symbols']), len(meta['fields'])
+
+    def open(self, meta=None, mmap=False):
+        """
+        返回MarketPanel。mmap为True时以只读内存映射的方式打开，不把数据读入进程内存，
+        同一台机器上的多个回测进程通过操作系统的页缓存共享同一份物理内存
+        """
+
+        if meta is None:
+            meta = self.read_meta()
+        shape = self._shape(meta)
+        self.values_path = self._values_path(meta)
+        self.values_rows = shape[0]
+        if mmap:
+            values = np.memmap(self.values_path, dtype=np.float64, mode='r', shape=shape)
+        else:
+            values = np.fromfile(self.values_path, dtype=np.float64, count=int(np.prod(shape))).reshape(shape)
+        return MarketPanel(np.asarray(meta['dates'], dtype=str), meta['symbols'], meta['fields'], values)
+
+    def rebuild(self, stock_csv_dir, factor_csv_dir, symbol_list, cache_dir=None, workers=1):
+        """
+        完整读取所有源文件，重新生成面板，返回新的meta。
+        股票按每批REBUILD_SYMBOLS支分批读取：第一遍只收集日期并集和因子列，第二遍逐批对齐后
+        写入新数据文件的对应列，内存中最多只有一批股票的数据，股票池再大也不会一次读入全部历史
+        """
+
+        os.makedirs(self.store_dir, exist_ok=True)
+        name, generation = self._next_values(self.read_meta())
+        symbol_list = list(symbol_list)
+        blocks = [symbol_list[i:i + self.REBUILD_SYMBOLS] for i in range(0, len(symbol_list), self.REBUILD_SYMBOLS)]
+
+        date_parts = []
+        factor_fields = []
+        for block in blocks:
+            price_data, factor_data = load_universe(stock_csv_dir, factor_csv_dir, block, cache_dir, workers)
+            date_parts.append(np.unique(np.concatenate([price_data[s][0] for s in block])))
+            for s in block:
+                for c in factor_data[s][1]:
+                    if c not in factor_fields:
+                        factor_fields.append(c)
+        dates = np.unique(np.concatenate(date_parts))
+        fields = PRICE_FIELDS + factor_fields + ['Pct_change']
+
+        path = os.path.join(self.store_dir, name)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        values = np.memmap(tmp, dtype=np.float64, mode='w+', shape=(len(dates), len(symbol_list), len(fields)))
+        sources = {}
+        start = 0
+        for block in blocks:
+            price_data, factor_data = load_universe(stock_csv_dir, factor_csv_dir, block, cache_dir, workers)
+            part = build_panel(block, price_data, factor_data, None, dates, factor_fields)
+            values[:, start:start + len(block)] = part.values
+            start += len(block)
+            for s in block:
+                f_dates, f_columns, f_values = factor_data[s]
+                sources[s] = {'price': _csv_state(os.path.join(stock_csv_dir, '%s.csv' % s), self.VERIFY_BYTES),
+                              'factor': _xlsx_state(os.path.join(factor_csv_dir, '%s.xlsx' % s), f_dates, f_columns,
+                                                    f_values, _consumed_rows(f_dates, dates[-1]), self.VERIFY_BYTES)}
+        values.flush()
+        del values
+        os.replace(tmp, path)
+
+        meta = {'stock_csv_dir': os.path.abspath(stock_csv_dir), 'factor_csv_dir': os.path.abspath(factor_csv_dir),
+                'symbols': symbol_list, 'fields': fields, 'dates': [str(d) for d in dates],
+                'sources': sources, 'values': name, 'generation': generation}
+        self._write_meta(meta)
+        self._remove_values(name)
+        return meta
+
+    def _read_deltas(self, meta, stock_csv_dir, factor_csv_dir):
+        """
+        读取所有源文件的新增部分，返回(price_delta, factor_delta, sources)；需要重建时返回None
+        """
+
+        price_delta = {}
+        factor_delta = {}
+        sources = {}
+        for s in meta['symbols']:
+            state = meta['sources'][s]
+            price_path = os.path.join(stock_csv_dir, '%s.csv' % s)
+            factor_path = os.path.join(factor_csv_dir, '%s.xlsx' % s)
+            sources[s] = dict(state)
+
+            if not _unchanged(price_path, state['price']):
+                delta = read_price_delta(price_path, state['price'], self.VERIFY_BYTES)
+                if delta is None:
+                    return None
+                sources[s]['price'], p_dates, p_values = delta
+                if len(p_dates):
+                    price_delta[s] = (p_dates, p_values)
+
+            if not _unchanged(factor_path, state['factor']):
+                delta = read_factor_delta(factor_path, state['factor'], self.VERIFY_BYTES)
+                if delta is None or not set(delta[1]) <= set(meta['fields']):
+                    return None
+                factor_delta[s] = delta
+
+        return price_delta, factor_delta, sources
+
+    def _append(self, meta, price_delta, factor_delta, sources):
+        """
+        把新增的行追加到数据文件末尾并写入新增的因子值，返回新的meta；新增行情的日期不在原有日期之后时返回None。
+        只写入新增的部分，耗时与数据文件的大小无关。数据文件中原有的行不会被修改：
+        新增的因子值落在原有的行上时，先把数据文件复制为下一代再写入
+        """
+
+        old_dates = np.asarray(meta['dates'], dtype=str)
+        n_old, n_symbols, n_fields = self._shape(meta)
+        symbol_index = dict((s, j) for j, s in enumerate(meta['symbols']))
+        field_index = dict((f, k) for k, f in enumerate(meta['fields']))
+        n_price = len(PRICE_FIELDS)
+
+        new_dates = np.unique(np.concatenate([d for d, _ in price_delta.values()] + [np.empty(0, dtype=str)]))
+        if n_old and len(new_dates) and new_dates[0] <= old_dates[-1]:
+            return None
+        dates = np.concatenate([old_dates, new_dates])
+        n_new = len(new_dates)
+
+        current = self._values_path(meta)
+        last = np.array(np.memmap(current, dtype=np.float64, mode='r', shape=(n_old, n_symbols, n_fields))[-1]) \
+            if n_old else np.full((n_symbols, n_fields), np.nan)
+        block = np.full((n_new, n_symbols, n_fields), np.nan)
+        present = np.zeros((n_new, n_symbols), dtype=bool)
+
+        for s, (p_dates, p_values) in price_delta.items():
+            rows = np.searchsorted(new_dates, p_dates)
+            block[rows, symbol_index[s], :n_price] = p_values
+            present[rows, symbol_index[s]] = True
+
+        # 新增的行情按每支股票最近一次出现的日期向前填充，新增部分之前的数据从面板最后一行接续
+        last_seen = np.where(present, np.arange(n_new)[:, None], -1)
+        np.maximum.accumulate(last_seen, axis=0, out=last_seen)
+        prices = block[np.maximum(last_seen, 0), np.arange(n_symbols)[None, :], :n_price]
+        prices = np.where((last_seen < 0)[:, :, None], last[None, :, :n_price], prices)
+        block[:, :, :n_price] = np.nan_to_num(prices, nan=0.0)
+
+        # 因子按日期左连接，只写入上次之后新增、日期不晚于面板最后一天的行，日期落在原有部分时写入原有的行
+        old_writes = []
+        for s, (f_dates, f_columns, f_values, advance) in factor_delta.items():
+            rows = _consumed_rows(f_dates, dates[-1])
+            sources[s]['factor'] = advance(rows)
+            f_dates, f_values = f_dates[:rows], f_values[:rows]
+            pos = np.searchsorted(dates, f_dates)
+            hit = (pos < len(dates)) & (dates[np.minimum(pos, len(dates) - 1)] == f_dates)
+            cols = [field_index[c] for c in f_columns]
+            j = symbol_index[s]
+            in_old = hit & (pos < n_old)
+            in_new = hit & (pos >= n_old)
+            if in_old.any():
+                old_writes.append((pos[in_old], j, cols, f_values[in_old]))
+            block[np.ix_(pos[in_new] - n_old, [j], cols)] = f_values[in_new][:, None, :]
+
+        if n_new:
+            close = block[:, :, field_index['close']]
+            prev_close = np.concatenate([last[None, :, field_index['close']], close[:-1]])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                block[:, :, field_index['Pct_change']] = close / prev_close - 1.0
+
+        size = n_old * n_symbols * n_fields * 8
+        if old_writes:
+            name, generation = self._next_values(meta)
+            path = os.path.join(self.store_dir, name)
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            shutil.copyfile(current, tmp)
+            with open(tmp, 'r+b') as f:
+                f.truncate(size)
+            old = np.memmap(tmp, dtype=np.float64, mode='r+', shape=(n_old, n_symbols, n_fields))
+            for pos, j, cols, values in old_writes:
+                old[np.ix_(pos, [j], cols)] = values[:, None, :]
+            old.flush()
+            del old
+        else:
+            # 新增的行写在当前数据文件的末尾，meta.json替换之前其他进程不会读到
+            name, generation = os.path.basename(current), meta.get('generation', 0)
+            path = tmp = current
+        with open(tmp, 'r+b') as f:
+            f.truncate(size)  # 去掉上次中断的追加留下的数据
+            f.seek(size)
+            f.write(block.tobytes())
+        if tmp != path:
+            os.replace(tmp, path)
+
+        meta = dict(meta, dates=[str(d) for d in dates], sources=sources, values=name, generation=generation)
+        self._write_meta(meta)
+        self._remove_values(name)
+        return meta
+
+    def update(self, stock_csv_dir, factor_csv_dir, symbol_list, cache_dir=None, workers=1, mmap=False):
+        """
+        把源文件的新增行写入面板并返回完整的MarketPanel。没有可用的面板，或者不能增量更新时完整重建。
+        mmap为True时返回只读内存映射的面板。整个过程持有面板目录的锁
+        """
+
+        with self._lock():
+            return self._update(stock_csv_dir, factor_csv_dir, symbol_list, cache_dir, workers, mmap)
+
+    def _update(self, stock_csv_dir, factor_csv_dir, symbol_list, cache_dir, workers, mmap):
+
+        meta = self.read_meta()
+        if meta is None or meta['symbols'] != list(symbol_list) \
+                or meta['stock_csv_dir'] != os.path.abspath(stock_csv_dir) \
+                or meta['factor_csv_dir'] != os.path.abspath(factor_csv_dir):
+            return self._rebuild_and_open(stock_csv_dir, factor_csv_dir, symbol_list, cache_dir, workers, mmap)
+
+        deltas = self._read_deltas(meta, stock_csv_dir, factor_csv_dir)
+        if deltas is None:
+            return self._rebuild_and_open(stock_csv_dir, factor_csv_dir, symbol_list, cache_dir, workers, mmap)
+        price_delta, factor_delta, sources = deltas
+        if price_delta or factor_delta:
+            meta = self._append(meta, price_delta, factor_delta, sources)
+            if meta is None:
+                return self._rebuild_and_open(stock_csv_dir, factor_csv_dir, symbol_list, cache_dir, workers, mmap)
+        elif sources != meta['sources']:
+            # 只有修改时间变化，没有新增数据
+            meta = dict(meta, sources=sources)
+            self._write_meta(meta)
+        return self.open(meta, mmap)
+
+    def derived(self, key, compute, mmap=False, shape=None):
+        """
+        与面板一起缓存的派生数组，例如预处理后的因子矩阵。key是描述计算方法、可以写入JSON的对象，
+        compute()返回数组。缓存对应这个PanelStore最近一次open的数据文件（调用者正在使用的面板），
+        不是meta.json中最新的数据文件：其他进程在两次调用之间追加了新行时，不会读到另一代面板的结果。
+        面板文件变化（追加新行或重建）或者缓存的形状不等于shape时重新计算，否则直接读取缓存
+        """
+
+        digest = hashlib.md5(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+        path = os.path.join(self.store_dir, 'derived.%s.npy' % digest)
+        state_path = os.path.join(self.store_dir, 'derived.%s.json' % digest)
+        if self.values_path is None:
+            meta = self.read_meta()
+            values_path, rows = self._values_path(meta), len(meta['dates'])
+        else:
+            values_path, rows = self.values_path, self.values_rows
+        try:
+            st = os.stat(values_path)
+        except OSError:
+            # 打开的数据文件已经被新的一代替换并删除，结果不再写入缓存
+            return compute()
+        # 数据文件只在末尾追加新行，原有的行不变：用文件（重建时是新文件）和打开时的行数确定面板
+        state = {'key': key, 'values': os.path.basename(values_path), 'values_ino': st.st_ino, 'values_rows': rows}
+
+        try:
+            with open(state_path, 'r', encoding='utf-8') as f:
+                if json.load(f) == json.loads(json.dumps(state)):
+                    values = np.load(path, mmap_mode='r' if mmap else None)
+                    if shape is None or values.shape == tuple(shape):
+                        return values
+        except (OSError, ValueError):
+            pass
+
+        values = compute()
+        tmp = '%s.%d.tmp.npy' % (path[:-4], os.getpid())
+        np.save(tmp, values)
+        os.replace(tmp, path)
+        tmp = '%s.%d.tmp' % (state_path, os.getpid())
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp, state_path)
+        return values
+
+    def _rebuild_and_open(self, stock_csv_dir, factor_csv_dir, symbol_list, cache_dir, workers, mmap):
+
+        meta = self.rebuild(stock_csv_dir, factor_csv_dir, symbol_list, cache_dir, workers)
+        return self.open(meta, mmap)
@@ -18,6 +18,11 @@ class Strategy(object, metaclass=ABCMeta):
     数据队列当中
     """
 
+    # 计算信号需要的最近数据条目数（含当前条目），流式读取的数据对象只保留这么多历史。
+    # 也可以按字段声明，例如{'close': 20}，数据对象为这些字段维护环形缓冲区，
+    # get_latest_bars_values(s, 'close', N)直接返回缓冲区中连续的视图
+    lookback = 1
+
     @abstractmethod
     def calculate_signals(self, event):
         """
@@ -26,6 +31,15 @@ class Strategy(object, metaclass=ABCMeta):
 
         raise NotImplementedError("Should implement calculate_signals()")
 
+    def next_control(self, start):
+        """
+        返回第start个数据条目及之后，策略下一次需要处理MarketEvent的数据条目下标，默认为下一个调仓点。
+        策略可以覆盖这个函数加入价格触发条件，例如用bars.first_crossing找到止损价被触发的日期。
+        两个控制点之间回测引擎不发出事件，只对组合做向量化的逐日市值结算
+        """
+
+        return self.bars.next_rebalance(start)
+
 
 class BuyAndHoldStrategy(Strategy):
 
@@ -0,0 +1,125 @@
+# sweep.py
+
+import itertools
+import os
+import os.path
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from panel import MarketPanel, load_panel
+from store import PanelStore
+from performance import equity_by_date, summary_table
+from vectorized import VectorizedFactorTest
+
+_shared_panel = None
+
+
+def _open_shared_panel(path, dates, symbols, fields):
+    """
+    子进程初始化：以只读内存映射的方式打开主进程写出的面板数组，各进程共享同一份物理内存
+    """
+
+    global _shared_panel
+    _shared_panel = MarketPanel(dates, symbols, fields, np.load(path, mmap_mode='r'))
+
+
+def _open_shared_store(path, offset, shape, dates, symbols, fields):
+    """
+    子进程初始化：以只读内存映射的方式直接打开主进程使用的PanelStore数据文件。
+    文件、起始位置和形状由主进程给出，子进程不再读取meta.json，所有子进程与主进程使用同一代面板
+    """
+
+    global _shared_panel
+    values = np.memmap(path, dtype=np.float64, mode='r', offset=offset, shape=shape)
+    _shared_panel = MarketPanel(dates, symbols, fields, values)
+
+
+def _run_config(config, initial_capital, panel=None):
+    """
+    在共享面板上运行一组参数，每一层返回一行汇总统计
+    """
+
+    if panel is None:
+        panel = _shared_panel
+    if config['start_date'] is not None:
+        panel = panel.since(config['start_date'])
+
+    test = VectorizedFactorTest(panel, config['factor'], config['stock_num'], config['layer'], initial_capital)
+    layers = [config['cur_layer']] if config['cur_layer'] is not None else range(config['layer'])
+    rows = []
+    for cur_layer in layers:
+        test.run(cur_layer)
+        row = dict(config, cur_layer=cur_layer)
+        row.update(summary_table(equity_by_date(test.equity_curve)).iloc[0].to_dict())
+        rows.append(row)
+    return rows
+
+
+class ParameterSweep(object):
+    """
+    ParameterSweep只读取一次数据，然后在进程池中对 因子 × 持股数 × 分层 × 开始日期 的参数网格
+    运行向量化的因子测试（规则与FactorTest相同），返回每组参数一行汇总统计的表格。
+    数据以内存映射的方式共享给子进程，不会在每个进程中复制一份：指定cache_dir时直接映射PanelStore的面板文件，
+    否则先写出一个临时的.npy文件。
+    """
+
+    def __init__(self, stock_csv_dir, factor_csv_dir, symbol_list, initial_capital, start_date,
+                 cache_dir=None, workers=1):
+
+        self.initial_capital = initial_capital
+        self.workers = workers
+        self.start_date = start_date.strftime("%Y-%m-%d")
+        self.values_path = None  # 面板来自PanelStore时为本次使用的数据文件，values_offset为回测第一天在其中的字节位置
+        self.values_offset = 0
+        if cache_dir is None:
+            self.panel = load_panel(stock_csv_dir, factor_csv_dir, symbol_list, self.start_date, workers=workers)
+        else:
+            store = PanelStore.for_universe(cache_dir, stock_csv_dir, factor_csv_dir, symbol_list)
+            full = store.update(stock_csv_dir, factor_csv_dir, symbol_list, cache_dir, workers, mmap=True)
+            self.panel = full.since(self.start_date)
+            self.values_path = store.values_path
+            self.values_offset = (len(full) - len(self.panel)) * int(np.prod(full.values.shape[1:])) * 8
+
+    @staticmethod
+    def _expand_grid(grid):
+        """
+        grid是 参数名 -> 取值列表 的字典，可用参数为factor、stock_num、layer、cur_layer、start_date，
+        没有给出cur_layer时测试所有层
+        """
+
+        grid = dict(grid)
+        grid.setdefault('layer', [1])
+        grid.setdefault('cur_layer', [None])
+        grid.setdefault('start_date', [None])
+        grid['start_date'] = [d.strftime("%Y-%m-%d") if hasattr(d, 'strftime') else d for d in grid['start_date']]
+        keys = list(grid)
+        return [dict(zip(keys, values)) for values in itertools.product(*[grid[k] for k in keys])]
+
+    def run(self, grid):
+
+        configs = self._expand_grid(grid)
+        if self.workers is None or self.workers <= 1:
+            results = [_run_config(config, self.initial_capital, self.panel) for config in configs]
+        elif self.values_path is not None:
+            panel = self.panel
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=_open_shared_store,
+                                     initargs=(self.values_path, self.values_offset, panel.values.shape, panel.dates,
+                                               panel.symbols, panel.fields)) as pool:
+                results = list(pool.map(_run_config, configs, [self.initial_capital] * len(configs)))
+        else:
+            tmp_dir = tempfile.mkdtemp(prefix='sweep_')
+            try:
+                path = os.path.join(tmp_dir, 'values.npy')
+                np.save(path, self.panel.values)
+                with ProcessPoolExecutor(max_workers=self.workers, initializer=_open_shared_panel,
+                                         initargs=(path, self.panel.dates, self.panel.symbols,
+                                                   self.panel.fields)) as pool:
+                    results = list(pool.map(_run_config, configs, [self.initial_capital] * len(configs)))
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        return pd.DataFrame([row for rows in results for row in rows])
@@ -1,4 +1,5 @@
 import datetime
+import logging
 import math
 import os
 import matplotlib.pyplot as plt
@@ -7,10 +8,9 @@ import pandas as pd
 
 from event import OrderEvent
 from backtest import Backtest
-from data import HistoricCSVDataHandler
+from data import PanelDataHandler
 from execution import SimulatedExecutionHandler
 from portfolio import Portfolio
-from Moving_average_cross_strategy import MovingAverageCrossStrategy
 from Test_strategy import TestStrategy
 from factor_test import FactorTest
 
@@ -46,12 +46,14 @@ class MyPortfolio(Portfolio):
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
     start_time = time.process_time()
     path1 = os.path.abspath('.')
     stock_csv_dir = 'stock_price'
     stock_csv_dir = os.path.join(path1, stock_csv_dir)
     factor_csv_dir = 'factors'
     factor_csv_dir = os.path.join(path1, factor_csv_dir)
+    cache_dir = os.path.join(path1, 'cache')  # 解析后的数据缓存，源文件修改后自动失效
     symbol_list = os.listdir(stock_csv_dir)
     for i in range(len(symbol_list)):
         symbol_list[i] = symbol_list[i].replace('.csv', '')
@@ -62,14 +64,14 @@ if __name__ == "__main__":
     start_date = datetime.datetime(2018, 10, 31, 0, 0, 0)
     factor = 'PE'
     layer = 1
-    equity_curve = pd.DataFrame
+    workers = os.cpu_count()  # 读取数据的进程数
     factortest = FactorTest(stock_csv_dir, factor_csv_dir, symbol_list, initial_capital, stock_num / layer,
                             heartbeat, start_date, factor, layer,  # cur_layer,
-                            data_handler_cls=HistoricCSVDataHandler, execution_handler_cls=SimulatedExecutionHandler,
-                            portfolio_cls=MyPortfolio, strategy_cls=TestStrategy
+                            data_handler_cls=PanelDataHandler, execution_handler_cls=SimulatedExecutionHandler,
+                            portfolio_cls=MyPortfolio, strategy_cls=TestStrategy, cache_dir=cache_dir,
+                            workers=workers
                             )
-    factortest.run_trading()
-    # equity_curve[('layer %s' % cur_layer)] = factortest.factor_equity_curve()
+    equity_curve = factortest.run_trading()  # 层 × 日期 的净值矩阵
 
     plt.show()
     end_time = time.process_time()
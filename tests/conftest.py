@@ -0,0 +1,39 @@
+import os
+import shutil
+import sys
+
+# 模块都在仓库根目录下
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+import pandas as pd
+import pytest
+
+from benchmark import generate_market
+
+N_SYMBOLS = 30
+N_DAYS = 160
+
+
+@pytest.fixture(scope='session')
+def market(tmp_path_factory):
+    """
+    模拟行情和因子数据：返回数据目录、股票代码列表和回测开始日期
+    """
+
+    data_dir = str(tmp_path_factory.mktemp('market'))
+    symbol_list = generate_market(data_dir, N_SYMBOLS, N_DAYS)
+    start_date = pd.bdate_range('2018-01-01', periods=N_DAYS)[21].to_pydatetime()
+    return data_dir, symbol_list, start_date
+
+
+@pytest.fixture
+def source(market, tmp_path):
+    """
+    模拟数据的副本，测试中会修改源文件：返回行情目录、因子目录、股票代码列表和cache_dir
+    """
+
+    data_dir, symbol_list, _ = market
+    shutil.copytree(os.path.join(data_dir, 'stock_price'), str(tmp_path / 'stock_price'))
+    shutil.copytree(os.path.join(data_dir, 'factors'), str(tmp_path / 'factors'))
+    return str(tmp_path / 'stock_price'), str(tmp_path / 'factors'), symbol_list, str(tmp_path / 'cache')
@@ -0,0 +1,88 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from analytics import FactorAnalysis
+from data import PanelDataHandler
+from event import EventBus
+from preprocess import FactorPreprocessor
+
+
+def _analysis(market):
+    data_dir, symbol_list, start_date = market
+    handler = PanelDataHandler(EventBus(), os.path.join(data_dir, 'stock_price'), os.path.join(data_dir, 'factors'),
+                               'PE', start_date, symbol_list)
+    return handler, FactorAnalysis(handler)
+
+
+def _frames(handler, factor, horizon):
+    index = pd.Index(handler.panel.dates)
+    close = pd.DataFrame(np.asarray(handler.field('close'), dtype=float), index=index, columns=handler.panel.symbols)
+    close = close.where(close > 0)
+    returns = close.shift(-horizon) / close - 1.0
+    values = pd.DataFrame(np.asarray(handler.field(factor), dtype=float), index=index, columns=handler.panel.symbols)
+    return values, returns
+
+
+def _daily_corr(values, returns, method):
+    # 逐日用pandas计算截面相关系数作为参照
+    result = []
+    for date in values.index:
+        pair = pd.DataFrame({'f': values.loc[date], 'r': returns.loc[date]}).dropna()
+        if method == 'spearman':
+            pair = pair.rank()
+        result.append(pair['f'].corr(pair['r']) if len(pair) >= 3 else np.nan)
+    return np.array(result)
+
+
+def test_ic_and_rank_ic_match_daily_correlation(market):
+    handler, analysis = _analysis(market)
+    for horizon in (1, 5):
+        values, returns = _frames(handler, 'PE', horizon)
+        np.testing.assert_allclose(analysis.ic('PE', horizon).to_numpy(),
+                                   _daily_corr(values, returns, 'pearson'), rtol=1e-9, atol=1e-12)
+        np.testing.assert_allclose(analysis.ic('PE', horizon, rank=True).to_numpy(),
+                                   _daily_corr(values, returns, 'spearman'), rtol=1e-9, atol=1e-12)
+        assert np.isnan(analysis.ic('PE', horizon).to_numpy()[-horizon:]).all()
+
+
+def test_ic_decay_uses_each_horizon(market):
+    handler, analysis = _analysis(market)
+    decay = analysis.ic_decay('PE', horizons=(1, 5, 20))
+    for horizon in (1, 5, 20):
+        ic = analysis.ic('PE', horizon).to_numpy()
+        assert np.isclose(decay.loc[horizon, 'ic_mean'], np.nanmean(ic))
+
+
+def test_autocorrelation_matches_lagged_rank_correlation(market):
+    handler, analysis = _analysis(market)
+    values, _ = _frames(handler, 'PE', 1)
+    ranks = values.rank(axis=1)
+    expected = _daily_corr(ranks, ranks.shift(2), 'pearson')
+    np.testing.assert_allclose(analysis.autocorrelation('PE', lag=2).to_numpy(), expected, rtol=1e-9, atol=1e-12)
+
+
+def test_quantile_returns_match_groupby(market):
+    handler, analysis = _analysis(market)
+    values, returns = _frames(handler, 'PE', 1)
+    result = analysis.quantile_returns('PE', quantiles=5)
+    for i in range(0, len(values) - 1, 17):
+        factor, ret = values.iloc[i], returns.iloc[i]
+        valid = factor.notna()
+        labels = np.floor((factor[valid].rank() - 1) * 5 / valid.sum()).astype(int)
+        expected = ret[valid].groupby(labels).mean().reindex(range(5))
+        np.testing.assert_allclose(result.iloc[i].to_numpy(), expected.to_numpy(), rtol=1e-12)
+
+
+def test_analysis_of_combined_and_neutralized_fields(market):
+    handler, analysis = _analysis(market)
+    combined = handler.combine_factors({'PE': 1, 'PB': -0.5})
+    industry = {symbol: 'I%d' % (i % 3) for i, symbol in enumerate(handler.panel.symbols)}
+    preprocessor = FactorPreprocessor(winsorize=3.0, standardize=True, industry=industry)
+    neutralized = handler.preprocess_factor(preprocessor, factor='PB')
+    summary = analysis.summary([combined, neutralized])
+    for name in (combined, neutralized):
+        values, returns = _frames(handler, name, 1)
+        assert np.isclose(summary.loc[name, 'ic_mean'], np.nanmean(_daily_corr(values, returns, 'pearson')))
+        assert np.isclose(summary.loc[name, 'rank_ic_mean'], np.nanmean(_daily_corr(values, returns, 'spearman')))
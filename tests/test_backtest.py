@@ -0,0 +1,43 @@
+import functools
+import os
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+
+from backtest import Backtest, BacktestResult
+from data import PanelDataHandler
+from execution import SimulatedExecutionHandler
+from test import MyPortfolio
+import Test_strategy
+
+
+def _backtest(market, **kwargs):
+    data_dir, symbol_list, start_date = market
+    strategy_cls = functools.partial(Test_strategy.TestStrategy, stock_num=10, factor='PE')
+    return Backtest(os.path.join(data_dir, 'stock_price'), os.path.join(data_dir, 'factors'), symbol_list,
+                    1000000.0, 10, 0.0, start_date, PanelDataHandler, SimulatedExecutionHandler,
+                    MyPortfolio, strategy_cls, **kwargs)
+
+
+def test_backtest_runs_and_returns_result(market):
+    result = _backtest(market, factor='PE').run()
+    assert isinstance(result, BacktestResult)
+    assert result.fills > 0
+    assert len(result.execution_records) == result.fills
+    assert np.isfinite(result.equity_curve['total'].to_numpy()).all()
+
+
+def test_backtest_without_factor(market):
+    backtest = _backtest(market)
+    backtest.run()
+    assert backtest.data_handler.factor_na == 0
+    assert backtest.fills > 0
+
+
+def test_backtest_skip_ahead_matches_daily_loop(market):
+    skipped = _backtest(market, factor='PE', rebalance='W').run()
+    daily = _backtest(market, factor='PE', rebalance='W', skip_ahead=False).run()
+    assert skipped.equity_curve.index.equals(daily.equity_curve.index)
+    np.testing.assert_array_equal(skipped.equity_curve.to_numpy(float), daily.equity_curve.to_numpy(float))
+    assert skipped.fills == daily.fills
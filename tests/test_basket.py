@@ -0,0 +1,85 @@
+import functools
+import os
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import pytest
+
+from data import PanelDataHandler
+from event import BasketSignalEvent
+from execution import SimulatedExecutionHandler
+from factor_test import FactorTest
+from test import MyPortfolio
+import Test_strategy
+
+
+def test_basket_orders_keep_cash_non_negative(market):
+    data_dir, symbol_list, start_date = market
+    strategy_cls = functools.partial(Test_strategy.TestStrategy, basket=True)
+    factortest = FactorTest(os.path.join(data_dir, 'stock_price'), os.path.join(data_dir, 'factors'), symbol_list,
+                            1000000.0, 10, 0.0, start_date, 'PE', 1,
+                            data_handler_cls=PanelDataHandler, execution_handler_cls=SimulatedExecutionHandler,
+                            portfolio_cls=MyPortfolio, strategy_cls=strategy_cls, rebalance='W')
+    factortest._run_factortest()
+    curve = factortest.portfolio.equity_curve
+    assert factortest.signals > 0
+    assert (curve['cash'] >= 0).all()
+    assert (curve['commission'].diff().dropna() >= 0).all()
+    # 权重之和为1时，除了取整和手续费留下的零头，现金几乎全部买入股票
+    invested = curve[symbol_list].to_numpy().sum(axis=1)
+    assert np.max(invested / curve['total'].to_numpy()) > 0.99
+
+
+def test_default_strategy_uses_single_symbol_signals(market):
+    data_dir, symbol_list, start_date = market
+    factortest = FactorTest(os.path.join(data_dir, 'stock_price'), os.path.join(data_dir, 'factors'), symbol_list,
+                            1000000.0, 10, 0.0, start_date, 'PE', 1,
+                            data_handler_cls=PanelDataHandler, execution_handler_cls=SimulatedExecutionHandler,
+                            portfolio_cls=MyPortfolio, strategy_cls=Test_strategy.TestStrategy)
+    seen = []
+    factortest.layer_events[0].subscribe('SIGNAL', lambda event: seen.append(event.type))
+    factortest.layer_events[0].subscribe('BASKET_SIGNAL', lambda event: seen.append(event.type))
+    factortest._run_factortest()
+    assert seen and set(seen) == {'SIGNAL'}
+
+
+def test_basket_reduction_is_a_sell(market):
+    data_dir, symbol_list, start_date = market
+    strategy_cls = functools.partial(Test_strategy.TestStrategy, basket=True)
+    factortest = FactorTest(os.path.join(data_dir, 'stock_price'), os.path.join(data_dir, 'factors'), symbol_list,
+                            1000000.0, 10, 0.0, start_date, 'PE', 1,
+                            data_handler_cls=PanelDataHandler, execution_handler_cls=SimulatedExecutionHandler,
+                            portfolio_cls=MyPortfolio, strategy_cls=strategy_cls)
+    handler, portfolio, execution = factortest.data_handler, factortest.portfolio, factortest.execution_handler
+    events = factortest.layer_events[0]
+    handler.update_bars_monthly()
+    price = handler.get_latest_cross_section('close')
+    symbol = symbol_list[0]
+    weights = np.zeros(len(symbol_list))
+
+    def rebalance(weight):
+        weights[0] = weight
+        events.put(BasketSignalEvent(1, handler.panel.dates[0], symbol_list, None, weights.copy(), price))
+        events.dispatch()
+        return execution.trade_log.to_frame().iloc[-1]
+
+    opened = rebalance(0.5)
+    held = portfolio.current_positions[symbol]
+    cash = portfolio.current_holdings['cash']
+    cost = execution.recent_deal_average_cost[symbol]
+    assert opened['direction'] == 'LONG' and held > 0 and cost == pytest.approx(price[0])
+
+    # 减仓：卖出一部分，现金增加卖出所得减去手续费，平均成本不变
+    reduced = rebalance(0.2)
+    sold = held - portfolio.current_positions[symbol]
+    assert 0 < sold < held
+    assert reduced['direction'] == 'SELL' and reduced['quantity'] == sold
+    assert reduced['return_profit'] == pytest.approx(0.0)
+    assert portfolio.current_holdings['cash'] == pytest.approx(cash + sold * price[0] * (1 - portfolio.commission_rate))
+    assert execution.recent_deal_average_cost[symbol] == cost
+    assert execution.entry_time[symbol] == 1
+
+    closed = rebalance(0.0)
+    assert closed['direction'] == 'EXIT' and portfolio.current_positions[symbol] == 0
+    assert execution.recent_deal_average_cost[symbol] == 0
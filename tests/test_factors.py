@@ -0,0 +1,85 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from data import MemmapDataHandler, PanelDataHandler
+from event import EventBus
+from preprocess import FactorPreprocessor
+
+
+def _handler(market):
+    data_dir, symbol_list, start_date = market
+    return PanelDataHandler(EventBus(), os.path.join(data_dir, 'stock_price'), os.path.join(data_dir, 'factors'),
+                            'PE', start_date, symbol_list)
+
+
+def test_preprocess_factor_cache_follows_opened_panel(market, source):
+    stock_dir, factor_dir, symbol_list, cache_dir = source
+    start_date = market[2]
+    preprocessor = FactorPreprocessor(winsorize=3.0, standardize=True)
+    for handler_cls in (PanelDataHandler, MemmapDataHandler):
+        old = handler_cls(EventBus(), stock_dir, factor_dir, 'PE', start_date, symbol_list, cache_dir=cache_dir)
+        # 两个回测之间源文件追加了一行
+        date = (pd.Timestamp(str(old.panel.dates[-1])) + pd.offsets.BDay(1)).strftime('%Y-%m-%d')
+        for symbol in symbol_list:
+            with open(os.path.join(stock_dir, '%s.csv' % symbol), 'a') as f:
+                f.write('%s,10.1,9.9,10.0,10.0\n' % date)
+        new = handler_cls(EventBus(), stock_dir, factor_dir, 'PE', start_date, symbol_list, cache_dir=cache_dir)
+        assert len(new.panel) == len(old.panel) + 1
+
+        for handler in (new, old, new):
+            name = handler.preprocess_factor(preprocessor)
+            expected = preprocessor.transform(handler.field('PE'), handler.panel.symbols)
+            np.testing.assert_array_equal(handler.field(name), expected)
+
+
+def test_combine_factors_keeps_exact_weights(market):
+    handler = _handler(market)
+    a = handler.combine_factors({'PE': 0.5, 'PB': 0.5})
+    b = handler.combine_factors({'PE': 0.5, 'PB': 0.5000001})
+    assert a != b
+    assert not np.array_equal(handler.field(a), handler.field(b), equal_nan=True)
+    assert handler.combine_factors({'PE': 0.5, 'PB': 0.5}) == a
+
+
+def test_combine_factors_matches_weighted_zscore(market):
+    from preprocess import zscore
+
+    handler = _handler(market)
+    name = handler.combine_factors({'PE': 1, 'PB': -0.25})
+    expected = zscore(np.asarray(handler.field('PE'), dtype=float)) \
+        - 0.25 * zscore(np.asarray(handler.field('PB'), dtype=float))
+    np.testing.assert_array_equal(handler.field(name), expected)
+
+
+def _factor_na(market, rebalance):
+    import matplotlib
+    matplotlib.use('Agg')
+    from execution import SimulatedExecutionHandler
+    from factor_test import FactorTest
+    from test import MyPortfolio
+    import Test_strategy
+
+    data_dir, symbol_list, start_date = market
+    factortest = FactorTest(os.path.join(data_dir, 'stock_price'), os.path.join(data_dir, 'factors'), symbol_list,
+                            1000000.0, 10, 0.0, start_date, 'PE', 1,
+                            data_handler_cls=PanelDataHandler, execution_handler_cls=SimulatedExecutionHandler,
+                            portfolio_cls=MyPortfolio, strategy_cls=Test_strategy.TestStrategy, rebalance=rebalance)
+    # 回测第一天去掉几支股票的因子值
+    values = np.array(factortest.data_handler.field('PE'), dtype=float)
+    values[0, :4] = np.nan
+    factortest.data_handler.add_field('PE_NA', values)
+    counted = []
+    # 同一个FactorTest跑两次，第二次的计数不能叠加在第一次上
+    for _ in range(2):
+        factortest.set_factor('PE_NA')
+        factortest._run_factortest()
+        counted.append(factortest.data_handler.factor_na)
+    return counted, int(np.isnan(values[0]).sum())
+
+
+def test_factor_na_counted_once_per_run(market):
+    for rebalance in ('M', 'W', 3):
+        counted, expected = _factor_na(market, rebalance)
+        assert counted == [expected, expected]
@@ -0,0 +1,41 @@
+import gc
+import os
+
+import matplotlib
+matplotlib.use('Agg')
+
+from data import PanelDataHandler
+from execution import SimulatedExecutionHandler
+from factor_test import FactorTest
+from instrument import Instrumentation
+from test import MyPortfolio
+import Test_strategy
+
+
+def _factortest(market, timer):
+    data_dir, symbol_list, start_date = market
+    return FactorTest(os.path.join(data_dir, 'stock_price'), os.path.join(data_dir, 'factors'), symbol_list,
+                      1000000.0, 10, 0.0, start_date, 'PE', 2,
+                      data_handler_cls=PanelDataHandler, execution_handler_cls=SimulatedExecutionHandler,
+                      portfolio_cls=MyPortfolio, strategy_cls=Test_strategy.TestStrategy, instrumentation=timer)
+
+
+def test_instrumentation_restores_handlers_and_rewraps_new_runs(market):
+    timer = Instrumentation()
+    factortest = _factortest(market, timer)
+    factortest._run_factortest()
+    calls = dict(timer.calls)
+    assert calls['calculate_signals'] > 0
+    # 回测结束后恢复原来的方法
+    assert 'update_bars_monthly' not in vars(factortest.data_handler)
+    assert 'put' not in vars(factortest.events)
+    for portfolio, strategy in zip(factortest.portfolios, factortest.strategies):
+        assert 'update_timeindex' not in vars(portfolio) and 'calculate_signals' not in vars(strategy)
+
+    # 旧的回测对象被回收后，新回测中的对象（可能复用同一个id）仍然被计时
+    del factortest
+    gc.collect()
+    for _ in range(2):
+        _factortest(market, timer)._run_factortest()
+    assert timer.calls['calculate_signals'] == 3 * calls['calculate_signals']
+    assert timer.calls['update_bars_monthly'] == 3 * calls['update_bars_monthly']
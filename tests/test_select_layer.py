@@ -0,0 +1,43 @@
+import numpy as np
+
+from Test_strategy import select_layer
+
+
+def _reference(values):
+    # 因子值从大到小，NaN排在最后，相同的值按股票顺序
+    key = np.where(np.isnan(values), np.inf, -values)
+    return np.lexsort((np.arange(len(values)), key))
+
+
+def test_layers_are_disjoint_and_cover_all_symbols_with_ties_and_nan():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        n_symbols = int(rng.integers(1, 40))
+        values = rng.integers(0, 4, n_symbols).astype(float)
+        values[rng.random(n_symbols) < 0.3] = np.nan
+        n = int(rng.integers(1, n_symbols + 1))
+        layers = [select_layer(values, cur_layer, n) for cur_layer in range(-(-n_symbols // n))]
+        selected = np.concatenate(layers)
+        assert len(selected) == n_symbols
+        assert np.array_equal(np.sort(selected), np.arange(n_symbols))
+
+
+def test_layers_follow_stable_descending_order():
+    rng = np.random.default_rng(1)
+    for _ in range(200):
+        n_symbols = int(rng.integers(1, 40))
+        values = rng.integers(0, 4, n_symbols).astype(float)
+        values[rng.random(n_symbols) < 0.3] = np.nan
+        n = int(rng.integers(1, n_symbols + 1))
+        order = _reference(values)
+        for cur_layer in range(-(-n_symbols // n) + 1):
+            expected = np.sort(order[cur_layer * n:(cur_layer + 1) * n])
+            assert np.array_equal(select_layer(values, cur_layer, n), expected)
+
+
+def test_ties_keep_symbol_order_and_nan_last():
+    values = np.array([1.0, 2.0, np.nan, 2.0, 1.0, 1.0, np.nan, 3.0, 1.0, 2.0])
+    assert list(select_layer(values, 0, 3)) == [1, 3, 7]
+    assert list(select_layer(values, 1, 3)) == [0, 4, 9]
+    assert list(select_layer(values, 2, 3)) == [2, 5, 8]
+    assert list(select_layer(values, 3, 3)) == [6]
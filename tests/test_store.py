@@ -0,0 +1,166 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from panel import build_panel, load_universe
+from store import PanelStore
+
+
+def _assert_matches_full_rebuild(source):
+    stock_dir, factor_dir, symbol_list, cache_dir = source
+    store = PanelStore.for_universe(cache_dir, stock_dir, factor_dir, symbol_list)
+    panel = store.update(stock_dir, factor_dir, symbol_list, cache_dir)
+    expected = build_panel(symbol_list, *load_universe(stock_dir, factor_dir, symbol_list), None)
+    assert list(panel.dates) == list(expected.dates)
+    assert panel.fields == expected.fields
+    np.testing.assert_array_equal(panel.values, expected.values)
+    return panel
+
+
+def _append_price(stock_dir, symbol, date, close):
+    with open(os.path.join(stock_dir, '%s.csv' % symbol), 'a') as f:
+        f.write('%s,%.4f,%.4f,%.4f,%.4f\n' % (date, close * 1.01, close * 0.99, close, close))
+
+
+def _edit_factor(factor_dir, symbol, edit):
+    path = os.path.join(factor_dir, '%s.xlsx' % symbol)
+    df = pd.read_excel(path, index_col=0)
+    df = edit(df)
+    df.to_excel(path)
+
+
+def test_store_matches_full_rebuild_after_appends(source):
+    stock_dir, factor_dir, symbol_list, _ = source
+    panel = _assert_matches_full_rebuild(source)
+    last = pd.Timestamp(str(panel.dates[-1]))
+    for k in range(1, 3):
+        date = (last + pd.offsets.BDay(k)).strftime('%Y-%m-%d')
+        for symbol in symbol_list[:5]:
+            _append_price(stock_dir, symbol, date, 10.0 + k)
+        _edit_factor(factor_dir, symbol_list[0],
+                     lambda df: pd.concat([df, pd.DataFrame({'PE': [1.5 * k], 'PB': [np.nan]},
+                                                            index=pd.Index([pd.Timestamp(date)], name=df.index.name))]))
+        panel = _assert_matches_full_rebuild(source)
+        assert panel.dates[-1] == date
+
+
+def test_store_rebuilds_after_historical_price_edit(source):
+    stock_dir, factor_dir, symbol_list, _ = source
+    _assert_matches_full_rebuild(source)
+    path = os.path.join(stock_dir, '%s.csv' % symbol_list[9])
+    df = pd.read_csv(path)
+    df.loc[10, 'close'] += 0.0002
+    df.to_csv(path, index=False, float_format='%.4f')
+    panel = _assert_matches_full_rebuild(source)
+    assert panel.field('close')[list(panel.dates).index(df.loc[10, 'datetime']), 9] == pytest.approx(df.loc[10, 'close'])
+
+
+def test_store_rebuilds_after_historical_factor_edit(source):
+    stock_dir, factor_dir, symbol_list, _ = source
+    _assert_matches_full_rebuild(source)
+
+    def edit(df):
+        df.iloc[5, df.columns.get_loc('PE')] = 123.0
+        return df
+
+    _edit_factor(factor_dir, symbol_list[11], edit)
+    panel = _assert_matches_full_rebuild(source)
+    assert panel.field('PE')[5, 11] == 123.0
+
+
+def test_update_does_not_modify_files_mapped_by_readers(source):
+    stock_dir, factor_dir, symbol_list, cache_dir = source
+    reader = PanelStore.for_universe(cache_dir, stock_dir, factor_dir, symbol_list)
+    mapped = reader.update(stock_dir, factor_dir, symbol_list, cache_dir, mmap=True)
+    before = np.array(mapped.values)
+    old_path = reader.values_path
+
+    date = (pd.Timestamp(str(mapped.dates[-1])) + pd.offsets.BDay(1)).strftime('%Y-%m-%d')
+    _append_price(stock_dir, symbol_list[0], date, 12.0)
+    _edit_factor(factor_dir, symbol_list[0],
+                 lambda df: pd.concat([df, pd.DataFrame({'PE': [2.0], 'PB': [3.0]},
+                                                        index=pd.Index([pd.Timestamp(date)], name=df.index.name))]))
+    writer = PanelStore.for_universe(cache_dir, stock_dir, factor_dir, symbol_list)
+    updated = writer.update(stock_dir, factor_dir, symbol_list, cache_dir)
+
+    # 只追加新行：写在同一个数据文件的末尾
+    assert writer.values_path == old_path
+    np.testing.assert_array_equal(mapped.values, before)
+    assert len(updated) == len(mapped) + 1
+    _assert_matches_full_rebuild(source)
+
+
+def test_late_factor_rows_are_written_to_a_new_generation(source):
+    stock_dir, factor_dir, symbol_list, cache_dir = source
+    path = os.path.join(factor_dir, '%s.xlsx' % symbol_list[3])
+    full = pd.read_excel(path, index_col=0)
+    full.iloc[:-2].to_excel(path)  # 因子比行情晚两天
+    reader = PanelStore.for_universe(cache_dir, stock_dir, factor_dir, symbol_list)
+    mapped = reader.update(stock_dir, factor_dir, symbol_list, cache_dir, mmap=True)
+    before = np.array(mapped.values)
+    old_path = reader.values_path
+
+    full.to_excel(path)
+    writer = PanelStore.for_universe(cache_dir, stock_dir, factor_dir, symbol_list)
+    updated = writer.update(stock_dir, factor_dir, symbol_list, cache_dir)
+
+    assert writer.values_path != old_path
+    assert not os.path.exists(old_path)
+    np.testing.assert_array_equal(mapped.values, before)
+    assert len(updated) == len(mapped)
+    _assert_matches_full_rebuild(source)
+
+
+def test_update_parses_only_new_rows(source, monkeypatch):
+    import store
+
+    stock_dir, factor_dir, symbol_list, cache_dir = source
+    monkeypatch.setattr(PanelStore, 'VERIFY_BYTES', 256)  # 校验窗口比已经读入的部分小
+    panel = _assert_matches_full_rebuild(source)
+
+    parsed = []
+    read_factor_xlsx = store.read_factor_xlsx
+
+    def counting(path, sort=True):
+        result = read_factor_xlsx(path, sort)
+        parsed.append(len(result[0]))
+        return result
+
+    monkeypatch.setattr(store, 'read_factor_xlsx', counting)
+    last = pd.Timestamp(str(panel.dates[-1]))
+    for k in range(1, 3):
+        date = (last + pd.offsets.BDay(k)).strftime('%Y-%m-%d')
+        for symbol in symbol_list:
+            _append_price(stock_dir, symbol, date, 10.0 + k)
+            _edit_factor(factor_dir, symbol,
+                         lambda df: pd.concat([df, pd.DataFrame({'PE': [1.5 * k], 'PB': [0.5 * k]},
+                                                                index=pd.Index([pd.Timestamp(date)],
+                                                                               name=df.index.name))]))
+        del parsed[:]
+        panel = _assert_matches_full_rebuild(source)
+        assert panel.dates[-1] == date
+        # 每个因子文件只解析了新增的一行（完整重建不经过store.read_factor_xlsx）
+        assert parsed == [1] * len(symbol_list)
+
+
+def test_concurrent_updates_are_serialized(source):
+    from concurrent.futures import ThreadPoolExecutor
+
+    stock_dir, factor_dir, symbol_list, cache_dir = source
+    panel = _assert_matches_full_rebuild(source)
+    date = (pd.Timestamp(str(panel.dates[-1])) + pd.offsets.BDay(1)).strftime('%Y-%m-%d')
+    for symbol in symbol_list:
+        _append_price(stock_dir, symbol, date, 11.0)
+
+    def update(_):
+        store = PanelStore.for_universe(cache_dir, stock_dir, factor_dir, symbol_list)
+        return len(store.update(stock_dir, factor_dir, symbol_list, cache_dir))
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        assert set(pool.map(update, range(4))) == {len(panel) + 1}
+    _assert_matches_full_rebuild(source)
+    bins = [name for name in os.listdir(os.path.dirname(PanelStore.for_universe(
+        cache_dir, stock_dir, factor_dir, symbol_list).meta_path)) if name.endswith('.bin')]
+    assert len(bins) == 1
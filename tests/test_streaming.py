@@ -0,0 +1,141 @@
+import functools
+import os
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import pytest
+
+from data import PanelDataHandler, StreamingDataHandler
+from execution import SimulatedExecutionHandler
+from factor_test import FactorTest
+from test import MyPortfolio
+import Test_strategy
+
+
+class TriggerStrategy(Test_strategy.TestStrategy):
+    """
+    收盘价比回测第一天上涨10%的股票出现时，在调仓点之前提前处理行情
+    """
+
+    def next_control(self, start):
+        stop = self.bars.next_rebalance(start)
+        return self.bars.first_crossing('close', start, stop, upper=self.bars.field_rows('close', 0, 1)[0] * 1.1)
+
+
+class GuardedValues(object):
+    """
+    代替完整历史的内存映射，回测循环中访问时报错
+    """
+
+    def __getitem__(self, item):
+        raise AssertionError("full-history panel accessed during the backtest")
+
+
+def _factortest(market, tmp_path, handler_cls, strategy_cls, guard=False, **kwargs):
+    data_dir, symbol_list, start_date = market
+    factortest = FactorTest(os.path.join(data_dir, 'stock_price'), os.path.join(data_dir, 'factors'), symbol_list,
+                            1000000.0, 12, 0.0, start_date, 'PE', 3,
+                            data_handler_cls=handler_cls, execution_handler_cls=SimulatedExecutionHandler,
+                            portfolio_cls=MyPortfolio, strategy_cls=strategy_cls, cache_dir=str(tmp_path), **kwargs)
+    if guard:
+        factortest.data_handler.panel.values = GuardedValues()
+    factortest._run_factortest()
+    return factortest
+
+
+def _run(market, tmp_path, handler_cls, strategy_cls, guard=False, **kwargs):
+    factortest = _factortest(market, tmp_path, handler_cls, strategy_cls, guard, **kwargs)
+    return [portfolio.equity_curve for portfolio in factortest.portfolios]
+
+
+@pytest.mark.parametrize('handler_cls', [PanelDataHandler, StreamingDataHandler])
+def test_trigger_control_points_match_daily_loop(market, tmp_path, handler_cls):
+    daily = _factortest(market, tmp_path, handler_cls, TriggerStrategy, rebalance='Q', skip_ahead=False)
+    skipped = _factortest(market, tmp_path, handler_cls, TriggerStrategy, rebalance='Q', skip_ahead=True)
+    assert daily.fills == skipped.fills
+    assert daily.orders == skipped.orders
+    for a, b in zip(daily.portfolios, skipped.portfolios):
+        assert a.equity_curve.index.equals(b.equity_curve.index)
+        np.testing.assert_array_equal(a.equity_curve.to_numpy(float), b.equity_curve.to_numpy(float))
+
+
+@pytest.mark.parametrize('strategy_cls', [Test_strategy.TestStrategy, TriggerStrategy])
+@pytest.mark.parametrize('chunk', [None, 7])
+def test_streaming_skip_ahead_reads_by_chunk(market, tmp_path, strategy_cls, chunk):
+    expected = _run(market, tmp_path, PanelDataHandler, strategy_cls, rebalance='Q')
+    streamed = _run(market, tmp_path, functools.partial(StreamingDataHandler, chunk=chunk), strategy_cls, guard=True,
+                    rebalance='Q')
+    for a, b in zip(expected, streamed):
+        assert a.index.equals(b.index)
+        np.testing.assert_array_equal(a.to_numpy(float), b.to_numpy(float))
+
+
+def test_close_releases_file_and_rerun_reopens(market, tmp_path):
+    factortest = _factortest(market, tmp_path, functools.partial(StreamingDataHandler, chunk=7),
+                             Test_strategy.TestStrategy)
+    handler = factortest.data_handler
+    first = [portfolio.equity_curve for portfolio in factortest.portfolios]
+    assert handler.values_file is None and handler._executor is None
+
+    factortest.set_factor('PE')
+    factortest._run_factortest()
+    assert handler.values_file is None and handler._executor is None
+    for a, b in zip(first, factortest.portfolios):
+        np.testing.assert_array_equal(a.to_numpy(float), b.equity_curve.to_numpy(float))
+
+
+def test_streaming_handler_retries_when_generation_is_replaced(market, tmp_path, monkeypatch):
+    from event import EventBus
+    from store import PanelStore
+
+    data_dir, symbol_list, start_date = market
+    stock_dir, factor_dir = os.path.join(data_dir, 'stock_price'), os.path.join(data_dir, 'factors')
+    open_store = StreamingDataHandler._open_store
+    calls = []
+
+    def racing(self, mmap):
+        full = open_store(self, mmap)
+        if not calls:
+            # 更新之后、打开数据文件之前，另一个进程重建了面板并删除了这一代数据文件
+            PanelStore.for_universe(str(tmp_path), stock_dir, factor_dir, symbol_list).rebuild(
+                stock_dir, factor_dir, symbol_list)
+        calls.append(self.store.values_path)
+        return full
+
+    monkeypatch.setattr(StreamingDataHandler, '_open_store', racing)
+    handler = StreamingDataHandler(EventBus(), stock_dir, factor_dir, 'PE', start_date, symbol_list,
+                                   cache_dir=str(tmp_path))
+    assert len(calls) == 2 and calls[0] != calls[1]
+    assert handler.values_file.name == calls[1]
+    np.testing.assert_array_equal(handler.field_rows('close', 0, 3), handler.panel.field('close')[:3])
+    handler.close()
+
+
+@pytest.mark.parametrize('handler_cls', [PanelDataHandler, functools.partial(StreamingDataHandler, chunk=7)])
+def test_ring_buffer_lookback_matches_panel(market, tmp_path, handler_cls):
+    from event import EventBus
+
+    data_dir, symbol_list, start_date = market
+    handler = handler_cls(EventBus(), os.path.join(data_dir, 'stock_price'), os.path.join(data_dir, 'factors'), 'PE',
+                          start_date, symbol_list, cache_dir=str(tmp_path))
+    lookback = {'close': 5, 'PE': 3}
+    handler.declare_lookback(lookback)
+    expected = dict((field, np.array(handler.panel.field(field))) for field in lookback)
+    rng = np.random.RandomState(0)
+    skipped = 0
+    while handler.continue_backtest:
+        handler.update_bars_monthly()
+        t = handler.bar_index
+        if t < 0 or not handler.continue_backtest:
+            continue
+        for field, n in lookback.items():
+            for j in (0, len(symbol_list) - 1):
+                for N in (1, n - 1, n):
+                    np.testing.assert_array_equal(handler.get_latest_bars_values(symbol_list[j], field, N),
+                                                  expected[field][max(t - N + 1, 0):t + 1, j])
+        # 随机跳过一段数据条目（有时比回看长度短，有时更长），环形缓冲区要补上跳过的部分
+        if not handler.next_month_bar and t + 12 < len(handler.panel) and rng.rand() < 0.3:
+            handler.skip_to(t + rng.randint(2, 12), None)
+            skipped += 1
+    assert skipped > 3
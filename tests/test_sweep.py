@@ -0,0 +1,43 @@
+import os
+
+import pandas as pd
+import pytest
+
+from sweep import ParameterSweep
+
+
+@pytest.mark.parametrize('cached', [True, False])
+def test_parallel_sweep_matches_serial(market, tmp_path, cached):
+    data_dir, symbol_list, start_date = market
+    cache_dir = str(tmp_path) if cached else None
+    grid = {'factor': ['PE', 'PB'], 'stock_num': [6, 12], 'layer': [2],
+            'start_date': [None, pd.Timestamp(start_date) + pd.offsets.BDay(20)]}
+
+    def sweep(workers):
+        return ParameterSweep(os.path.join(data_dir, 'stock_price'), os.path.join(data_dir, 'factors'), symbol_list,
+                              1000000.0, start_date, cache_dir=cache_dir, workers=workers).run(grid)
+
+    serial = sweep(1)
+    assert len(serial) == 16
+    pd.testing.assert_frame_equal(sweep(2), serial)
+
+
+def test_workers_use_the_parent_generation(market, source):
+    from store import PanelStore
+
+    stock_dir, factor_dir, symbol_list, cache_dir = source
+    grid = {'factor': ['PE'], 'stock_num': [6, 12], 'layer': [2]}
+    sweep = ParameterSweep(stock_dir, factor_dir, symbol_list, 1000000.0, market[2], cache_dir=cache_dir)
+    serial = sweep.run(dict(grid))
+
+    # 主进程打开面板之后，另一个进程追加了新的一天
+    date = (pd.Timestamp(str(sweep.panel.dates[-1])) + pd.offsets.BDay(1)).strftime('%Y-%m-%d')
+    for symbol in symbol_list:
+        with open(os.path.join(stock_dir, '%s.csv' % symbol), 'a') as f:
+            f.write('%s,20.2,19.8,20.0,20.0\n' % date)
+    updated = PanelStore.for_universe(cache_dir, stock_dir, factor_dir, symbol_list).update(
+        stock_dir, factor_dir, symbol_list, cache_dir)
+    assert updated.dates[-1] == date
+
+    sweep.workers = 2
+    pd.testing.assert_frame_equal(sweep.run(dict(grid)), serial)
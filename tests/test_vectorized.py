@@ -0,0 +1,55 @@
+import os
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import pytest
+
+from data import PanelDataHandler
+from execution import SimulatedExecutionHandler
+from factor_test import FactorTest
+from test import MyPortfolio
+import Test_strategy
+
+LAYER = 3
+
+
+def _factor_test(market, **kwargs):
+    data_dir, symbol_list, start_date = market
+    return FactorTest(os.path.join(data_dir, 'stock_price'), os.path.join(data_dir, 'factors'), symbol_list,
+                      1000000.0, 12, 0.0, start_date, 'PE', LAYER,
+                      data_handler_cls=PanelDataHandler, execution_handler_cls=SimulatedExecutionHandler,
+                      portfolio_cls=MyPortfolio, strategy_cls=Test_strategy.TestStrategy, **kwargs)
+
+
+def _assert_layers_match(factortest):
+    factortest._run_factortest()
+    for cur_layer, portfolio in enumerate(factortest.portfolios):
+        event_curve = portfolio.equity_curve.drop(columns='drawdown', errors='ignore')
+        vectorized_curve = factortest.run_vectorized(cur_layer).equity_curve
+        assert event_curve.index.equals(vectorized_curve.index)
+        assert len(event_curve) == len(vectorized_curve)
+        np.testing.assert_allclose(event_curve.to_numpy(float),
+                                   vectorized_curve[event_curve.columns].to_numpy(float),
+                                   rtol=1e-10, atol=1e-6)
+
+
+@pytest.mark.parametrize('rebalance', ['M', 'W'])
+@pytest.mark.parametrize('skip_ahead', [True, False])
+def test_vectorized_matches_event_engine(market, rebalance, skip_ahead):
+    _assert_layers_match(_factor_test(market, rebalance=rebalance, skip_ahead=skip_ahead))
+
+
+def test_vectorized_matches_event_engine_with_ties_and_nan(market):
+    factortest = _factor_test(market)
+    # 因子只取-1和1两个值，大量相同的值，另外每天随机去掉一部分因子值
+    values = np.sign(np.asarray(factortest.data_handler.field('PE'), dtype=float))
+    values[np.random.default_rng(0).random(values.shape) < 0.2] = np.nan
+    factortest.data_handler.add_field('PE_TIED', values)
+    factortest.set_factor('PE_TIED')
+    _assert_layers_match(factortest)
+    # 各层在同一天不会持有同一支股票
+    held = np.array([portfolio.equity_curve[factortest.data_handler.symbol_list].to_numpy() != 0
+                     for portfolio in factortest.portfolios])
+    assert held.any()
+    assert held.sum(axis=0).max() <= 1
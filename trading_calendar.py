@@ -0,0 +1,68 @@
+# trading_calendar.py
+
+import numpy as np
+
+FREQUENCIES = ('W', 'M', 'Q', 'Y')
+
+
+class TradingCalendar(object):
+    """
+    TradingCalendar把面板的'%Y-%m-%d'日期字符串一次转换成datetime64数组，
+    并预先算出调仓点在日期序列中的下标，回测循环中只需要比较整数，不再逐条解析日期。
+    调仓点是一个周期的最后一个交易日：策略在这一天收盘时调仓，下一个交易日进入新的周期。
+    """
+
+    def __init__(self, dates):
+
+        self.dates = np.asarray(dates)
+        self.days = self.dates.astype('datetime64[D]')
+        self.months = self.days.astype('datetime64[M]').astype(int) % 12 + 1
+
+    def __len__(self):
+
+        return len(self.days)
+
+    def _period_keys(self, freq):
+        """
+        每个交易日所属周期的整数编号：W为周（周一开始），M为月，Q为季度，Y为年
+        """
+
+        if freq == 'W':
+            # 1970-01-01是星期四，加3后按7整除得到以周一开始的周编号
+            return (self.days.astype(int) + 3) // 7
+        if freq == 'M':
+            return self.days.astype('datetime64[M]').astype(int)
+        if freq == 'Q':
+            return self.days.astype('datetime64[M]').astype(int) // 3
+        if freq == 'Y':
+            return self.days.astype('datetime64[Y]').astype(int)
+        raise ValueError("Unknown rebalance frequency %r, expected one of %s, an integer or a list of dates"
+                         % (freq, FREQUENCIES))
+
+    def rebalance_offsets(self, freq='M'):
+        """
+        调仓点的下标数组（升序）。freq为'W'/'M'/'Q'/'Y'时是每周/月/季/年的最后一个交易日；
+        为整数N时每N个交易日调仓一次；为日期列表时是每个日期当天或之前最近的一个交易日。
+        最后一个交易日之后没有数据，不作为调仓点
+        """
+
+        n = len(self.days)
+        if isinstance(freq, str):
+            keys = self._period_keys(freq)
+            return np.flatnonzero(keys[1:] != keys[:-1])
+        if isinstance(freq, (int, np.integer)):
+            if freq < 1:
+                raise ValueError("Rebalance interval must be at least 1 bar, got %d" % freq)
+            return np.arange(freq - 1, n - 1, freq)
+        custom = np.asarray([np.datetime64(d, 'D') for d in freq], dtype='datetime64[D]')
+        offsets = np.unique(np.searchsorted(self.days, custom, side='right') - 1)
+        return offsets[(offsets >= 0) & (offsets < n - 1)]
+
+    def rebalance_mask(self, freq='M'):
+        """
+        每个交易日是否为调仓点的布尔数组
+        """
+
+        mask = np.zeros(len(self.days), dtype=bool)
+        mask[self.rebalance_offsets(freq)] = True
+        return mask
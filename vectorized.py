@@ -0,0 +1,113 @@
+# vectorized.py
+
+import numpy as np
+import pandas as pd
+
+from performance import create_summary_stats
+from Test_strategy import select_layer
+from trading_calendar import TradingCalendar
+
+
+class VectorizedFactorTest(object):
+    """
+    VectorizedFactorTest是月度调仓因子测试的向量化版本，不经过事件队列。
+    交易规则与FactorTest + TestStrategy + MyPortfolio + SimulatedExecutionHandler一致：
+    每个调仓日（默认为每月最后一个交易日，见TradingCalendar）按因子值从大到小排序，先清仓，再用清仓后的现金平均买入
+    当前层的n支股票（按收盘价成交，股数向下取整），每日按收盘价结算市值。
+    直接在面板的(日期 × 股票)矩阵上计算，得到与事件驱动引擎相同的equity_curve。
+    factor_values是排序使用的(日期 × 股票)因子矩阵（例如预处理后的因子），默认为面板中的factor字段。
+    """
+
+    def __init__(self, panel, factor, stock_num, layer=1, initial_capital=100000, commission=0.00025,
+                 factor_values=None, rebalance='M'):
+
+        self.panel = panel
+        self.factor = factor
+        self.stock_num = stock_num
+        self.layer = layer
+        self.initial_capital = initial_capital
+        self.commission = commission
+
+        self.close = self.panel.field('close')
+        self.factor_values = self.panel.field(self.factor) if factor_values is None else factor_values
+        self.rebalance_index = TradingCalendar(self.panel.dates).rebalance_offsets(rebalance)
+
+    def _layer_selection(self, t, cur_layer):
+        """
+        t日按因子值降序（NaN排在最后）排序后，取第cur_layer层的股票下标
+        """
+
+        n = int(self.stock_num / self.layer)
+        return select_layer(self.factor_values[t], cur_layer, n)
+
+    def run(self, cur_layer=0):
+        """
+        计算第cur_layer层的持仓、现金和市值，生成equity_curve
+        """
+
+        n_dates, n_symbols = self.close.shape
+        positions = np.zeros((n_dates, n_symbols))
+        cash = np.empty(n_dates)
+        commission = np.empty(n_dates)
+
+        cur_positions = np.zeros(n_symbols)
+        cur_cash = float(self.initial_capital)
+        cur_commission = 0.0
+        prev = 0
+        for t in self.rebalance_index:
+            # t日及之前记录的是调仓前的状态，调仓后的持仓从t+1日开始生效
+            positions[prev:t + 1] = cur_positions
+            cash[prev:t + 1] = cur_cash
+            commission[prev:t + 1] = cur_commission
+            prev = t + 1
+
+            price = self.close[t]
+            sold = (cur_positions * price).sum()
+            cur_cash += sold - self.commission * sold
+            cur_commission += self.commission * sold
+
+            # 所有卖单成交后才发出买入信号，每支股票分到清仓后现金的1/stock_num
+            selected = self._layer_selection(t, cur_layer)
+            selected = selected[price[selected] != 0]
+            cur_positions = np.zeros(n_symbols)
+            cur_positions[selected] = np.floor(cur_cash / self.stock_num / price[selected])
+            bought = (cur_positions * price).sum()
+            cur_cash -= bought + self.commission * bought
+            cur_commission += self.commission * bought
+
+        positions[prev:] = cur_positions
+        cash[prev:] = cur_cash
+        commission[prev:] = cur_commission
+
+        market_value = positions * self.close
+        total = cash + market_value.sum(axis=1)
+        self.positions = positions
+        self.create_equity_curve_dataframe(market_value, cash, commission, total)
+        return self.equity_curve
+
+    def create_equity_curve_dataframe(self, market_value, cash, commission, total):
+        """
+        按Portfolio.create_equity_curve_dataframe的格式生成equity_curve：第一行是初始资金；
+        事件驱动引擎在调仓日和最后一个交易日会多调用一次update_timeindex，这些日期各重复一行
+        """
+
+        n_dates = len(total)
+        rows = np.sort(np.r_[0, np.arange(n_dates), self.rebalance_index, n_dates - 1])
+        curve = pd.DataFrame(market_value[rows], columns=self.panel.symbols)
+        curve['cash'] = cash[rows]
+        curve['commission'] = commission[rows]
+        curve['total'] = total[rows]
+        curve.iloc[0] = 0.0
+        curve.iloc[0, curve.columns.get_loc('cash')] = self.initial_capital
+        curve.iloc[0, curve.columns.get_loc('total')] = self.initial_capital
+        curve.index = pd.Index([np.nan] + list(self.panel.dates[rows[1:]]), name='datetime')
+        curve['returns'] = curve['total'].pct_change()
+        curve['equity_curve'] = (1.0 + curve['returns']).cumprod()
+        self.equity_curve = curve
+
+    def output_summary_stats(self):
+        """
+        Equity_summary
+        """
+
+        return create_summary_stats(self.equity_curve)